@@ -2,7 +2,7 @@
 from setuptools import setup
 from setuptools.command.install import install
 
-install_requires = ["fdstools>=2.0.1",
+install_requires = ["fdstools>=2.2,<2.3",
                     "umierrorcorrect>=0.29",
                     "pysam>=0.19.1",
                     "scikit-learn==1.1.1",
@@ -32,10 +32,20 @@ setup(name='umierrorcorrect_forensics',
                "umierrorcorrect_forensics/run_fdstools.py",
                "umierrorcorrect_forensics/fastq2sam.py",
                "umierrorcorrect_forensics/run_umifilter.py",
+               "umierrorcorrect_forensics/family_store.py",
+               "umierrorcorrect_forensics/model_cache.py",
                "umierrorcorrect_forensics/convert_fastq2bam.py",
                "umierrorcorrect_forensics/convert_bam2fastq.py",
+               "umierrorcorrect_forensics/postprocess.py",
+               "umierrorcorrect_forensics/fdstools_engine.py",
+               "umierrorcorrect_forensics/tssv_engine.py",
+               "umierrorcorrect_forensics/fused_fastq2bam.py",
+               "umierrorcorrect_forensics/flat_forest.py",
                "umierrorcorrect_forensics/tools/uncollapse_reads.py",
                "umierrorcorrect_forensics/tools/downsample.py",
                "umierrorcorrect_forensics/tools/barcode_diversity.py",
-               "umierrorcorrect_forensics/tools/get_stutters.py"],
+               "umierrorcorrect_forensics/tools/get_stutters.py",
+               "umierrorcorrect_forensics/tools/simulate_reads.py",
+               "umierrorcorrect_forensics/tools/benchmark.py",
+               "umierrorcorrect_forensics/tools/check_flank_search.py"],
       zip_safe=False)
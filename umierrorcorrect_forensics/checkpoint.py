@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Stage checkpoints, to resume a sample where it stopped.
+
+Each stage of the pipeline is keyed on the contents of its input files and
+on its settings. When a stage has finished, its key and the content digests
+of its output files are saved to checkpoints.json in the output directory.
+When the sample is run again, a stage with the same key and unchanged
+outputs is skipped, and the result it returned is taken from the
+checkpoint.
+
+Output files that are read by a later stage may have been removed, like
+the temp files after UMIerrorcorrect. They are not needed as long as no
+stage that reads them has to run again. If one has to, the stage that wrote
+them is run again first.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from functools import partial
+from umierrorcorrect_forensics.profiling import profile
+
+CHECKPOINT_FILE = "checkpoints.json"
+CHUNK_SIZE = 1 << 20
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fh:
+        while chunk := fh.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Checkpoints:
+    """
+    Checkpoints of the stages of one sample. If not enabled, all stages
+    are run, and nothing is saved. If metrics (a metrics.RunMetrics) are
+    given, the stages are measured. If profile_path is given, the stages
+    are profiled (see profiling), with the profile files written there.
+    """
+    def __init__(self, output_path, enabled=True, metrics=None, profile_path=None):
+        self.path = os.path.join(output_path, CHECKPOINT_FILE)
+        self.enabled = enabled
+        self.metrics = metrics
+        self.profile_path = profile_path
+        self.state = {"stages": {}, "files": {}}
+        if enabled and os.path.isfile(self.path):
+            with open(self.path) as fh:
+                self.state = json.load(fh)
+        # Functions that run the stages of this run again, by stage name
+        self.reruns = {}
+        # Stages may run at the same time, in threads (see scheduler)
+        self.lock = threading.RLock()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(self.state, fh, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def file_digest(self, path):
+        """
+        Returns the content digest of a file. Digests are cached by size and
+        modification time, so unchanged files are not read again.
+        """
+        stat = os.stat(path)
+        cached = self.state["files"].get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hash_file(path)
+        self.state["files"][path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def digest(self, path):
+        """
+        Returns the content digest of a file or a directory. For a removed
+        output of a stage, the digest saved for the stage is returned.
+        """
+        if os.path.isdir(path):
+            digest = hashlib.blake2b(digest_size=16)
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    digest.update(os.path.relpath(file_path, path).encode())
+                    digest.update(self.file_digest(file_path).encode())
+            return digest.hexdigest()
+        if os.path.exists(path):
+            return self.file_digest(path)
+        producer = self.producer(path)
+        if producer is None:
+            raise FileNotFoundError(path)
+        return self.state["stages"][producer]["outputs"][path]
+
+    def producer(self, path):
+        """Returns the stage that wrote a file, if any."""
+        for stage, saved in self.state["stages"].items():
+            if path in saved["outputs"]:
+                return stage
+        return None
+
+    def stage_key(self, stage, inputs, params):
+        key = json.dumps([stage, [self.digest(path) for path in inputs], params], sort_keys=True)
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def outputs_valid(self, stage):
+        """
+        Outputs are valid if unchanged, or if removed after being read by
+        another stage.
+        """
+        saved = self.state["stages"][stage]
+        for path, digest in saved["outputs"].items():
+            if os.path.exists(path):
+                if self.digest(path) != digest:
+                    return False
+            elif not any(path in other["inputs"] for other in self.state["stages"].values()):
+                return False
+        return True
+
+    def restore_inputs(self, inputs):
+        """Runs the stages that wrote removed input files again."""
+        for path in inputs:
+            if not os.path.exists(path):
+                producer = self.producer(path)
+                if producer not in self.reruns:
+                    raise FileNotFoundError(path)
+                logging.info(f'Running stage {producer} again, for {path}')
+                self.reruns[producer]()
+
+    def run(self, stage, func, inputs, params, outputs):
+        """
+        Runs func for a stage, unless the checkpoint of the stage is valid.
+        inputs are the input files and directories, and params the settings
+        of the stage that affect its outputs. outputs is a function that
+        returns the output paths of the stage, given the result of func.
+        Returns the result of func.
+        """
+        inputs = [path for path in inputs if path]
+        if self.profile_path:
+            func = partial(profile, func, stage, self.profile_path)
+        if self.metrics:
+            func = partial(self.metrics.measure, stage, func, inputs, outputs)
+        if not self.enabled:
+            return func()
+
+        def run_stage():
+            self.restore_inputs(inputs)
+            with self.lock:
+                key = self.stage_key(stage, inputs, params)
+            result = func()
+            with self.lock:
+                self.state["stages"][stage] = {"key": key,
+                                               "inputs": inputs,
+                                               "outputs": {path: self.digest(path) for path in outputs(result)},
+                                               "result": result}
+                self.save()
+            return result
+
+        with self.lock:
+            self.reruns[stage] = run_stage
+            saved = self.state["stages"].get(stage)
+            valid = (saved is not None and saved["key"] == self.stage_key(stage, inputs, params)
+                     and self.outputs_valid(stage))
+        if valid:
+            logging.info(f'Skipping stage {stage}, its outputs are up to date')
+            if self.metrics:
+                self.metrics.skipped(stage)
+            return saved["result"]
+        return run_stage()
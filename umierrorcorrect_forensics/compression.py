@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Compression of the intermediate FASTQ files of the pipeline.
+
+One setting decides how all intermediate files are compressed:
+gzip - gzip at the default level, as before
+none - no compression, where the tool allows it
+fast - gzip at level 1, with pigz on all threads if it is installed
+bgzf - BGZF with bgzip on all threads, which can also be decompressed
+       on several threads
+
+Compressed files are decompressed by a separate process, with bgzip on
+several threads for BGZF files, else with pigz or gzip.
+"""
+import io
+import shutil
+import subprocess
+from contextlib import contextmanager
+
+COMPRESSION_MODES = ('gzip', 'none', 'fast', 'bgzf')
+
+def check_compression(mode):
+    """Checks that the tools needed for a compression mode are installed."""
+    if mode not in COMPRESSION_MODES:
+        raise ValueError('Unknown compression mode: ' + str(mode))
+    if mode == 'bgzf' and not shutil.which('bgzip'):
+        raise FileNotFoundError('bgzip is needed for BGZF compression')
+
+def fastq_suffix(mode):
+    if mode == 'none':
+        return '.fastq'
+    return '.fastq.gz'
+
+def compress_command(mode, num_threads=1):
+    """Returns the command that compresses stdin to stdout, or None for no compression."""
+    if mode == 'none':
+        return None
+    if mode == 'bgzf':
+        return ['bgzip', '-c', '-@', str(num_threads)]
+    level = ['-1'] if mode == 'fast' else []
+    if shutil.which('pigz'):
+        return ['pigz', '-c', '-p', str(num_threads)] + level
+    return ['gzip', '-c'] + level
+
+def preprocessing_gziptool(mode):
+    """
+    Returns the gziptool for umierrorcorrect preprocessing, which always
+    compresses its output, with gzip or pigz.
+    """
+    if mode != 'gzip' and shutil.which('pigz'):
+        return 'pigz'
+    return 'gzip'
+
+def adapter_removal_options(mode):
+    """AdapterRemoval has no BGZF output, so fast gzip is used instead."""
+    if mode in ('fast', 'bgzf'):
+        return ['--gzip', '--gzip-level', '1']
+    return []
+
+def flash_options(mode, num_threads=1):
+    """FLASH options to compress the output files."""
+    if mode == 'gzip':
+        return ['-z']
+    if mode == 'none':
+        return []
+    command = compress_command(mode, num_threads)
+    # FLASH adds '-c -' to the arguments, and the suffix must come last
+    return ['--compress-prog', command[0],
+            '--compress-prog-args', ' '.join(command[2:]),
+            '--suffix', 'gz']
+
+def is_bgzf(path):
+    """Checks for the BGZF extra field in the first gzip header."""
+    with open(path, 'rb') as fh:
+        header = fh.read(16)
+    return (len(header) == 16 and header[:4] == b'\x1f\x8b\x08\x04'
+            and header[12:14] == b'BC')
+
+def decompress_command(path, num_threads=1):
+    if is_bgzf(path) and shutil.which('bgzip'):
+        return ['bgzip', '-dc', '-@', str(num_threads), path]
+    if shutil.which('pigz'):
+        return ['pigz', '-dc', '-p', str(num_threads), path]
+    return ['gzip', '-dc', path]
+
+@contextmanager
+def decompressed(path, num_threads=1):
+    """
+    Yields a binary file object with the contents of a file, decompressed
+    by a separate process if the file name ends with .gz.
+    """
+    if not path.endswith('.gz'):
+        with open(path, 'rb') as fh:
+            yield fh
+        return
+    process = subprocess.Popen(decompress_command(path, num_threads), stdout=subprocess.PIPE)
+    try:
+        yield process.stdout
+    finally:
+        # Lets the process get SIGPIPE if not all was read
+        process.stdout.close()
+        process.wait()
+    if process.returncode not in (0, -13):
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+@contextmanager
+def decompressed_path(path, num_threads=1):
+    """
+    Yields a path to read the decompressed contents of a file from, for
+    readers that open a file by name.
+    """
+    if not path.endswith('.gz'):
+        yield path
+        return
+    with decompressed(path, num_threads) as fh:
+        yield '/dev/fd/' + str(fh.fileno())
+
+@contextmanager
+def open_fastq(path, mode='rt', compression='none', num_threads=1):
+    """
+    Opens a FASTQ file as text. A .gz file is read through a separate
+    decompression process, and a file is written compressed by a separate
+    process unless compression is 'none'.
+    """
+    if 'r' in mode:
+        with decompressed(path, num_threads) as fh:
+            yield io.TextIOWrapper(fh)
+        return
+    command = compress_command(compression, num_threads)
+    if command is None:
+        with open(path, 'w') as fh:
+            yield fh
+        return
+    with open(path, 'wb') as outfh:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=outfh)
+        try:
+            with io.TextIOWrapper(process.stdin) as fh:
+                yield fh
+        finally:
+            process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
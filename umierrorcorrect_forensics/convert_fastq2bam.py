@@ -6,6 +6,7 @@ import logging
 import argparse
 import tempfile
 import fastq2sam as f2s
+from umierrorcorrect_forensics.profiling import profile_main
 
 def parseArgs():
     parser = argparse.ArgumentParser(description="Runs full FDStools pipeline")
@@ -17,12 +18,28 @@ def parseArgs():
                         help='Path to BED file with genomic positions of markers, required', required=True)
     parser.add_argument("-l", "--Library", dest = "lib",
                         help = "FDStools library file with marker definitions", required=True)
+    parser.add_argument('-t', '--num_threads', dest='num_threads',
+                        help='Number of markers to convert in parallel. Default=%(default)s', default='1')
+    parser.add_argument('--via_sam', dest='via_sam', action='store_true',
+                        help='Write a temporary SAM file and convert and sort it with samtools, instead of writing the BAM file directly.')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Profile the conversion, and write the profile files to a profile directory next to the output file.')
     args = parser.parse_args(sys.argv[1:])
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
     logging.info('Starting convert fastq to bam')
     return(args)
 
-def fastq2bam(infolder, outfile, bed_file, library_file, trim_flanks=True, num_threads=1):
+def fastq2bam(infolder, outfile, bed_file, library_file, trim_flanks=True, num_threads=1, direct=True, flanks=None):
+    """
+    Converts the TSSV per-marker fastq files to a sorted and indexed BAM file.
+    By default the records are written directly to a BAM file, in sorted
+    order since all reads of a marker share one position. With direct=False,
+    a SAM file is written and then converted and sorted with samtools.
+    Flanks already read with fastq2sam.get_flanks_lib can be given, to
+    avoid reading the library file again (direct mode only).
+    """
+    if direct:
+        return fastq2bam_direct(infolder, outfile, bed_file, library_file, trim_flanks, num_threads, flanks)
     [_, samfile] = tempfile.mkstemp(suffix='.sam', text=True)
     chromosomes, pos, fq_dirs = f2s.get_chr_str(bed_file)
     f2s.write_header(samfile, chromosomes)
@@ -45,9 +62,19 @@ def fastq2bam(infolder, outfile, bed_file, library_file, trim_flanks=True, num_t
     logging.info('Indexed BAM file. Fastq to BAM file conversion complete.')
     return outfile
 
+def fastq2bam_direct(infolder, outfile, bed_file, library_file, trim_flanks=True, num_threads=1, flanks=None):
+    chromosomes, pos, fq_dirs = f2s.get_chr_str(bed_file)
+    f2s.loop_fds_result_bam(infolder, outfile, chromosomes, fq_dirs, pos, library_file, trim_flanks, num_threads, flanks)
+    logging.info('Converted fastq to sorted BAM file: ' + infolder + ' to '+ outfile)
+
+    pysam.index(outfile)
+    logging.info('Indexed BAM file. Fastq to BAM file conversion complete.')
+    return outfile
+
 def main(args):
-    fastq2bam(args.infolder, args.outfile, args.bed_file, args.lib)
+    fastq2bam(args.infolder, args.outfile, args.bed_file, args.lib,
+              num_threads=args.num_threads, direct=not args.via_sam)
 
 if __name__ == '__main__':
     args = parseArgs()
-    main(args)
+    profile_main(main, args, args.outfile, "fastq2bam")
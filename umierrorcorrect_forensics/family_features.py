@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Vectorized calculation of the UMI family features used by the ML filter.
+
+The members of all families are flattened once into contiguous arrays
+(family index, member length and member count), and all features are then
+calculated with grouped NumPy reductions. The values are identical to those
+from run_umifilter.get_shorter_longer and run_umifilter.get_stutterprops.
+"""
+import numpy as np
+
+DEFAULT_REPEAT_LENGTH = 4
+
+MEMBER_FEATURES = ["purity", "unpurity", "prop_shorter", "prop_samelength", "prop_longer",
+                   "prop_n_variants", "cons_len", "diff_longer_shorter",
+                   "prop_minus1", "prop_minus2", "prop_plus1"]
+
+def get_repeat_lengths_lib(filename):
+    """
+    Gets the repeat unit length of each marker from the [repeat] section of
+    a FDStools library file. The most common unit length among the repeat
+    blocks of a marker is used, the longest one in case of a tie.
+    """
+    repeat_lengths = {}
+    with open(filename) as fh:
+        found_repeats = False
+        for line in fh:
+            line = line.strip()
+            if line.startswith("["):
+                found_repeats = line.startswith("[repeat]")
+                continue
+            elif line.startswith(";") or line == "" or not found_repeats:
+                continue
+            marker, blocks = line.split("=", 1)
+            units = blocks.split()[0::3]
+            unit_lengths = [len(unit) for unit in units]
+            repeat_lengths[marker.strip()] = max(set(unit_lengths),
+                                                 key=lambda x: (unit_lengths.count(x), x))
+    return repeat_lengths
+
+def flatten_members(members_list):
+    """
+    Flattens a sequence of family member dicts (sequence: count) into arrays
+    of family index, member length and member count.
+    """
+    n_members = np.fromiter((len(members) for members in members_list), dtype=np.int64,
+                            count=len(members_list))
+    total = int(n_members.sum())
+    family_idx = np.repeat(np.arange(len(members_list), dtype=np.int64), n_members)
+    lengths = np.empty(total, dtype=np.int64)
+    counts = np.empty(total, dtype=np.int64)
+    i = 0
+    for members in members_list:
+        for seq, count in members.items():
+            lengths[i] = len(seq)
+            counts[i] = count
+            i += 1
+    return family_idx, lengths, counts
+
+def member_features(family_idx, lengths, counts, cons_len, repeat_length):
+    """
+    Calculates the member derived features for each family. The member arrays
+    must be grouped by family index, in increasing order. cons_len and
+    repeat_length are arrays with one value per family. Returns a dict of
+    feature name and array, in the same order as MEMBER_FEATURES.
+    """
+    n_families = len(cons_len)
+    cons_len = np.asarray(cons_len, dtype=np.int64)
+    repeat_length = np.asarray(repeat_length, dtype=np.int64)
+    weights = counts.astype(np.float64)
+    total_reads = np.bincount(family_idx, weights=weights, minlength=n_families)
+    n_variants = np.bincount(family_idx, minlength=n_families).astype(np.float64)
+
+    # Most and second most common member of each family
+    order = np.lexsort((counts, family_idx))
+    sorted_counts = weights[order]
+    group_end = np.cumsum(np.bincount(family_idx, minlength=n_families)) - 1
+    n_pure = sorted_counts[group_end]
+    n_unpure = np.zeros(n_families, dtype=np.float64)
+    has_second = n_variants > 1
+    n_unpure[has_second] = sorted_counts[group_end[has_second] - 1]
+
+    member_cons_len = cons_len[family_idx]
+    member_repeat = repeat_length[family_idx]
+
+    def grouped_sum(mask):
+        return np.bincount(family_idx[mask], weights=weights[mask], minlength=n_families)
+
+    n_shorter = grouped_sum(lengths < member_cons_len)
+    n_longer = grouped_sum(lengths > member_cons_len)
+    n_samelength = grouped_sum(lengths == member_cons_len)
+    is_minus1 = lengths == member_cons_len - member_repeat
+    is_minus2 = (lengths == member_cons_len - 2*member_repeat) & ~is_minus1
+    is_plus1 = (lengths == member_cons_len + member_repeat) & ~is_minus1 & ~is_minus2
+
+    features = {"purity": n_pure / total_reads,
+                "unpurity": n_unpure / total_reads,
+                "prop_shorter": n_shorter / total_reads,
+                "prop_samelength": n_samelength / total_reads,
+                "prop_longer": n_longer / total_reads,
+                "prop_n_variants": n_variants / total_reads,
+                "cons_len": cons_len.astype(np.float64)}
+    features["diff_longer_shorter"] = features["prop_longer"] - features["prop_shorter"]
+    features["prop_minus1"] = grouped_sum(is_minus1) / total_reads
+    features["prop_minus2"] = grouped_sum(is_minus2) / total_reads
+    features["prop_plus1"] = grouped_sum(is_plus1) / total_reads
+    return features
+
+def marker_repeat_lengths(markers, repeat_lengths=None):
+    """Returns an array with the repeat length of each family's marker."""
+    if repeat_lengths is None:
+        repeat_lengths = {}
+    return np.array([repeat_lengths.get(marker, DEFAULT_REPEAT_LENGTH) for marker in markers],
+                    dtype=np.int64)
@@ -2,12 +2,21 @@
 import argparse
 import sys
 import re
+import os
+import shutil
+import tempfile
+import pysam
+from concurrent.futures import ProcessPoolExecutor
+from umierrorcorrect_forensics.flank_search import compile_flank, search_compiled_flank_trim
+from umierrorcorrect_forensics.metrics import ReadProgress
+from umierrorcorrect_forensics.profiling import profile_main
 def parse_arg():
     parser = argparse.ArgumentParser(description = 'Converts FDStools tssv out put to a single sam format file')
     parser.add_argument("-i", "--infile", dest = "infolder", help = "Folder created by FDStools tssv")
     parser.add_argument("-o", "--outfile", dest = "outfile", help = "SAM file name to write too")
     parser.add_argument("-b", "--bed", dest = "bedfile", help = "BED file to get chromesome and strname from")
     parser.add_argument("-l", "--library", dest = "lib", help = "Library file to get chromesome and strname from")
+    parser.add_argument("--profile", dest = "profile", action = "store_true", help = "Profile the conversion, and write the profile files to a profile directory next to the output file")
     args = parser.parse_args(sys.argv[1:])
     return args
 def rev_comp(seq):
@@ -58,7 +67,9 @@ def levenshtein(s1, s2):
 def search_for_flank_trim(seq, flank, rev_flank,flank_len,flank_rev_len):
     found = False
     """
-    Searches read for either the reverse primer or the forward primer reversed
+    Searches read for either the reverse primer or the forward primer reversed.
+    This is the reference implementation, fq2sam uses the faster
+    flank_search.search_compiled_flank_trim which gives identical results.
     """
     for m in re.finditer(flank, seq):
 
@@ -126,51 +137,118 @@ def loop_fds_result(indir, outfile, chromsomes, fq_dir, pos, lib, trim_flanks=Tr
         fq2sam(f"{indir}/{dire}/paired.fq", outfile, dire, chromsome, pos,
                 flanks[dire][1], rev_comp(flanks[dire][0]), trim_flanks)
 
-def fq2sam(infile, outfile, dir, chrom, pos, flank, flank_rev, trim_flanks):
-### Write fastq seq and phred score to sam file with hardcoded chrom pos and perfect map qual and trims read att positon from search flank
-    with open(infile, "r") as infh, open(outfile, "a") as outfh:
+def trim_fq(infile, dir, flank, flank_rev, trim_flanks):
+### Yields read name, seq and phred score of each read in a tssv fastq file, trimmed att positon from search flank
+    with open(infile, "r") as infh:
         fq_lines = []
         count = 0
         count_2 = 0
-        flank_len = len(flank)
-        flank_rev_len = len(flank_rev)
+        compiled_flank = compile_flank(flank)
+        compiled_flank_rev = compile_flank(flank_rev)
+        progress = ReadProgress(dir)
         for line in infh:
             fq_lines.append(line.rstrip().split()[0])
             if len(fq_lines) == 4:
                 count_2 += 1
+                progress.update()
                 if trim_flanks:
-                    end = search_for_flank_trim(fq_lines[1], flank, flank_rev, flank_len, flank_rev_len)
-                    if end is None:
-                        fq_lines = []
-                        continue
-                    else:
-                        fq_lines[1] = fq_lines[1][:end]
-                        fq_lines[3] = fq_lines[3][:end]
-                        cigar = len(fq_lines[1])
-                        pos_2 = int(pos) + int(cigar)
-                        #print("Length of read after triming ", len(fq_lines[1]))
-                        sam_line = f"{fq_lines[0][1:]}\t0\t{chrom}\t{pos}\t255\t{cigar}M\t*\t0\t0\t{fq_lines[1]}\t{fq_lines[3]}\tUG:Z:{dir}\n"
-                        outfh.write(sam_line)
-                        fq_lines = []
-                        count += 1
-                else:
-                    end = "Starting"
-                    if end is None:
+                    trimmed = trim_read(fq_lines[1], fq_lines[3], compiled_flank, compiled_flank_rev)
+                    if trimmed is None:
                         fq_lines = []
                         continue
-                    else:
-                        fq_lines[1] = fq_lines[1]#[:end]
-                        fq_lines[3] = fq_lines[3]#[:end]
-                        cigar = len(fq_lines[1])
-                        pos_2 = int(pos) + int(cigar)
-                        #print("Length of read after triming ", len(fq_lines[1]))
-                        sam_line = f"{fq_lines[0][1:]}\t0\t{chrom}\t{pos}\t255\t{cigar}M\t*\t0\t0\t{fq_lines[1]}\t{fq_lines[3]}\tUG:Z:{dir}\n"
-                        outfh.write(sam_line)
-                        fq_lines = []
-                        count += 1
-        #print(flank_seq)
+                    fq_lines[1], fq_lines[3] = trimmed
+                yield fq_lines[0][1:], fq_lines[1], fq_lines[3]
+                fq_lines = []
+                count += 1
         print(f"found {count} reads of {count_2} for {dir}")
 
+def trim_read(seq, qual, compiled_flank, compiled_flank_rev):
+### Trims seq and phred score att positon from search flank, None if the flank is not found
+    end = search_compiled_flank_trim(seq, compiled_flank, compiled_flank_rev)
+    if end is None:
+        return None
+    return seq[:end], qual[:end]
+
+def fq2sam(infile, outfile, dir, chrom, pos, flank, flank_rev, trim_flanks):
+### Write fastq seq and phred score to sam file with hardcoded chrom pos and perfect map qual and trims read att positon from search flank
+    with open(outfile, "a") as outfh:
+        for name, seq, qual in trim_fq(infile, dir, flank, flank_rev, trim_flanks):
+            cigar = len(seq)
+            sam_line = f"{name}\t0\t{chrom}\t{pos}\t255\t{cigar}M\t*\t0\t0\t{seq}\t{qual}\tUG:Z:{dir}\n"
+            outfh.write(sam_line)
+
+def make_bam_header(chromsomes):
+### Header of bam file, same contigs and order as write_header
+    dup = []
+    for chrom in chromsomes:
+        if chrom not in dup:
+            dup.append(chrom)
+    return {"HD": {"VN": "1.6", "SO": "coordinate"},
+            "SQ": [{"SN": chrom, "LN": 10} for chrom in dup]}
+
+def sorted_markers(chromsomes, fq_dir, pos):
+### Markers in the order samtools sort would put their reads: header order, then position
+    contig_order = list(dict.fromkeys(chromsomes))
+    markers = list(zip(fq_dir, chromsomes, pos))
+    return sorted(markers, key=lambda m: (contig_order.index(m[1]), int(m[2])))
+
+def loop_fds_result_bam(indir, outfile, chromsomes, fq_dir, pos, lib, trim_flanks=True, num_threads=1, flanks=None):
+### Loop through the fastq files output of tssv and writes them directly into a coordinate sorted bam file
+### With more than one thread, markers are converted in parallel to one bam shard each, which are then concatenated
+### Flanks already read with get_flanks_lib can be given, then lib is not read again
+    if flanks is None:
+        flanks = get_flanks_lib(lib)
+    header = make_bam_header(chromsomes)
+    markers = sorted_markers(chromsomes, fq_dir, pos)
+    num_threads = min(int(num_threads), len(markers))
+    if num_threads <= 1:
+        with pysam.AlignmentFile(outfile, "wb", header=header) as outfh:
+            for dire, chromsome, pos in markers:
+                fq2bam(f"{indir}/{dire}/paired.fq", outfh, dire, chromsome, pos,
+                       flanks[dire][1], rev_comp(flanks[dire][0]), trim_flanks)
+        return
+
+    shard_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    jobs = []
+    for dire, chromsome, pos in markers:
+        shard = os.path.join(shard_dir, dire + ".bam")
+        jobs.append((f"{indir}/{dire}/paired.fq", shard, header, dire, chromsome, pos,
+                     flanks[dire][1], rev_comp(flanks[dire][0]), trim_flanks))
+    try:
+        with ProcessPoolExecutor(max_workers=num_threads) as executor:
+            shards = list(executor.map(fq2bam_shard, jobs))
+        pysam.cat("--no-PG", "-o", outfile, *shards, catch_stdout=False)
+    finally:
+        shutil.rmtree(shard_dir)
+
+def fq2bam_shard(job):
+### Write the reads of one marker to its own bam file, run in a worker process
+    infile, shard, header, dire, chromsome, pos, flank, flank_rev, trim_flanks = job
+    with pysam.AlignmentFile(shard, "wb", header=header) as outfh:
+        fq2bam(infile, outfh, dire, chromsome, pos, flank, flank_rev, trim_flanks)
+    return shard
+
+def fq2bam(infile, outfh, dir, chrom, pos, flank, flank_rev, trim_flanks):
+### Write fastq seq and phred score as records to an open bam file, same fields as fq2sam
+    reference_id = outfh.get_tid(chrom)
+    reference_start = int(pos) - 1
+    for name, seq, qual in trim_fq(infile, dir, flank, flank_rev, trim_flanks):
+        outfh.write(make_bam_record(outfh.header, reference_id, reference_start, name, seq, qual, dir))
+
+def make_bam_record(header, reference_id, reference_start, name, seq, qual, dir):
+### Bam record of a read with hardcoded position and perfect map qual, tagged with its marker
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.flag = 0
+    read.reference_id = reference_id
+    read.reference_start = reference_start
+    read.mapping_quality = 255
+    read.cigartuples = [(0, len(seq))]
+    read.query_sequence = seq
+    read.query_qualities = pysam.qualitystring_to_array(qual)
+    read.set_tag("UG", dir, value_type="Z")
+    return read
+
 def main(args):
    chromsomes, pos, fq_dirs = get_chr_str(args.bedfile)
    write_header(args.outfile, chromsomes)
@@ -178,4 +256,4 @@ def main(args):
 
 if __name__ == "__main__":
     args = parse_arg()
-    main(args)
+    profile_main(main, args, args.outfile, "fastq2sam")
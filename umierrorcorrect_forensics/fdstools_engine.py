@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+In-process FDStools case-sample pipeline and stuttermark.
+
+fdstools pipeline runs TSSV, Seqconvert, Samplestats and Vis as separate
+processes, and run_fdstools then runs fdstools stuttermark in another. Each
+of them imports FDStools and parses the library file again, for each sample
+and again for the uncollapsed reads. Here, the ini file is compiled once to
+the arguments of each tool, and the library file is parsed once, by
+load_fdstools, and the tools are run in-process with them. The output of
+TSSV and Seqconvert is passed on in temp files instead of pipes. The output
+files are the same as from fdstools pipeline and fdstools stuttermark.
+
+The compiled ini files are cached per process, so samples of a batch that
+run in forked processes share the library parsed before the fork. Only
+case-sample analyses without a stutter model or background profiles can
+run in-process.
+
+The uncollapsed reads are analysed without writing them out: instead of a
+FASTQ file with each consensus read repeated as many times as the size of
+its family (see tools/uncollapse_reads.py), TSSV reads the consensus FASTQ
+file and counts each read by its family size, from the Count=<size> at the
+end of its name (see WeightedTSSV). The output files are the same as from
+the uncollapsed FASTQ file.
+"""
+import argparse
+import sys
+import os
+import logging
+import importlib
+import tempfile
+import threading
+from fdstools.lib.cli import DEF_TAG_EXPR, DEF_TAG_FORMAT, get_tag, regex_arg, library_arg
+from fdstools.lib.io import parse_reads, std_or_open, write_sequence_record
+from fdstools.tools.pipeline import (read_ini, get_argv, get_arguments, ini_require_option,
+                                     ini_try_get_option)
+from fdstools.tools.tssv import TSSV, open_outdir, update_qualities
+
+PIPELINE_TOOLS = ("tssv", "seqconvert", "samplestats", "vis")
+# Stand-ins for the files of a sample in the compiled arguments
+SAMPLE_FILES = ("{sample}", "{tssv}", "{seqconvert}", "{report}", "{csv}", "{html}", "{title}", "{library}")
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Runs the FDStools case-sample pipeline and stuttermark in-process")
+    parser.add_argument('-f', '--fastq', dest='fastq_file',
+                        help='Path to FASTQ file, required', required=True)
+    parser.add_argument('-i', '--ini', dest='ini_file',
+                        help='Path to first FDStools ini file, required', required=True)
+    parser.add_argument('-l', '--library', dest='library_file',
+                        help='Path to the Library file for TSSV, Required', required=True)
+    parser.add_argument('-o', '--output_path', dest='output_path',
+                        help='Path to the output directory')
+    args = parser.parse_args(sys.argv[1:])
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
+    return(args)
+
+def tool_parser(name):
+    """
+    Returns the module and argument parser of an FDStools tool. The library
+    arguments are left unparsed, as the library is parsed once by FDStools.
+    """
+    module = importlib.import_module("fdstools.tools." + name)
+    parser = argparse.ArgumentParser(prog="fdstools " + name)
+    module.add_arguments(parser)
+    parser.set_defaults(tool=name)
+    for action in parser._actions:
+        if action.dest in ("library", "library2"):
+            action.type = None
+    return module, parser
+
+def pipeline_config(ini_file):
+    """
+    Reads the ini file and sets the input and output files of the tools as
+    fdstools pipeline does for a case-sample analysis, with SAMPLE_FILES
+    in place of the files of a sample.
+    """
+    with open(ini_file, "rt", encoding="utf-8") as fh:
+        config = read_ini(fh)
+    if ini_require_option(config, "pipeline", "analysis") != "case-sample":
+        raise ValueError("Only case-sample analyses can be run in-process")
+    if (ini_try_get_option(config, "pipeline", "in-stuttermodel") is not None or
+            ini_try_get_option(config, "pipeline", "in-bgprofiles") is not None):
+        raise ValueError("Analyses with a stutter model or background profiles cannot be run in-process")
+    sample, tssv, seqconvert, report, csv, html, title, library = SAMPLE_FILES
+    for name in PIPELINE_TOOLS:
+        if not config.has_section(name):
+            config.add_section(name)
+        for option in ("infiles", "outfiles"):
+            config.remove_option(name, option)
+    # The TSSV output directory is set for each run, see FDStools.run
+    config.remove_option("tssv", "dir")
+    config.set("tssv", "library", library)
+    config.set("tssv", "infile", sample)
+    config.set("tssv", "outfile", tssv)
+    config.set("tssv", "report", report)
+    if not config.has_option("seqconvert", "sequence-format"):
+        config.set("seqconvert", "sequence-format", "allelename")
+    config.set("seqconvert", "infile", tssv)
+    config.set("seqconvert", "outfile", seqconvert)
+    config.set("seqconvert", "library", library)
+    config.set("seqconvert", "marker-column", "marker")
+    config.set("seqconvert", "allele-column", "sequence")
+    config.set("samplestats", "infile", seqconvert)
+    config.set("samplestats", "outfile", csv)
+    config.set("vis", "type", "sample")
+    config.set("vis", "infile", seqconvert)
+    config.set("vis", "outfile", html)
+    if not config.has_option("vis", "title"):
+        config.set("vis", "title", title)
+    return config
+
+def tool_argv(name, arg_defs, config):
+    """The arguments fdstools pipeline gives a tool, without "fdstools <tool> [-d]"."""
+    argv = get_argv(name, arg_defs, config)[2:]
+    return argv[1:] if argv[:1] == ["-d"] else argv
+
+def family_size(header):
+    """The name of the uncollapsed reads of a consensus read, and its family size, as uncollapse_reads."""
+    name, size = header.split("=")[:2]
+    return name, int(size)
+
+class WeightedTSSV(TSSV):
+    """
+    TSSV that counts each consensus read as many times as the size of its
+    family, as if it were repeated in the input as by uncollapse_reads.
+    """
+    def process_results(self, record, results):
+        name, weight = family_size(record[0])
+        record = (name,) + tuple(record[1:])
+        self.total_reads += weight
+        recognised = 0
+        for marker, matches, start_end_seq1, start_end_seq2, ambiguous in results:
+            recognised |= matches
+            sequences = self.ambiguous_sequences[marker] if ambiguous else self.sequences[marker]
+            counters = self.counters[marker]
+            if matches & 0b0001:
+                counters["fLeft"] += weight
+            if matches & 0b0010:
+                counters["fRight"] += weight
+            if matches & 0b0100:
+                counters["rLeft"] += weight
+            if matches & 0b1000:
+                counters["rRight"] += weight
+            for strand, start_end_seq, noend, nostart in ((0, start_end_seq1, 0b0001, 0b0010),
+                                                          (1, start_end_seq2, 0b0100, 0b1000)):
+                if start_end_seq is not None:
+                    start, end, seq = start_end_seq
+                    counters["rPaired" if strand else "fPaired"] += weight
+                    sequences[seq][strand] += weight
+                    if self.output_qualities:
+                        qual = record[2][start:end]
+                        for _ in range(weight):
+                            update_qualities(sequences[seq][2], qual[::-1] if strand else qual)
+                    if self.outfiles:
+                        self.write_records(self.outfiles["markers"][marker]["paired"], record, weight)
+                elif self.outfiles:
+                    if matches & noend:
+                        self.write_records(self.outfiles["markers"][marker]["noend"], record, weight)
+                    if matches & nostart:
+                        self.write_records(self.outfiles["markers"][marker]["nostart"], record, weight)
+        if not recognised:
+            self.unrecognised += weight
+            if self.outfiles:
+                self.write_records(self.outfiles["unknown"], record, weight)
+
+    @staticmethod
+    def write_records(outfile, record, weight):
+        for _ in range(weight):
+            write_sequence_record(outfile, record)
+
+def run_weighted_tssv(args):
+    """Runs TSSV as fdstools tssv does, with each consensus read counted by its family size."""
+    with parse_reads(args.infile) as (file_format, reads), \
+         std_or_open(args.outfile, "wt") as outfile, \
+         std_or_open(args.report, "wt") as reportfile, \
+         open_outdir(args.dir, args.library.get_ranges(), file_format, args.zip_level) as outdir:
+        if (args.output_qualities or args.distrust_base_quality) and ".fq" not in file_format:
+            raise ValueError(f"Basecall quality values are not available in {file_format} input file")
+        tssv = WeightedTSSV(reads, args.library, args.flank_length, args.mismatches, args.resolve_ambiguous,
+                            args.output_qualities, args.distrust_base_quality, args.indel_score, outdir,
+                            args.num_threads, args.deduplicate)
+        tssv.process_file(args.resolve_ambiguous)
+        tssv.filter_sequences(args.aggregate_filtered, args.minimum, args.missing_marker_action)
+        tssv.write_sequence_tables(outfile, args.sequence_format)
+        tssv.write_statistics_table(reportfile)
+
+class FDStools:
+    """
+    The FDStools tools with the arguments compiled from an ini file, and the
+    parsed library file.
+    """
+    def __init__(self, ini_file, library_file):
+        self.library_file = library_file
+        config = pipeline_config(ini_file)
+        self.tag_expr = regex_arg(ini_try_get_option(config, "pipeline", "tag-expr", DEF_TAG_EXPR))
+        self.tag_format = ini_try_get_option(config, "pipeline", "tag-format", DEF_TAG_FORMAT)
+        self.tools = {name: tool_parser(name) for name in PIPELINE_TOOLS + ("stuttermark",)}
+        arg_defs = get_arguments({name: self.tools[name][0] for name in PIPELINE_TOOLS})
+        self.argv = {name: tool_argv(name, arg_defs, config) for name in PIPELINE_TOOLS}
+        self.library = library_arg(library_file)
+
+    def tool_args(self, name, argv, files=None):
+        """Parses the arguments of a tool, with the files of a sample in place of SAMPLE_FILES."""
+        if files:
+            argv = [files.get(arg, arg) for arg in argv]
+        args = self.tools[name][1].parse_args(argv)
+        if getattr(args, "library", None) is not None:
+            args.library = self.library
+        return args
+
+    def run_tool(self, name, argv, files=None, run=None):
+        """
+        Runs a tool, or run with its arguments. As fdstools pipeline does not
+        check the exit status of its tools, nor run_fdstools that of
+        stuttermark, errors are logged and the next tool is run.
+        """
+        run = run or self.tools[name][0].run
+        try:
+            run(self.tool_args(name, argv, files))
+        except (Exception, SystemExit) as e:
+            logging.error(f'FDStools {name} failed: {type(e).__name__}: {e}')
+
+    def run(self, fastq_file, output_path, verbose=True, uncollapsed_file=None, num_threads=None):
+        """
+        Runs the case-sample pipeline on a FASTQ file, as fdstools pipeline
+        with the ini file. With verbose, TSSV writes its output directory to
+        fdstools_output in output_path. With uncollapsed_file, the consensus
+        reads of fastq_file are counted by their family size, and the output
+        files are named as for uncollapsed_file, which is not written. With
+        num_threads, TSSV uses that many threads instead of those of the ini file.
+        """
+        tag = get_tag(uncollapsed_file or fastq_file, self.tag_expr, self.tag_format)
+        with tempfile.TemporaryDirectory(dir=output_path, prefix=".fdstools") as tmp_dir:
+            files = dict(zip(SAMPLE_FILES,
+                             (fastq_file, os.path.join(tmp_dir, "tssv.csv"), os.path.join(tmp_dir, "seqconvert.csv"),
+                              tag + "-stats.txt", tag + ".csv", tag + ".html", tag, self.library_file)))
+            tssv_argv = self.argv["tssv"]
+            if verbose:
+                tssv_argv = ["--dir", os.path.join(output_path, 'fdstools_output')] + tssv_argv
+            if num_threads is not None:
+                tssv_argv = tssv_argv + ["--num-threads", str(num_threads)]
+            self.run_tool("tssv", tssv_argv, files, run_weighted_tssv if uncollapsed_file else None)
+            for name in PIPELINE_TOOLS[1:]:
+                self.run_tool(name, self.argv[name], files)
+        return tag + ".csv"
+
+    def stuttermark(self, infile, outfile):
+        """Runs stuttermark with its default settings, as fdstools stuttermark -i infile -o outfile -l library."""
+        self.run_tool("stuttermark", ["-i", infile, "-o", outfile, "-l", self.library_file])
+        return outfile
+
+def load_fdstools(ini_file, library_file):
+    """Returns the FDStools of an ini file and a library file, compiled once per process."""
+    key = tuple((os.path.abspath(path), os.stat(path).st_mtime_ns) for path in (ini_file, library_file))
+    with _loaded_lock:
+        if key not in _loaded:
+            _loaded[key] = FDStools(ini_file, library_file)
+        return _loaded[key]
+
+def main(args):
+    fdstools = load_fdstools(args.ini_file, args.library_file)
+    infile = fdstools.run(args.fastq_file, args.output_path)
+    fdstools.stuttermark(infile, os.path.splitext(args.fastq_file)[0] + '_stutter.csv')
+
+if __name__ == '__main__':
+    args = parseArgs()
+    main(args)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Approximate flank search used when trimming reads in fastq2sam.
+
+The reference implementation (fastq2sam.search_for_flank_trim) slides a
+window backwards over the read and computes a full Levenshtein distance for
+every window. Here, a bit-parallel pass (Myers' algorithm) first finds all
+read positions where the flank can end with at most max_dist edits. Only
+those candidate windows are then verified with a banded edit distance, so
+the trim positions are identical to the reference implementation.
+"""
+import re
+
+def compile_flank(flank, max_dist=2):
+    """
+    Precompiles a flank sequence for repeated searches. Returns a dict with
+    the exact match regex, the Myers match bit masks and the flank length.
+    """
+    peq = {}
+    for i, base in enumerate(flank):
+        peq[base] = peq.get(base, 0) | (1 << i)
+    return {"flank": flank,
+            "regex": re.compile(flank),
+            "peq": peq,
+            "length": len(flank),
+            "max_dist": max_dist}
+
+def myers_end_distances(seq, compiled_flank):
+    """
+    Returns a list where position e holds the lowest edit distance between
+    the flank and any substring of seq ending before position e.
+    """
+    peq = compiled_flank["peq"]
+    m = compiled_flank["length"]
+    mask = (1 << m) - 1
+    high_bit = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+    scores = [score]
+    for base in seq:
+        eq = peq.get(base, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high_bit:
+            score += 1
+        elif mh & high_bit:
+            score -= 1
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        scores.append(score)
+    return scores
+
+def banded_distance(s1, s2, max_dist):
+    """
+    Levenshtein distance between s1 and s2 restricted to a diagonal band of
+    width max_dist. Returns max_dist+1 as soon as the distance is known to
+    exceed max_dist.
+    """
+    n1 = len(s1)
+    n2 = len(s2)
+    if abs(n1 - n2) > max_dist:
+        return max_dist + 1
+    over = max_dist + 1
+    previous_row = [j if j <= max_dist else over for j in range(n2 + 1)]
+    for i in range(1, n1 + 1):
+        lo = max(1, i - max_dist)
+        hi = min(n2, i + max_dist)
+        current_row = [over] * (n2 + 1)
+        if i <= max_dist:
+            current_row[0] = i
+        c1 = s1[i - 1]
+        row_min = current_row[0]
+        for j in range(lo, hi + 1):
+            value = min(previous_row[j] + 1,
+                        current_row[j - 1] + 1,
+                        previous_row[j - 1] + (c1 != s2[j - 1]))
+            if value > over:
+                value = over
+            current_row[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_dist:
+            return over
+        previous_row = current_row
+    return previous_row[n2]
+
+def search_compiled_flank_trim(seq, compiled_flank, compiled_rev_flank):
+    """
+    Searches read for either the reverse primer or the forward primer
+    reversed. Gives the same trim positions as
+    fastq2sam.search_for_flank_trim, but with precompiled flanks.
+    """
+    m = compiled_flank["regex"].search(seq)
+    if m:
+        return m.end()
+    m = compiled_rev_flank["regex"].search(seq)
+    if m:
+        return m.end()
+
+    seq_len = len(seq)
+    flank = compiled_flank["flank"]
+    rev_flank = compiled_rev_flank["flank"]
+    flank_len = compiled_flank["length"]
+    flank_rev_len = compiled_rev_flank["length"]
+    max_dist = compiled_flank["max_dist"]
+    max_rev_dist = compiled_rev_flank["max_dist"]
+    ends = myers_end_distances(seq, compiled_flank)
+    ends_rev = myers_end_distances(seq, compiled_rev_flank)
+
+    # Same window order as the reference: the window ends at seq_len+base,
+    # for base = -1, -2, ... Windows past the read start are empty.
+    for base in range(-1, -seq_len - flank_len, -1):
+        end = seq_len + base
+        if end > 0:
+            if ends[end] <= max_dist:
+                subseq = seq[max(0, end - flank_len):end]
+                if banded_distance(subseq, flank, max_dist) <= max_dist:
+                    return base
+            if ends_rev[end] <= max_rev_dist:
+                subseq_rev = seq[max(0, end - flank_rev_len):end]
+                if banded_distance(subseq_rev, rev_flank, max_rev_dist) <= max_rev_dist:
+                    return base
+        elif flank_len <= max_dist or flank_rev_len <= max_rev_dist:
+            return base
+    return None
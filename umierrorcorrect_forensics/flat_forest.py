@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Flattened random-forest models for the ML filter.
+
+export_model converts a Scikit-learn forest model, or a dict of per-marker
+models and [model, k, m] length correction lists, into plain NumPy node
+arrays (feature, threshold, children and leaf class probabilities). The
+supported models are forests or decision trees, either alone or as the final
+step of a pipeline whose first step is a sklearn-pandas DataFrameMapper that
+selects columns without transforming them, optionally wrapped in a
+CalibratedClassifierCV with isotonic or sigmoid calibration. Other models
+raise UnsupportedModelError.
+
+The exported file is an uncompressed .npz file, which is read with NumPy only.
+The flattened models are evaluated for a whole batch of UMI families at once,
+so scoring does not need to import Scikit-learn.
+"""
+import argparse
+import sys
+import os
+import json
+import logging
+import numpy as np
+
+FLAT_SUFFIX = ".flat.npz"
+FLAT_VERSION = 1
+BATCH_SIZE = 10000
+
+class UnsupportedModelError(ValueError):
+    pass
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Exports a random-forest filter model to flattened NumPy arrays.")
+    parser.add_argument('-m', '--model_path', dest='model_path',
+                        help='Path to a pickle (or .xz) file with a Scikit-learn model.', required=True)
+    parser.add_argument('-o', '--output_path', dest='output_path',
+                        help='Path to write the flattened model to, should end with ' + FLAT_SUFFIX, required=True)
+    parser.add_argument('-j', '--json_path', dest='json_path',
+                        help='UMI families JSON file or family store to check the exported model on. Random features are used if unset.')
+    args = parser.parse_args(sys.argv[1:])
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
+    return(args)
+
+def is_flat_model(path):
+    return path.endswith(FLAT_SUFFIX)
+
+class FlatModel:
+    """
+    A flattened model, with the same predict_proba interface as the
+    Scikit-learn model it was exported from. The prediction is the mean over
+    its members, each a forest with an optional calibrator.
+    """
+    def __init__(self, features, n_classes, members, arrays):
+        self.features = features
+        self.n_classes = n_classes
+        self.members = members
+        self.arrays = arrays
+
+    def predict_proba(self, df):
+        X = df[self.features].to_numpy(dtype=np.float64).astype(np.float32)
+        proba = np.zeros((len(X), self.n_classes))
+        for start in range(0, len(X), BATCH_SIZE):
+            batch = X[start:start + BATCH_SIZE]
+            for member in self.members:
+                proba[start:start + BATCH_SIZE] += self.member_proba(member, batch)
+        return proba / len(self.members)
+
+    def member_proba(self, member, X):
+        forest_proba = forest_predict_proba(self.arrays, member["forest"], X)
+        calibrator = member["calibrator"]
+        if calibrator is None:
+            return forest_proba
+        if calibrator["method"] == "isotonic":
+            T = np.clip(forest_proba[:, 1], calibrator["x_min"], calibrator["x_max"])
+            positive = np.interp(T, self.arrays[calibrator["x"]], self.arrays[calibrator["y"]])
+        else:
+            positive = 1.0 / (1.0 + np.exp(calibrator["a"] * forest_proba[:, 1] + calibrator["b"]))
+        proba = np.empty((len(X), 2))
+        proba[:, 1] = positive
+        proba[:, 0] = 1.0 - positive
+        proba[(1.0 < proba) & (proba <= 1.0 + 1e-5)] = 1.0
+        return proba
+
+def forest_predict_proba(arrays, prefix, X):
+    """
+    Evaluates all trees of a flattened forest on all rows of X at once and
+    returns the average of the trees' class probabilities. Leaves point to
+    themselves, so every row and tree takes max_depth steps.
+    """
+    feature = arrays[prefix + "/feature"]
+    threshold = arrays[prefix + "/threshold"]
+    children = arrays[prefix + "/children"]
+    value = arrays[prefix + "/value"]
+    roots = arrays[prefix + "/roots"]
+    n_rows, n_features = X.shape
+    X_flat = X.ravel()
+    row_start = np.repeat(np.arange(n_rows, dtype=np.int64) * n_features, len(roots))
+    node = np.tile(roots, n_rows)
+    for _ in range(int(arrays[prefix + "/max_depth"])):
+        # Same comparison as Scikit-learn, NaN values go right
+        goes_right = ~(X_flat[row_start + feature[node]] <= threshold[node])
+        node = children[node, goes_right.view(np.int8)]
+    return value[node].reshape(n_rows, len(roots), -1).sum(axis=1) / len(roots)
+
+def flatten_forest(estimators, prefix, arrays):
+    """Adds the node arrays of a list of decision trees to arrays, with global node indices."""
+    features, thresholds, children, values, roots = [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    for estimator in estimators:
+        tree = estimator.tree_
+        if tree.n_outputs != 1:
+            raise UnsupportedModelError("Only single output trees are supported.")
+        is_leaf = tree.children_left < 0
+        nodes = np.arange(tree.node_count) + offset
+        features.append(np.where(is_leaf, 0, tree.feature).astype(np.int64))
+        thresholds.append(tree.threshold.astype(np.float64))
+        children.append(np.stack([np.where(is_leaf, nodes, tree.children_left + offset),
+                                  np.where(is_leaf, nodes, tree.children_right + offset)], axis=1))
+        value = tree.value[:, 0, :].astype(np.float64)
+        normalizer = value.sum(axis=1)
+        normalizer[normalizer == 0.0] = 1.0
+        values.append(value / normalizer[:, np.newaxis])
+        roots.append(offset)
+        offset += tree.node_count
+        max_depth = max(max_depth, tree.max_depth)
+    arrays[prefix + "/feature"] = np.concatenate(features)
+    arrays[prefix + "/threshold"] = np.concatenate(thresholds)
+    arrays[prefix + "/children"] = np.concatenate(children).astype(np.int64)
+    arrays[prefix + "/value"] = np.concatenate(values)
+    arrays[prefix + "/roots"] = np.array(roots, dtype=np.int64)
+    arrays[prefix + "/max_depth"] = np.array(max_depth)
+
+def split_pipeline(model):
+    """Returns the input column names and the final tree or forest estimator of a model."""
+    steps = [step for _, step in model.steps] if hasattr(model, "steps") else [model]
+    final = steps[-1]
+    if hasattr(final, "estimators_"):
+        estimators = list(final.estimators_)
+    elif hasattr(final, "tree_"):
+        estimators = [final]
+    else:
+        raise UnsupportedModelError(f"Final estimator {type(final).__name__} is not a tree or forest.")
+    if len(final.classes_) != 2:
+        raise UnsupportedModelError("Only two-class models are supported.")
+
+    if len(steps) == 1:
+        if not hasattr(final, "feature_names_in_"):
+            raise UnsupportedModelError("Model was not fitted on a DataFrame, so its input columns are unknown.")
+        return list(final.feature_names_in_), estimators
+    mapper = steps[0]
+    if not hasattr(mapper, "features") or getattr(mapper, "default", False) is not False:
+        raise UnsupportedModelError("First pipeline step must be a DataFrameMapper without default transformer.")
+    columns = []
+    for selection, transformer, *_ in mapper.features:
+        if transformer is not None:
+            raise UnsupportedModelError(f"Transformed input column {selection} is not supported.")
+        columns.extend(selection if isinstance(selection, list) else [selection])
+    for step in steps[1:-1]:
+        # Samplers (imbalanced-learn) are only applied during fitting
+        if not hasattr(step, "fit_resample"):
+            raise UnsupportedModelError(f"Pipeline step {type(step).__name__} is not supported.")
+    return columns, estimators
+
+def flatten_component(model, prefix, arrays):
+    """Flattens one (optionally calibrated) model and returns its description."""
+    members = []
+    if hasattr(model, "calibrated_classifiers_"):
+        for i, calibrated in enumerate(model.calibrated_classifiers_):
+            # Renamed from base_estimator to estimator in Scikit-learn 1.2
+            base = getattr(calibrated, "estimator", None) or getattr(calibrated, "base_estimator", None)
+            if base is None:
+                raise UnsupportedModelError("Calibrated classifier without an estimator is not supported.")
+            if hasattr(base, "decision_function"):
+                raise UnsupportedModelError("Calibration on decision_function is not supported.")
+            columns, estimators = split_pipeline(base)
+            if len(calibrated.calibrators) != 1:
+                raise UnsupportedModelError("Only two-class calibration is supported.")
+            calibrator = calibrated.calibrators[0]
+            member_prefix = f"{prefix}/{i}"
+            if hasattr(calibrator, "X_thresholds_"):
+                if calibrator.out_of_bounds != "clip":
+                    raise UnsupportedModelError("Isotonic calibration must use out_of_bounds='clip'.")
+                arrays[member_prefix + "/iso_x"] = calibrator.X_thresholds_.astype(np.float64)
+                arrays[member_prefix + "/iso_y"] = calibrator.y_thresholds_.astype(np.float64)
+                calibrator_desc = {"method": "isotonic",
+                                   "x": member_prefix + "/iso_x",
+                                   "y": member_prefix + "/iso_y",
+                                   "x_min": float(calibrator.X_min_),
+                                   "x_max": float(calibrator.X_max_)}
+            else:
+                calibrator_desc = {"method": "sigmoid",
+                                   "a": float(calibrator.a_),
+                                   "b": float(calibrator.b_)}
+            flatten_forest(estimators, member_prefix, arrays)
+            members.append({"forest": member_prefix, "calibrator": calibrator_desc})
+    else:
+        columns, estimators = split_pipeline(model)
+        flatten_forest(estimators, prefix + "/0", arrays)
+        members.append({"forest": prefix + "/0", "calibrator": None})
+    return {"features": columns, "n_classes": 2, "members": members}
+
+def export_model(model, output_path):
+    """
+    Writes a model, or dict of per-marker models, as a flattened model file.
+    Raises UnsupportedModelError if any of the models can not be flattened.
+    """
+    arrays = {}
+    if isinstance(model, dict):
+        structure = {"version": FLAT_VERSION, "kind": "dict", "models": {}}
+        for marker, marker_model in model.items():
+            if isinstance(marker_model, list):
+                component = flatten_component(marker_model[0], marker, arrays)
+                adjustment = [float(marker_model[1]), float(marker_model[2])]
+            else:
+                component = flatten_component(marker_model, marker, arrays)
+                adjustment = None
+            structure["models"][marker] = {"model": component, "adjustment": adjustment}
+    else:
+        structure = {"version": FLAT_VERSION, "kind": "single",
+                     "model": flatten_component(model, "model", arrays)}
+    arrays["structure"] = np.array(json.dumps(structure))
+    with open(output_path, "wb") as f:
+        np.savez(f, **arrays)
+    return output_path
+
+def load_flat_model(path):
+    """
+    Reads a flattened model file. Returns an object with a predict_proba
+    method, or a dict of those and [model, k, m] lists, like the original.
+    """
+    with np.load(path) as npz:
+        arrays = {key: npz[key] for key in npz.files}
+    structure = json.loads(str(arrays.pop("structure")))
+    if structure["version"] != FLAT_VERSION:
+        raise ValueError(f"Flattened model {path} has version {structure['version']}, expected {FLAT_VERSION}.")
+
+    def make_model(component):
+        return FlatModel(component["features"], component["n_classes"], component["members"], arrays)
+
+    if structure["kind"] == "single":
+        return make_model(structure["model"])
+    model = {}
+    for marker, entry in structure["models"].items():
+        if entry["adjustment"] is None:
+            model[marker] = make_model(entry["model"])
+        else:
+            model[marker] = [make_model(entry["model"])] + entry["adjustment"]
+    return model
+
+def random_features(n=5000, seed=1):
+    """A DataFrame with random values of all model features, for checking exported models."""
+    import pandas as pd
+    from umierrorcorrect_forensics.family_features import MEMBER_FEATURES
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({name: rng.random(n) for name in MEMBER_FEATURES})
+    df["total_count"] = rng.integers(1, 200, n)
+    df["normalized_count"] = df["total_count"] / df["total_count"].mean()
+    df["cons_len"] = rng.integers(60, 200, n).astype(float)
+    df["diff_longer_shorter"] = df["prop_longer"] - df["prop_shorter"]
+    return df
+
+def max_difference(model, flat_model, df):
+    """Largest absolute difference between the probabilities of two models on df."""
+    if isinstance(model, dict):
+        difference = 0.0
+        for marker in model:
+            original = model[marker][0] if isinstance(model[marker], list) else model[marker]
+            flat = flat_model[marker][0] if isinstance(flat_model[marker], list) else flat_model[marker]
+            difference = max(difference,
+                             np.abs(original.predict_proba(df) - flat.predict_proba(df)).max())
+        return difference
+    return np.abs(model.predict_proba(df) - flat_model.predict_proba(df)).max()
+
+def export_and_check(model, output_path, df=None, tolerance=1e-9):
+    """
+    Exports a model and checks that the flattened model gives the same
+    probabilities within tolerance, on df or on random features.
+    """
+    export_model(model, output_path)
+    if df is None:
+        df = random_features()
+    difference = max_difference(model, load_flat_model(output_path), df)
+    if difference > tolerance:
+        os.remove(output_path)
+        raise UnsupportedModelError(f"Flattened model differs by {difference} from the original model.")
+    logging.info(f"Exported flattened model {output_path}, max probability difference {difference}.")
+    return output_path
+
+def main(args):
+    from umierrorcorrect_forensics.model_cache import load_pickled_model
+    model = load_pickled_model(args.model_path)
+    df = None
+    if args.json_path:
+        import run_umifilter
+        import pandas as pd
+        from umierrorcorrect_forensics.family_store import is_family_store
+        if is_family_store(args.json_path):
+            df = pd.concat(run_umifilter.read_store_chunks(args.json_path), ignore_index=True)
+        else:
+            df = run_umifilter.calc_features(run_umifilter.read_json(args.json_path))
+    export_and_check(model, args.output_path, df)
+
+if __name__ == '__main__':
+    args = parseArgs()
+    main(args)
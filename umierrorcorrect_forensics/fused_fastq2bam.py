@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Fused conversion of a preprocessed FASTQ file to a marker-assigned BAM file.
+
+The reference path runs FDStools TSSV, which writes the reads of each marker
+to a paired.fq file, and then fastq2sam, which reads those files again, trims
+the reads at the flanks and writes them to a BAM file. Here, the FASTQ file
+(optionally gzipped) is read once. Each read is linked to markers by the TSSV
+engine of FDStools, run in-process by tssv_engine, and is then trimmed and
+written as a BAM record right away, with no intermediate FASTQ or SAM files. The TSSV
+statistics.csv and sequences.csv files are still written to the TSSV output
+directory, and the BAM records are the same as from the reference path.
+"""
+import argparse
+import sys
+import os
+import shutil
+import tempfile
+import logging
+import pysam
+from fdstools.lib.io import parse_reads
+from umierrorcorrect_forensics import fastq2sam as f2s
+from umierrorcorrect_forensics.compression import decompressed_path
+from umierrorcorrect_forensics.tssv_engine import InProcessTSSV, make_tssv, read_library, write_tssv_tables
+from umierrorcorrect_forensics.flank_search import compile_flank
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Links preprocessed reads to markers and writes them to a BAM file in one pass.")
+    parser.add_argument('-r1', '--read1', dest='read1',
+                        help='Path to the preprocessed FASTQ file, required', required=True)
+    parser.add_argument('-o', '--output_file', dest='outfile',
+                        help='BAM file to write to, required', required=True)
+    parser.add_argument('-s', '--stats_path', dest='stats_path',
+                        help='Directory to write the TSSV statistics.csv and sequences.csv files to, required', required=True)
+    parser.add_argument('-b', '--bed', dest='bed_file',
+                        help='Path to BED file with genomic positions of markers, required', required=True)
+    parser.add_argument('-l', '--library', dest='library_file',
+                        help='FDStools library file with marker definitions, required', required=True)
+    parser.add_argument('-t', '--num_threads', dest='num_threads',
+                        help='Number of threads to run TSSV on. Default=%(default)s', default='1')
+    parser.add_argument('--no_trim', dest='trim_flanks', action='store_false',
+                        help='Do not trim the reads at the flanks.')
+    args = parser.parse_args(sys.argv[1:])
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
+    return(args)
+
+class MarkerBamTSSV(InProcessTSSV):
+    """
+    In-process TSSV that writes the reads linked to a marker as BAM records,
+    instead of writing them to the marker's paired.fq file.
+    """
+    def __init__(self, *args, marker_writers, trim_flanks):
+        super().__init__(*args)
+        self.marker_writers = marker_writers
+        self.trim_flanks = trim_flanks
+
+    def process_results(self, record, results):
+        super().process_results(record, results)
+        for marker, _, forward, reverse, _ in results:
+            if marker not in self.marker_writers:
+                continue
+            # TSSV writes a read once for each strand it was linked on
+            for match in (forward, reverse):
+                if match is not None:
+                    write_marker_read(self.marker_writers[marker], record, self.trim_flanks)
+
+def open_marker_writers(shard_dir, header, markers, flanks):
+    """Opens one BAM file for the reads of each marker in the BED file."""
+    writers = {}
+    for dire, chromsome, pos in markers:
+        outfh = pysam.AlignmentFile(os.path.join(shard_dir, dire + ".bam"), "wb", header=header)
+        writers[dire] = {"marker": dire,
+                         "outfh": outfh,
+                         "reference_id": outfh.get_tid(chromsome),
+                         "reference_start": int(pos) - 1,
+                         "flank": compile_flank(flanks[dire][1]),
+                         "flank_rev": compile_flank(f2s.rev_comp(flanks[dire][0])),
+                         "n_linked": 0,
+                         "n_written": 0}
+    return writers
+
+def write_marker_read(writer, record, trim_flanks):
+    """Trims a read linked to a marker and writes it to the marker's BAM file."""
+    writer["n_linked"] += 1
+    name = record[0].split()[0]
+    seq = record[1]
+    qual = record[2]
+    if trim_flanks:
+        trimmed = f2s.trim_read(seq, qual, writer["flank"], writer["flank_rev"])
+        if trimmed is None:
+            return
+        seq, qual = trimmed
+    outfh = writer["outfh"]
+    outfh.write(f2s.make_bam_record(outfh.header, writer["reference_id"], writer["reference_start"],
+                                    name, seq, qual, writer["marker"]))
+    writer["n_written"] += 1
+
+def fused_fastq2bam(fastq_file, outfile, bed_file, library_file, stats_path, trim_flanks=True,
+                    num_threads=1, flanks=None):
+    """
+    Links the reads of a preprocessed FASTQ file to markers, trims them and
+    writes them to a sorted and indexed BAM file, in one pass over the reads.
+    The TSSV statistics are written to stats_path. Flanks already read with
+    fastq2sam.get_flanks_lib can be given.
+    """
+    chromsomes, pos, fq_dirs = f2s.get_chr_str(bed_file)
+    if flanks is None:
+        flanks = f2s.get_flanks_lib(library_file)
+    library = read_library(library_file)
+    header = f2s.make_bam_header(chromsomes)
+    markers = f2s.sorted_markers(chromsomes, fq_dirs, pos)
+    os.makedirs(stats_path, exist_ok=True)
+
+    # Reads are written to one BAM file per marker, which are concatenated
+    # in sorted order at the end, as all reads of a marker share one position.
+    shard_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        writers = open_marker_writers(shard_dir, header, markers, flanks)
+        try:
+            with decompressed_path(fastq_file, num_threads) as reads_path, \
+                 parse_reads(reads_path) as (_, reads):
+                tssv = make_tssv(MarkerBamTSSV, reads, library, num_threads,
+                                 marker_writers=writers, trim_flanks=trim_flanks)
+                tssv.process_file(True)
+        finally:
+            for writer in writers.values():
+                writer["outfh"].close()
+        for dire, writer in writers.items():
+            logging.info(f"found {writer['n_written']} reads of {writer['n_linked']} for {dire}")
+        shards = [os.path.join(shard_dir, dire + ".bam") for dire, _, _ in markers]
+        pysam.cat("--no-PG", "-o", outfile, *shards, catch_stdout=False)
+    finally:
+        shutil.rmtree(shard_dir)
+    write_tssv_tables(tssv, stats_path)
+    logging.info(f'Linked {tssv.total_reads - tssv.unrecognised} of {tssv.total_reads} reads to markers')
+
+    pysam.index(outfile)
+    logging.info('Wrote sorted and indexed BAM file: ' + outfile)
+    return outfile
+
+def main(args):
+    fused_fastq2bam(args.read1, args.outfile, args.bed_file, args.library_file, args.stats_path,
+                    args.trim_flanks, args.num_threads)
+
+if __name__ == '__main__':
+    args = parseArgs()
+    main(args)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Lifetimes of the intermediate files of a sample.
+
+Each intermediate file or directory is added with the stages that read it,
+and is removed as soon as the last of them has finished, so that the temp
+directory of a sample only holds what later stages still need. Stages that
+fail do not count as finished, so their inputs are kept. The index of a BAM
+file is removed with it.
+
+The temp files of a sample at their largest are estimated from the size
+of its input files, for the scratch space of a batch (see resources).
+"""
+import os
+import shutil
+import logging
+import threading
+
+# Size of gzipped FASTQ files relative to the uncompressed reads
+GZIP_RATIO = 0.25
+# Largest size of the temp files of a sample, relative to its uncompressed reads:
+# the trimmed reads next to the merged reads, or the TSSV output next to the BAM file
+SCRATCH_FACTOR = 1.5
+
+def path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, files in os.walk(path) for name in files)
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return 0
+
+def remove_path(path):
+    size = path_size(path)
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.isfile(path):
+        os.remove(path)
+    return size
+
+def scratch_estimate(read_files, fraction=None):
+    """Returns the estimated bytes of the temp files of a sample, at their largest."""
+    reads = sum(os.path.getsize(path) / (GZIP_RATIO if path.endswith('.gz') else 1)
+                for path in read_files if path)
+    if fraction:
+        reads *= fraction
+    return int(reads * SCRATCH_FACTOR)
+
+class Intermediates:
+    """
+    The intermediate files of a sample, with the stages that still read them.
+    If not enabled, as with --keep, nothing is removed.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.consumers = {}
+        self.lock = threading.Lock()
+
+    def add(self, path, consumers):
+        """Adds an intermediate file or directory, to be removed when the consumer stages have finished."""
+        if not path:
+            return
+        with self.lock:
+            self.consumers.setdefault(path, set()).update(consumers)
+
+    def finished(self, stage):
+        """Removes the intermediates that no stage reads after stage."""
+        with self.lock:
+            done = []
+            for path, consumers in self.consumers.items():
+                consumers.discard(stage)
+                if not consumers:
+                    done.append(path)
+            for path in done:
+                del self.consumers[path]
+        if not self.enabled:
+            return
+        for path in done:
+            size = remove_path(path)
+            if path.endswith('.bam'):
+                size += remove_path(path + '.bai')
+            if size:
+                logging.info(f'Removed {path} after {stage}, {size // 2**20} MB')
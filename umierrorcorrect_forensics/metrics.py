@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Performance metrics of the pipeline stages.
+
+For each stage of a sample, these are saved to run_metrics.json in the
+output directory of the sample:
+wall_time, cpu_time    - seconds, CPU time includes finished child processes
+peak_rss               - bytes, the highest memory use of the pipeline process
+                         and its child processes together during the stage
+io_read, io_written    - bytes read and written by the process and its
+                         finished child processes, including pipes
+input_bytes, output_bytes - sizes of the input and output files
+reads_in, reads_out    - reads in the input and output FASTQ and BAM files,
+                         only if counted (as each count is a full pass
+                         over the file, this is off by default)
+reads_per_sec          - reads_in (or reads_out, for stages that read a
+                         directory) per second of wall time, if counted
+start                  - seconds from the start of the sample to the start
+                         of the stage
+
+Stages that run at the same time (see scheduler) share the process, so
+their CPU time, peak memory and bytes read and written include each other.
+
+Memory is sampled every RSS_INTERVAL seconds from /proc, so the peak of a
+child process that lived shorter than that may be missed, unless it was
+the largest child so far (then getrusage has it). The Python stages also
+log their progress in reads/sec while they run, with ReadProgress.
+"""
+import os
+import json
+import time
+import logging
+import resource
+import threading
+import pysam
+from umierrorcorrect_forensics.compression import decompressed
+
+METRICS_FILE = "run_metrics.json"
+RSS_INTERVAL = 0.2
+PROGRESS_INTERVAL = 30
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+FASTQ_SUFFIXES = ('.fastq', '.fq', '.fastq.gz', '.fq.gz')
+
+class ReadProgress:
+    """
+    Logs the number of reads handled and the rate, at most every interval
+    seconds. The clock is only read every check_every reads, so that
+    update can be called once per read.
+    """
+    def __init__(self, name, interval=PROGRESS_INTERVAL, check_every=10000):
+        self.name = name
+        self.interval = interval
+        self.check_every = check_every
+        self.count = 0
+        self.next_check = check_every
+        self.start = self.last_log = time.monotonic()
+
+    def update(self, n=1):
+        self.count += n
+        if self.count >= self.next_check:
+            self.next_check = self.count + self.check_every
+            now = time.monotonic()
+            if now - self.last_log >= self.interval:
+                self.last_log = now
+                self.log(now)
+
+    def log(self, now):
+        elapsed = now - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0
+        logging.info(f'{self.name}: {self.count} reads, {rate:.0f} reads/sec')
+
+def process_tree_rss(pid):
+    """Returns the summed RSS in bytes of a process and all its descendants."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as fh:
+                stat = fh.read()
+        except OSError:
+            continue
+        # The command name is in parentheses and may contain spaces
+        fields = stat[stat.rindex(')') + 2:].split()
+        children.setdefault(int(fields[1]), []).append((int(entry), int(fields[21])))
+    rss = 0
+    pending = [pid]
+    while pending:
+        for child, pages in children.get(pending.pop(), []):
+            rss += pages * PAGE_SIZE
+            pending.append(child)
+    try:
+        with open(f'/proc/{pid}/statm') as fh:
+            rss += int(fh.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        pass
+    return rss
+
+class RSSSampler(threading.Thread):
+    """Samples the memory use of the process tree until stopped."""
+    def __init__(self, interval=RSS_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.available = os.path.isdir('/proc')
+
+    def run(self):
+        while self.available and not self.stopped.is_set():
+            self.peak = max(self.peak, process_tree_rss(os.getpid()))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+def read_io():
+    """Returns bytes read and written by the process and its finished children, if available."""
+    try:
+        with open('/proc/self/io') as fh:
+            io = dict(line.split(': ') for line in fh.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def rusage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    # ru_maxrss is in kilobytes on Linux
+    return cpu_time, own.ru_maxrss * 1024, children.ru_maxrss * 1024
+
+def count_fastq_reads(path):
+    lines = 0
+    with decompressed(path) as fh:
+        while chunk := fh.read(1 << 20):
+            lines += chunk.count(b'\n')
+    return lines // 4
+
+def count_bam_reads(path):
+    if os.path.isfile(path + '.bai'):
+        return sum(int(line.split('\t')[2]) + int(line.split('\t')[3])
+                   for line in pysam.idxstats(path).splitlines() if line)
+    return int(pysam.view('-c', path))
+
+class RunMetrics:
+    """
+    The metrics of the stages of one sample, saved after each stage. The
+    reads in the input and output files are only counted with count_reads.
+    """
+    def __init__(self, output_path, count_reads=False):
+        self.path = os.path.join(output_path, METRICS_FILE)
+        self.counting = count_reads
+        self.stages = []
+        self.read_counts = {}
+        self.start = time.perf_counter()
+        self.lock = threading.RLock()
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as fh:
+                json.dump({"stages": self.stages}, fh, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def count_reads(self, paths):
+        """
+        Counts the reads in the FASTQ and BAM files among paths, or returns
+        None if reads are not counted. Counts are cached, as the output files
+        of a stage are the inputs of the next.
+        """
+        if not self.counting:
+            return None
+        total = 0
+        for path in paths:
+            if not os.path.isfile(path) or not (path.endswith(FASTQ_SUFFIXES) or path.endswith('.bam')):
+                continue
+            stat = os.stat(path)
+            key = (path, stat.st_size, stat.st_mtime_ns)
+            if key not in self.read_counts:
+                if path.endswith('.bam'):
+                    self.read_counts[key] = count_bam_reads(path)
+                else:
+                    self.read_counts[key] = count_fastq_reads(path)
+            total += self.read_counts[key]
+        return total
+
+    def file_sizes(self, paths):
+        return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+    def measure(self, stage, func, inputs, outputs):
+        """
+        Runs func for a stage and saves its metrics. outputs is a function
+        that returns the output paths of the stage, given the result of func.
+        Returns the result of func.
+        """
+        # Reads in the inputs are counted before they may be removed by the stage
+        reads_in = self.count_reads(inputs)
+        input_bytes = self.file_sizes(inputs)
+        sampler = RSSSampler()
+        sampler.start()
+        start_io = read_io()
+        start_cpu, start_rss, start_children_rss = rusage()
+        start = time.perf_counter()
+        try:
+            result = func()
+        finally:
+            wall_time = time.perf_counter() - start
+            end_cpu, end_rss, end_children_rss = rusage()
+            end_io = read_io()
+            peak_rss = sampler.stop()
+        # getrusage has the highest memory use so far, which counts if it grew in this stage
+        if end_rss > start_rss:
+            peak_rss = max(peak_rss, end_rss)
+        if end_children_rss > start_children_rss:
+            peak_rss = max(peak_rss, end_children_rss)
+        output_paths = outputs(result)
+        reads_out = self.count_reads(output_paths)
+        reads = reads_in or reads_out
+        metrics = {"stage": stage,
+                   "start": round(start - self.start, 3),
+                   "wall_time": round(wall_time, 3),
+                   "cpu_time": round(end_cpu - start_cpu, 3),
+                   "peak_rss": peak_rss,
+                   "io_read": end_io[0] - start_io[0] if start_io and end_io else None,
+                   "io_written": end_io[1] - start_io[1] if start_io and end_io else None,
+                   "input_bytes": input_bytes,
+                   "output_bytes": self.file_sizes(output_paths),
+                   "reads_in": reads_in,
+                   "reads_out": reads_out,
+                   "reads_per_sec": round(reads / wall_time, 1) if reads is not None and wall_time > 0 else None}
+        with self.lock:
+            self.stages.append(metrics)
+            self.save()
+        logging.info(f'Stage {stage} took {metrics["wall_time"]} s, {metrics["cpu_time"]} s CPU, '
+                     f'{peak_rss // 2**20} MB peak memory')
+        return result
+
+    def skipped(self, stage):
+        with self.lock:
+            self.stages.append({"stage": stage, "skipped": True})
+            self.save()
+
+def write_run_metrics(output_path, sample_paths, wall_time, cpu_time):
+    """Writes run_metrics.json for the whole run, with the stage metrics of each sample."""
+    samples = {}
+    for name, path in sample_paths.items():
+        metrics_path = os.path.join(path, METRICS_FILE)
+        if os.path.isfile(metrics_path):
+            with open(metrics_path) as fh:
+                samples[name] = json.load(fh)["stages"]
+    with open(os.path.join(output_path, METRICS_FILE), "w") as fh:
+        json.dump({"wall_time": round(wall_time, 3),
+                   "cpu_time": round(cpu_time, 3),
+                   "samples": samples}, fh, indent=1)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Fast loading of the ML filter models.
+
+Models are distributed as (optionally lzma compressed) pickle files, which
+take seconds to decompress and unpickle. Here, a model, or a dict of
+per-marker models and [model, k, m] length correction lists, is compiled once
+to an uncompressed joblib file where all NumPy arrays are stored as raw
+buffers. These are loaded with memory mapping, so that parallel workers share
+the same pages. Compiled models are cached on disk, keyed by the SHA-256 hash
+of the original model file and by the versions of the libraries and formats
+they were compiled with (see cache_key), as joblib files hold pickled
+Scikit-learn objects that may not load in other versions.
+
+Random-forest models are instead compiled to flattened NumPy node arrays (see
+flat_forest), when the flattened model gives the same probabilities. These are
+loaded without Scikit-learn and scored faster. Other models, such as the MLP
+models, fall back to the joblib format.
+"""
+import argparse
+import sys
+import os
+import hashlib
+import logging
+import lzma
+import pickle
+import tempfile
+from importlib import metadata
+from umierrorcorrect_forensics import flat_forest
+
+COMPILED_SUFFIX = ".joblib"
+# Changes when the way models are compiled changes, so older cache entries are not used
+CACHE_VERSION = 1
+CACHE_ENV_VARIABLE = "UMIEC_FORENSICS_MODEL_CACHE"
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Compiles an ML filter model to a fast loading format.")
+    parser.add_argument('-m', '--model_path', dest='model_path',
+                        help='Path to a pickle (or .xz) file with a Scikit-learn model.', required=True)
+    parser.add_argument('-o', '--output_path', dest='output_path',
+                        help='Path to write the compiled model to, ending with ' + COMPILED_SUFFIX + ' or ' + flat_forest.FLAT_SUFFIX + '. Written to the model cache if unset.')
+    parser.add_argument('-c', '--cache_dir', dest='cache_dir',
+                        help='Model cache directory. Default=$' + CACHE_ENV_VARIABLE + ' or ~/.cache/umierrorcorrect_forensics/models')
+    args = parser.parse_args(sys.argv[1:])
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
+    return(args)
+
+def default_cache_dir():
+    if os.environ.get(CACHE_ENV_VARIABLE):
+        return os.environ[CACHE_ENV_VARIABLE]
+    return os.path.join(os.path.expanduser("~"), ".cache", "umierrorcorrect_forensics", "models")
+
+def file_hash(path, block_size=1 << 20):
+    """SHA-256 hash of a file, read in blocks."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def package_version(name):
+    """Installed version of a package, read without importing it."""
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return "none"
+
+def cache_key(model_path):
+    """
+    Cache key of a model file: the hash of the file, with the versions of
+    the cache, the flattened format, Scikit-learn, joblib and NumPy.
+    """
+    versions = (f"cache={CACHE_VERSION};flat={flat_forest.FLAT_VERSION};"
+                f"sklearn={package_version('scikit-learn')};joblib={package_version('joblib')};"
+                f"numpy={package_version('numpy')}")
+    return hashlib.sha256((file_hash(model_path) + ";" + versions).encode()).hexdigest()
+
+def load_pickled_model(model_path):
+    """Reads a pickled ML model, optionally lzma compressed."""
+    if os.path.splitext(model_path)[1] == ".xz":
+        with lzma.open(model_path, "rb") as f:
+            model = pickle.load(f)
+    else:
+        with open(model_path, "rb") as f:
+            model = pickle.load(f)
+    return model
+
+def compile_model(model_path, output_path):
+    """
+    Writes a model, or a dict of per-marker models, as a flattened model if
+    output_path ends with flat_forest.FLAT_SUFFIX, and otherwise as an
+    uncompressed joblib file that can be memory-mapped. The file is written
+    to a temporary name first, so parallel runs never see a partial file.
+    """
+    model = load_pickled_model(model_path)
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(output_dir, exist_ok=True)
+    flatten = flat_forest.is_flat_model(output_path)
+    (fd, tmp_path) = tempfile.mkstemp(suffix=flat_forest.FLAT_SUFFIX if flatten else COMPILED_SUFFIX,
+                                      dir=output_dir)
+    os.close(fd)
+    try:
+        if flatten:
+            flat_forest.export_and_check(model, tmp_path)
+        else:
+            import joblib
+            joblib.dump(model, tmp_path, compress=0)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logging.info(f"Compiled ML model {model_path} to {output_path}")
+    return output_path
+
+def cached_model_path(model_path, cache_dir=None):
+    """
+    Path of the compiled model in the cache, compiling it if not present.
+    The flattened format is tried first. Models that can not be flattened
+    are marked with an empty .unsupported file and compiled with joblib.
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    base_path = os.path.join(cache_dir, cache_key(model_path))
+    flat_path = base_path + flat_forest.FLAT_SUFFIX
+    compiled_path = base_path + COMPILED_SUFFIX
+    unsupported_path = base_path + ".unsupported"
+    if os.path.isfile(flat_path):
+        return flat_path
+    if not os.path.isfile(unsupported_path):
+        try:
+            return compile_model(model_path, flat_path)
+        except flat_forest.UnsupportedModelError as e:
+            logging.info(f"Model {model_path} can not be flattened ({e}), using joblib format.")
+            open(unsupported_path, "w").close()
+    if not os.path.isfile(compiled_path):
+        compile_model(model_path, compiled_path)
+    return compiled_path
+
+def load_compiled_model(compiled_path):
+    """
+    Loads a flattened or a joblib compiled model. joblib, and through the
+    model Scikit-learn, are only imported for joblib models, so flattened
+    models are scored without them.
+    """
+    if flat_forest.is_flat_model(compiled_path):
+        return flat_forest.load_flat_model(compiled_path)
+    import joblib
+    return joblib.load(compiled_path, mmap_mode="r")
+
+def load_model(model_path, cache_dir=None, use_cache=True):
+    """
+    Loads an ML model. Compiled (.joblib or .flat.npz) models are loaded
+    directly. Pickled models are compiled into the cache on first use and
+    then loaded from there, unless use_cache is False.
+    """
+    if os.path.splitext(model_path)[1] == COMPILED_SUFFIX or flat_forest.is_flat_model(model_path):
+        return load_compiled_model(model_path)
+    if not use_cache:
+        return load_pickled_model(model_path)
+    try:
+        compiled_path = cached_model_path(model_path, cache_dir)
+    except OSError as e:
+        logging.warning(f"Could not use the model cache ({e}), reading {model_path} directly.")
+        return load_pickled_model(model_path)
+    logging.info(f"Loading compiled ML model {compiled_path}")
+    return load_compiled_model(compiled_path)
+
+def main(args):
+    if args.output_path:
+        compile_model(args.model_path, args.output_path)
+    else:
+        cached_model_path(args.model_path, args.cache_dir)
+
+if __name__ == '__main__':
+    args = parseArgs()
+    main(args)
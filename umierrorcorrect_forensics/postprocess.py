@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Single-pass post-processing of the consensus BAM file of a sample.
+
+The reference path reads the consensus reads four times: the ML filter
+writes the accepted reads to a new BAM file, filter_bam of UMIerrorcorrect
+keeps the families with enough members, run_get_consensus_statistics
+counts the family sizes, and bam2fastq converts the filtered BAM file for
+FDStools. Here, the consensus BAM file is read once. Each read accepted by
+the ML filter (if any) is counted for the statistics and, if its family has
+at least umi_member_threshold members, written to the filtered BAM and
+FASTQ files. The ML-filtered BAM file is written in the same pass, if asked
+for. The outputs are the same as from the reference path.
+"""
+import argparse
+import sys
+import logging
+from collections import Counter
+from contextlib import nullcontext
+import pysam
+from umierrorcorrect.get_consensus_statistics import (region_cons_stat, get_overall_statistics,
+                                                      calculate_target_coverage)
+from umierrorcorrect_forensics.metrics import ReadProgress
+from umierrorcorrect_forensics.profiling import profile_main
+
+FAMILY_SIZES = [1, 2, 3, 4, 5, 7, 10, 20, 30]
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+# Quality that samtools fastq (as bundled with pysam) gives to the bases of reads without qualities
+DEFAULT_QUALITY = 'B'
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Filters the consensus reads, counts their family sizes and \
+                                     writes them to BAM and FASTQ files in one pass.")
+    parser.add_argument('-i', '--input_path', dest='input_path',
+                        help='Path to the consensus BAM file, required', required=True)
+    parser.add_argument('-o', '--output_path', dest='output_path',
+                        help='Path to the output directory, required', required=True)
+    parser.add_argument('-s', '--sample_name', dest='sample_name',
+                        help='Sample name, used in the file names, required', required=True)
+    parser.add_argument('--hist', dest='hist_file',
+                        help='Path to the .hist file of UMIerrorcorrect, required', required=True)
+    parser.add_argument('-uth', '--umi_member_threshold', dest='umi_member_threshold', type=int,
+                        help='Minimum number of members in an UMI family. Default=%(default)s', default=3)
+    parser.add_argument('-j', '--json_path', dest='json_path',
+                        help='Path to the json file, or family store directory, with UMI family metadata, for the ML filter.')
+    parser.add_argument('-m', '--model_path', dest='model_path',
+                        help='Path to a model for the ML filter. No ML filtering takes place if unset.')
+    parser.add_argument('-th', '--threshold', dest='threshold', type=float, default=0.95,
+                        help='Classification threshold. Default=%(default)s')
+    parser.add_argument('-thp', '--thresholds_path', dest='thresholds_path',
+                        help='Path to file with classification threshold per marker. Overrides -th.')
+    parser.add_argument('-l', '--library', dest='library_file',
+                        help='FDStools library file to get the repeat length of each marker from.')
+    parser.add_argument('--model_cache', dest='model_cache',
+                        help='Directory to cache compiled models in.')
+    parser.add_argument('-t', '--num_threads', dest='num_threads', type=int,
+                        help='Number of threads for BAM compression and decompression. Default=%(default)s', default=1)
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Profile the post-processing, and write the profile files to a profile directory in the output directory.')
+    args = parser.parse_args(sys.argv[1:])
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
+    return(args)
+
+def fastq_record(read):
+    """The FASTQ record of a read, as samtools fastq writes it: on the forward strand of the read."""
+    seq = read.query_sequence
+    if read.query_qualities is None:
+        qual = DEFAULT_QUALITY * len(seq)
+    else:
+        qual = pysam.qualities_to_qualitystring(read.query_qualities)
+    if read.is_reverse:
+        seq = seq.translate(COMPLEMENT)[::-1]
+        qual = qual[::-1]
+    return f"@{read.query_name}\n{seq}\n+\n{qual}\n"
+
+def count_family(hist, name):
+    """Adds the family size of a consensus read to hist, by region, as get_stat of UMIerrorcorrect does."""
+    if name.startswith('Consensus_read'):
+        parts = name.split('_')
+        if parts[-1].startswith('Count') or parts[-1] == 'a':
+            hist.setdefault(str(parts[2]), []).append(int(name.split('=')[-1]))
+
+def region_statistics(hist, stat_filename):
+    """The statistics of each region of the .hist file, from the family sizes in hist, as get_stat of UMIerrorcorrect."""
+    regions = []
+    with open(stat_filename) as f:
+        for line in f:
+            regionid, pos, name, cons, singles, *rest = line.rstrip().split('\t')
+            regions.append((str(regionid), pos, int(singles.split(": ")[-1]), name))
+    regionstats = []
+    for regionid, pos, singletons, name in regions:
+        if '-' in regionid:
+            a, b, *rest = regionid.split('-')
+            from_tag = False
+            try:
+                int(b)
+            except ValueError:
+                if '_' in b:
+                    name = a
+                    a = 0
+                    b = int(b.split('_')[-1])
+                    from_tag = True
+            stat = region_cons_stat(regionid, pos, name, singletons, FAMILY_SIZES)
+            for i in range(int(a), int(b) + 1):
+                key = name + '_' + str(i) if from_tag else str(i)
+                if key in hist:
+                    stat.add_histogram(hist[key], FAMILY_SIZES)
+            regionstats.append(stat)
+        else:
+            stat = region_cons_stat(regionid, pos, name, singletons, FAMILY_SIZES)
+            if regionid in hist:
+                stat.add_histogram(hist[regionid], FAMILY_SIZES)
+            regionstats.append(stat)
+    return regionstats
+
+def statistics_files(output_path, sample_name, output_raw=True):
+    files = [output_path + '/' + sample_name + '_summary_statistics.txt',
+             output_path + '/' + sample_name + '_target_coverage.txt']
+    if output_raw:
+        files.append(output_path + '/' + sample_name + '_consensus_group_counts.txt')
+    return files
+
+def write_statistics(regionstats, output_path, sample_name, output_raw=True):
+    """Writes the statistics files that run_get_consensus_statistics of UMIerrorcorrect writes."""
+    fsizes = list(FAMILY_SIZES)
+    histall = get_overall_statistics(regionstats, fsizes)
+    summary_file, coverage_file, *counts_file = statistics_files(output_path, sample_name, output_raw)
+    logging.info('Writing consensus statistics to ' + summary_file)
+    with open(summary_file, 'w') as g:
+        g.write(histall.write_stats() + '\n')
+        for stat in regionstats:
+            g.write(stat.write_stats() + '\n')
+    with open(coverage_file, 'w') as g:
+        g.write(calculate_target_coverage(regionstats, fsizes))
+    if output_raw:
+        sizes = Counter()
+        for stat in regionstats:
+            sizes.update(stat.hist)
+            if stat.singletons:
+                sizes[1] += stat.singletons
+        with open(counts_file[0], 'w') as g:
+            for size in sorted(sizes):
+                g.write(str(size) + '\t' + str(sizes[size]) + '\n')
+
+def postprocess_consensus(consensus_bam, filtered_bam, fastq_file, hist_file, output_path, sample_name,
+                          umi_member_threshold, accepted=None, mlfiltered_bam=None, output_raw=True, num_threads=1):
+    """
+    Reads the consensus BAM file once, and writes the filtered BAM and FASTQ
+    files and the consensus statistics. accepted is the set of families
+    accepted by the ML filter (see run_umifilter.accepted_families), as
+    "<read name>_<contig>", or None to keep all. With mlfiltered_bam, the
+    accepted reads are also written to that file, which is then indexed.
+    """
+    umi_member_threshold = int(umi_member_threshold)
+    num_threads = int(num_threads)
+    hist = {}
+    n_accepted = n_dismissed = n_filtered = 0
+    with pysam.AlignmentFile(consensus_bam, 'rb', threads=num_threads) as f, \
+         pysam.AlignmentFile(filtered_bam, 'wb', template=f, threads=num_threads) as filtered, \
+         (pysam.AlignmentFile(mlfiltered_bam, 'wb', template=f, threads=num_threads)
+          if mlfiltered_bam else nullcontext()) as mlfiltered, \
+         open(fastq_file, 'w') as fastq:
+        progress = ReadProgress("Post-processing")
+        for read in f.fetch():
+            progress.update()
+            if accepted is not None:
+                if read.query_name + "_" + read.reference_name not in accepted:
+                    n_dismissed += 1
+                    continue
+                n_accepted += 1
+                if mlfiltered_bam:
+                    mlfiltered.write(read)
+            count_family(hist, read.query_name)
+            if int(read.query_name.split('=')[-1]) >= umi_member_threshold:
+                filtered.write(read)
+                n_filtered += 1
+                # samtools fastq leaves out secondary and supplementary alignments
+                if not read.is_secondary and not read.is_supplementary:
+                    fastq.write(fastq_record(read))
+    if accepted is not None:
+        if n_accepted == 0:
+            logging.warning(f"Zero consensus reads passed ML filter! Instead, {n_dismissed} were dismissed from the consensus BAM file.")
+        logging.info(f"ML filter included {n_accepted}, dismissed {n_dismissed} consensus sequences "
+                     f"out of {n_accepted+n_dismissed} in total.")
+        if mlfiltered_bam:
+            pysam.index(mlfiltered_bam)
+    logging.info(f'Wrote {n_filtered} consensus reads of families with at least {umi_member_threshold} members '
+                 f'to {filtered_bam} and {fastq_file}')
+    write_statistics(region_statistics(hist, hist_file), output_path, sample_name, output_raw)
+    return filtered_bam
+
+def main(args):
+    accepted = None
+    if args.model_path:
+        from umierrorcorrect_forensics.run_umifilter import accepted_families
+        accepted = accepted_families(args.json_path, args.model_path, args.threshold, args.thresholds_path,
+                                     args.library_file, model_cache=args.model_cache)
+    prefix = args.output_path + '/' + args.sample_name
+    postprocess_consensus(args.input_path, prefix + '_filtered_consensus_reads.bam',
+                          prefix + '_filtered_consensus_reads.fq', args.hist_file, args.output_path,
+                          args.sample_name, args.umi_member_threshold, accepted,
+                          prefix + '_mlfiltered_consensus_reads.bam' if accepted is not None else None,
+                          num_threads=args.num_threads)
+
+if __name__ == '__main__':
+    args = parseArgs()
+    profile_main(main, args, args.output_path + '/' + args.sample_name, "postprocess")
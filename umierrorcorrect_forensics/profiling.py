@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Function-level profiling of the Python stages.
+
+A profiled stage is run under cProfile, and its stack is also sampled
+every SAMPLE_INTERVAL seconds of CPU time, by a SIGPROF timer. The signal
+handler runs between bytecodes, so time in C functions is counted in the
+Python function that called them. Two files are written for each stage:
+<stage>.prof       - cProfile statistics, for pstats, snakeviz etc.
+<stage>.collapsed  - sampled stacks in the collapsed format of
+                     flamegraph.pl, inferno and speedscope, one
+                     "root;caller;function count" line per stack
+
+Only the main thread of the process is sampled (stacks are not sampled
+for stages run in other threads), and the worker processes of stages run
+on several threads are not profiled. Profile with one thread to see those.
+Stages are only wrapped when profiling is turned on, so there is no
+overhead otherwise.
+"""
+import os
+import signal
+import cProfile
+import logging
+import threading
+from collections import Counter
+
+PROFILE_DIR = "profile"
+SAMPLE_INTERVAL = 0.005
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """Counts the stacks of the main thread, sampled by SIGPROF until stopped."""
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.active = threading.current_thread() is threading.main_thread()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        if not self.active:
+            return
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        # Restart system calls, also in C extensions, instead of failing with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if self.active:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.previous)
+        return self.stacks
+
+def write_collapsed(path, stacks):
+    with open(path, "w") as fh:
+        for stack, count in stacks.most_common():
+            fh.write(f"{stack} {count}\n")
+
+def profile(func, stage, output_path):
+    """
+    Runs func under the profiler and writes the profile files of the stage
+    to output_path. Returns the result of func.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    profiler = cProfile.Profile()
+    sampler = StackSampler()
+    sampler.start()
+    try:
+        return profiler.runcall(func)
+    finally:
+        stacks = sampler.stop()
+        profiler.dump_stats(os.path.join(output_path, stage + ".prof"))
+        write_collapsed(os.path.join(output_path, stage + ".collapsed"), stacks)
+        logging.info(f'Wrote profile of {stage} to {output_path}')
+
+def profile_main(main, args, output_file, stage):
+    """Runs the main function of a script, profiled if args.profile is set, with the profile next to output_file."""
+    if not args.profile:
+        return main(args)
+    output_path = os.path.join(os.path.dirname(os.path.abspath(output_file)), PROFILE_DIR)
+    return profile(lambda: main(args), stage, output_path)
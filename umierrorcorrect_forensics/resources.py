@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+The CPU and memory budget of a run, and the governor that hands it out.
+
+The budget is what the process may use on the node: the CPUs in its
+affinity mask and its cgroup CPU quota (as set by Slurm, Docker etc.), and
+the memory under the cgroup limit, the Slurm memory request and the
+available memory of the node, whichever is least. Only MEMORY_HEADROOM of
+the memory is handed out, for the memory that the stages do not reserve.
+
+Each stage reserves threads, and memory, from the ResourceGovernor before
+it runs, and waits until they are free. Each sample of a batch reserves
+the disk space of its temp files from the ScratchSpace before it starts.
+Their counters are in shared memory, so the samples of a batch that run in
+forked processes share the budget.
+"""
+import os
+import re
+import math
+import logging
+import multiprocessing
+from contextlib import contextmanager
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+MEMORY_HEADROOM = 0.9
+# Memory samtools sort uses per thread by default (-m)
+SORT_MEMORY_PER_THREAD = 768 * 2**20
+# cgroup v1 reports no memory limit as a number near the largest 64 bit integer
+NO_LIMIT = 2**60
+MEMORY_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+def parse_size(size):
+    """Returns the bytes of a memory or disk size such as 4000M or 16G."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", str(size).strip().upper())
+    if match is None:
+        raise ValueError(f"Invalid memory size: {size}")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+def format_size(size):
+    return f"{size / 2**30:.1f} GB" if size is not None else "no limit"
+
+def read_value(path):
+    try:
+        with open(path) as fh:
+            return fh.read().strip()
+    except OSError:
+        return None
+
+def cgroup_dirs():
+    """
+    Returns the cgroup directories of the process and their parents, for the
+    controllers in /proc/self/cgroup ("" for cgroup v2), as
+    {controller: [directories]}.
+    """
+    dirs = {}
+    cgroups = read_value("/proc/self/cgroup")
+    if cgroups is None:
+        return dirs
+    for line in cgroups.splitlines():
+        _, controllers, path = line.split(":", 2)
+        if controllers.startswith("name="):
+            continue
+        for controller in controllers.split(",") if controllers else [""]:
+            if controller:
+                root = os.path.join(CGROUP_ROOT, controller)
+                if not os.path.isdir(root):
+                    root = os.path.join(CGROUP_ROOT, controllers)
+            elif os.path.isdir(os.path.join(CGROUP_ROOT, "unified")):
+                # cgroup v2 next to v1 controllers
+                root = os.path.join(CGROUP_ROOT, "unified")
+            else:
+                root = CGROUP_ROOT
+            # In a container the path may be outside its view of the hierarchy, then its root is used
+            parts = [part for part in path.split("/") if part]
+            dirs[controller] = [os.path.join(root, *parts[:i]) for i in range(len(parts), -1, -1)]
+    return dirs
+
+def reclaimable_memory(path, key):
+    """Returns the inactive page cache of a cgroup, which is counted in its usage but freed when needed."""
+    stat = read_value(os.path.join(path, "memory.stat"))
+    if stat is None:
+        return 0
+    for line in stat.splitlines():
+        name, value = line.split()
+        if name == key:
+            return int(value)
+    return 0
+
+def cgroup_cpu_limit():
+    """Returns the CPU quota of the cgroups of the process in CPUs, or None without a quota."""
+    limits = []
+    dirs = cgroup_dirs()
+    for path in dirs.get("", []):
+        value = read_value(os.path.join(path, "cpu.max"))
+        if value and not value.startswith("max"):
+            quota, period = value.split()
+            limits.append(int(quota) / int(period))
+    for path in dirs.get("cpu", []):
+        quota = read_value(os.path.join(path, "cpu.cfs_quota_us"))
+        period = read_value(os.path.join(path, "cpu.cfs_period_us"))
+        if quota and period and int(quota) > 0:
+            limits.append(int(quota) / int(period))
+    return min(limits) if limits else None
+
+def cgroup_memory_limit():
+    """Returns the memory left under the limits of the cgroups of the process in bytes, or None without a limit."""
+    limits = []
+    dirs = cgroup_dirs()
+    for path in dirs.get("", []):
+        limit = read_value(os.path.join(path, "memory.max"))
+        usage = read_value(os.path.join(path, "memory.current"))
+        if limit and limit != "max" and usage:
+            limits.append(int(limit) - int(usage) + reclaimable_memory(path, "inactive_file"))
+    for path in dirs.get("memory", []):
+        limit = read_value(os.path.join(path, "memory.limit_in_bytes"))
+        usage = read_value(os.path.join(path, "memory.usage_in_bytes"))
+        if limit and int(limit) < NO_LIMIT and usage:
+            limits.append(int(limit) - int(usage) + reclaimable_memory(path, "total_inactive_file"))
+    return max(min(limits), 0) if limits else None
+
+def available_memory():
+    """Returns the available memory of the node in bytes, from /proc/meminfo."""
+    meminfo = read_value("/proc/meminfo")
+    if meminfo is None:
+        return None
+    for line in meminfo.splitlines():
+        if line.startswith("MemAvailable:"):
+            return int(line.split()[1]) * 1024
+    return None
+
+def slurm_memory_limit(cpus):
+    """Returns the memory of the Slurm job step in bytes, if run under Slurm with a memory request."""
+    if os.environ.get("SLURM_MEM_PER_NODE"):
+        return int(os.environ["SLURM_MEM_PER_NODE"]) * 2**20
+    if os.environ.get("SLURM_MEM_PER_CPU"):
+        return int(os.environ["SLURM_MEM_PER_CPU"]) * 2**20 * cpus
+    return None
+
+def cpu_budget():
+    """Returns the number of CPUs the process may use."""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        cpus = min(cpus, max(math.floor(quota), 1))
+    if os.environ.get("SLURM_CPUS_PER_TASK"):
+        cpus = min(cpus, int(os.environ["SLURM_CPUS_PER_TASK"]))
+    return max(cpus, 1)
+
+def memory_budget(cpus):
+    """Returns the memory in bytes that the stages may reserve, or None if it is not known."""
+    limits = [limit for limit in (cgroup_memory_limit(), slurm_memory_limit(cpus), available_memory())
+              if limit is not None]
+    if not limits:
+        return None
+    return int(min(limits) * MEMORY_HEADROOM)
+
+class ResourceGovernor:
+    """
+    Hands out the threads and memory of the budget to stages. A stage asks
+    for up to a number of threads, memory for each of them, and memory for
+    the stage, and gets as many threads as are free, at least one. A stage
+    that needs more memory than the whole budget runs alone.
+    """
+    def __init__(self, threads=None, memory=None):
+        self.threads = int(threads) if threads else cpu_budget()
+        self.memory = parse_size(memory) if memory else memory_budget(self.threads)
+        context = multiprocessing.get_context("fork")
+        self.condition = context.Condition()
+        self.free_threads = context.RawValue('i', self.threads)
+        self.free_memory = context.RawValue('q', self.memory or 0)
+
+    def grant(self, threads, memory_per_thread, memory):
+        """Returns the threads and memory a stage can get now, or None."""
+        threads = min(max(int(threads), 1), self.threads)
+        free_threads = self.free_threads.value
+        if free_threads < 1:
+            return None
+        threads = min(threads, free_threads)
+        if self.memory is None:
+            return threads, 0
+        free_memory = self.free_memory.value
+        if memory + memory_per_thread > self.memory:
+            if free_threads == self.threads and free_memory == self.memory:
+                return threads, free_memory
+            return None
+        if memory_per_thread:
+            threads = min(threads, (free_memory - memory) // memory_per_thread)
+        if threads < 1 or memory > free_memory:
+            return None
+        return threads, memory + threads * memory_per_thread
+
+    def try_acquire(self, threads=1, memory_per_thread=0, memory=0):
+        """Reserves threads and memory for a stage if it can get them now, and returns them, or None."""
+        with self.condition:
+            granted = self.grant(threads, memory_per_thread, memory)
+            if granted is not None:
+                self.free_threads.value -= granted[0]
+                self.free_memory.value -= granted[1]
+            return granted
+
+    def acquire(self, threads=1, memory_per_thread=0, memory=0):
+        """Waits until the stage can get threads, and returns the threads and memory reserved."""
+        with self.condition:
+            while True:
+                granted = self.try_acquire(threads, memory_per_thread, memory)
+                if granted is not None:
+                    return granted
+                self.condition.wait()
+
+    def wait(self, timeout):
+        """Waits until resources are released, at most timeout seconds."""
+        with self.condition:
+            self.condition.wait(timeout)
+
+    def release(self, threads, memory):
+        with self.condition:
+            self.free_threads.value += threads
+            self.free_memory.value += memory
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, threads=1, memory_per_thread=0, memory=0):
+        """Reserves threads and memory while in the context, and gives the number of threads."""
+        threads, memory = self.acquire(threads, memory_per_thread, memory)
+        try:
+            yield threads
+        finally:
+            self.release(threads, memory)
+
+    def log_budget(self):
+        logging.info(f'Resource budget: {self.threads} threads, {format_size(self.memory)} memory')
+
+class ScratchSpace:
+    """
+    Disk space for the temp files of the samples that run at the same time.
+    A sample waits to start until its temp files fit, unless nothing else is
+    reserved. Without a size, samples never wait.
+    """
+    def __init__(self, size=None):
+        self.size = parse_size(size) if size else None
+        context = multiprocessing.get_context("fork")
+        self.condition = context.Condition()
+        self.free = context.RawValue('q', self.size or 0)
+
+    def acquire(self, size):
+        """Waits until size bytes fit, and returns the bytes reserved."""
+        if self.size is None:
+            return 0
+        with self.condition:
+            if size > self.free.value and self.free.value < self.size:
+                logging.info(f'Waiting for {format_size(size)} of scratch space, {format_size(self.free.value)} free')
+            while True:
+                if size <= self.free.value or self.free.value == self.size:
+                    size = min(size, self.free.value)
+                    self.free.value -= size
+                    return size
+                self.condition.wait()
+
+    def release(self, size):
+        if self.size is None:
+            return
+        with self.condition:
+            self.free.value += size
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, size):
+        """
+        Reserves size bytes while in the context, and gives a function that
+        releases them early, when the temp files have been removed.
+        """
+        reserved = [self.acquire(size)]
+        def release():
+            self.release(reserved[0])
+            reserved[0] = 0
+        try:
+            yield release
+        finally:
+            release()
@@ -5,6 +5,9 @@ import sys
 import os
 import logging
 import re
+import threading
+import configparser
+from umierrorcorrect_forensics.tools.uncollapse_reads import uncollapse_reads
 
 def parseArgs():
     parser = argparse.ArgumentParser(description="Runs full FDStools pipeline")
@@ -16,17 +19,34 @@ def parseArgs():
                         help='Path to the Library file for TSSV, Required', required=True)
     parser.add_argument('-o', '--output_path', dest='output_path',
                         help='Path to the output directory')
+    parser.add_argument('--in_process', dest='in_process', action='store_true',
+                        help='Run FDStools in-process, with the library and ini file read once, instead of the fdstools commands.')
+    parser.add_argument('-u', '--uncollapsed', dest='uncollapsed_file',
+                        help='Analyse the consensus reads uncollapsed, with outputs named after this FASTQ file. \
+                        In-process, the file is not written.')
     args = parser.parse_args(sys.argv[1:])
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
     logging.info('Starting FDStools')
     return(args)
 
-def customize_ini_file(old_ini_file, output_path, verbose=True):
+def tssv_threads(ini_file):
+    """Returns the number of threads TSSV is set to use in an ini file."""
+    config = configparser.ConfigParser(inline_comment_prefixes=(";", "#"))
+    config.read(ini_file)
+    return max(config.getint("tssv", "num-threads", fallback=1), 1)
+
+def customize_ini_file(old_ini_file, output_path, verbose=True, num_threads=None):
     """
     The ini file contains the path where tssv puts its output. To customize its
-    position, we must rewrite the ini file for each sample.
+    position, we must rewrite the ini file for each sample. It is only written
+    if its content changed, so the FDStools runs of a sample share it. With
+    num_threads, TSSV is set to use that many threads, in an ini file of its
+    own, so that runs given different numbers of threads do not share it.
     """
-    new_ini_file = os.path.join(output_path, "ultra_custom.ini")
+    if num_threads is None:
+        new_ini_file = os.path.join(output_path, "ultra_custom.ini")
+    else:
+        new_ini_file = os.path.join(output_path, f"ultra_custom_{num_threads}threads.ini")
     default_fds_output_path = "fdstools_pipeline_results"
     if verbose:
         new_fds_output_path = os.path.join(output_path, 'fdstools_output')
@@ -34,16 +54,66 @@ def customize_ini_file(old_ini_file, output_path, verbose=True):
         new_fds_output_path = ""
 
     with open(old_ini_file, "r") as source:
-        lines = source.readlines()
-    with open(new_ini_file, "w") as target:
-        for line in lines:
-            target.write(re.sub(default_fds_output_path,
-                                new_fds_output_path,
-                                line))
+        lines = [re.sub(default_fds_output_path, new_fds_output_path, line) for line in source]
+    if num_threads is not None:
+        lines = [re.sub(r"^(num-threads\s*=\s*)\d+", rf"\g<1>{num_threads}", line) for line in lines]
+    if os.path.isfile(new_ini_file):
+        with open(new_ini_file, "r") as current:
+            if current.readlines() == lines:
+                return new_ini_file
+    # Written to a temp file and moved in place, as the FDStools runs of a
+    # sample may start at the same time and read the ini file of the other
+    tmp_ini_file = new_ini_file + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_ini_file, "w") as target:
+        target.writelines(lines)
+    os.replace(tmp_ini_file, new_ini_file)
     return new_ini_file
 
-def run_fdstools(fastq_file, library_file, ini_file, output_path, verbose=True):
-    new_ini_file = customize_ini_file(ini_file, output_path, verbose)
+def in_process_fdstools(ini_file, library_file):
+    """
+    Returns the in-process FDStools of the ini file (see fdstools_engine), or
+    None if the analysis of the ini file can only run as fdstools commands.
+    fdstools_engine is imported here, as it needs FDStools internals that
+    older FDStools versions do not have; without them, the commands are run.
+    """
+    try:
+        from umierrorcorrect_forensics.fdstools_engine import load_fdstools
+    except ImportError as e:
+        logging.warning(f'FDStools cannot run in-process ({e}), running FDStools as commands')
+        return None
+    try:
+        return load_fdstools(ini_file, library_file)
+    except ValueError as e:
+        logging.warning(f'{e}, running FDStools as commands')
+        return None
+
+def run_fdstools(fastq_file, library_file, ini_file, output_path, verbose=True, in_process=False, fdstools=None,
+                 uncollapsed_file=None, num_threads=None):
+    """
+    Runs the FDStools case-sample pipeline and stuttermark. In-process, or
+    with the FDStools already loaded by load_fdstools, the library and ini
+    file are not read again. With uncollapsed_file, the consensus reads of
+    fastq_file are analysed uncollapsed, with the outputs named after
+    uncollapsed_file. In-process, each read is counted by its family size
+    and uncollapsed_file is not written. With num_threads, TSSV uses that
+    many threads instead of those of the ini file. Returns the uncollapsed
+    FASTQ file if it was written.
+    """
+    if in_process and fdstools is None:
+        fdstools = in_process_fdstools(ini_file, library_file)
+    infile = os.path.splitext(uncollapsed_file or fastq_file)[0] + '.csv'
+    outfile = os.path.splitext(uncollapsed_file or fastq_file)[0] + '_stutter.csv'
+    if fdstools is not None:
+        fdstools.run(fastq_file, output_path, verbose, uncollapsed_file, num_threads)
+        logging.info('FDStools case-sample pipeline finished. ')
+        fdstools.stuttermark(infile, outfile)
+        logging.info('Applied stutter thresholds using stuttermark: ' + outfile)
+        return None
+
+    if uncollapsed_file:
+        uncollapse_reads(fastq_file, uncollapsed_file)
+        fastq_file = uncollapsed_file
+    new_ini_file = customize_ini_file(ini_file, output_path, verbose, num_threads)
     subprocess.run(['fdstools', 'pipeline',
                     new_ini_file,
                     '-l', library_file,
@@ -51,17 +121,16 @@ def run_fdstools(fastq_file, library_file, ini_file, output_path, verbose=True):
                     check=True)
     logging.info('FDStools case-sample pipeline finished. ')
 
-    infile = os.path.splitext(fastq_file)[0] + '.csv'
-    outfile = os.path.splitext(fastq_file)[0] + '_stutter.csv'
     subprocess.run(['fdstools', 'stuttermark',
                     '-i', infile,
                     '-o', outfile,
                     '-l', library_file])
     logging.info('Applied stutter thresholds using stuttermark: ' + outfile)
-    return None
+    return uncollapsed_file
 
 def main(args):
-    run_fdstools(args.fastq_file, args.library_file, args.ini_file, args.output_path)
+    run_fdstools(args.fastq_file, args.library_file, args.ini_file, args.output_path,
+                 in_process=args.in_process, uncollapsed_file=args.uncollapsed_file)
 
 if __name__ == '__main__':
     args = parseArgs()
@@ -4,6 +4,7 @@ import subprocess
 import sys
 import os
 import logging
+from umierrorcorrect_forensics.compression import COMPRESSION_MODES, fastq_suffix, adapter_removal_options, flash_options
 
 def parseArgs():
     parser = argparse.ArgumentParser(description="Combines paired reads to one consensus read")
@@ -17,42 +18,71 @@ def parseArgs():
                         help='Path to second FASTQ file, R2 if applicable')
     parser.add_argument('-t', '--num_threads', dest='num_threads',
                         help='Number of threads to run the program on. Default=%(default)s', default='1')
+    parser.add_argument('--stream', dest='streaming', action='store_true',
+                        help='Stream the trimmed reads from AdapterRemoval to FLASH through a pipe, \
+                            and write the merged reads uncompressed.')
+    parser.add_argument('--compression', dest='compression', choices=COMPRESSION_MODES, default='gzip',
+                        help='Compression of the output files. Default=%(default)s')
     args = parser.parse_args(sys.argv[1:])
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
     logging.info('Starting Flash')
     return(args)
 
 
-def adapter_removal(read1, read2, num_threads, output_path):
-    '''
-    Removes default Illumina TrueSeq adapters from the reads, which helps
-    FLASH with with alignment.
-    '''
-    trimmed_read1 = os.path.join(output_path, 'trimmed_read1.fastq.gz')
-    trimmed_read2 = os.path.join(output_path, 'trimmed_read2.fastq.gz')
+def adapter_removal_command(read1, read2, num_threads, trimmed_read1, trimmed_read2, compression='none'):
     # Adapters from Froste
     adapter1 = 'AATGATACGGCGACCACCGAGATCTACACTCTTTCCCTACACGACGCTCTTCCGATCT'
     adapter2 = 'CAAGCAGAAGACGGCATACGAGATNNNNNNGTGACTGGAGTTCAGACGTGTGCTCTTCCG'
     # Adapters detected
     # adapter1 = 'AGATCGGAAGAGCACACGTCTGAACTCCAGTNNNNNNNCAATTTCGTATGCCTCTTCTGCTTGA'
     # adapter2 = 'AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGTAGATCTCGGTGGTCGCCGT'
-    subprocess.run(['AdapterRemoval',
-                    '--file1', read1,
-                    '--file2', read2,
-                    '--output1', trimmed_read1,
-                    '--output2', trimmed_read2,
-                    '--settings', '/dev/null', 
-                    '--singleton', '/dev/null', 
-                    '--discarded', '/dev/null',
-                    '--adapter1', adapter1,
-                    '--adapter2', adapter2,
-                    '--threads', num_threads],
-                    check=True)
+    if trimmed_read2 is None:
+        # Both reads of a pair to trimmed_read1
+        outputs = ['--interleaved-output', '--output1', trimmed_read1]
+    else:
+        outputs = ['--output1', trimmed_read1, '--output2', trimmed_read2]
+    return ['AdapterRemoval',
+            '--file1', read1,
+            '--file2', read2] + outputs + [
+            '--settings', '/dev/null', 
+            '--singleton', '/dev/null', 
+            '--discarded', '/dev/null',
+            '--adapter1', adapter1,
+            '--adapter2', adapter2,
+            '--threads', str(num_threads)] + adapter_removal_options(compression)
+
+
+def adapter_removal(read1, read2, num_threads, output_path, compression='gzip'):
+    '''
+    Removes default Illumina TrueSeq adapters from the reads, which helps
+    FLASH with with alignment.
+    '''
+    trimmed_read1 = os.path.join(output_path, 'trimmed_read1' + fastq_suffix(compression))
+    trimmed_read2 = os.path.join(output_path, 'trimmed_read2' + fastq_suffix(compression))
+    subprocess.run(adapter_removal_command(read1, read2, num_threads, trimmed_read1, trimmed_read2,
+                                           compression),
+                   check=True)
     return trimmed_read1,trimmed_read2
 
 
-def run_flash(read1, read2, num_threads, output_path, log_path):
-    read1,read2 = adapter_removal(read1, read2, num_threads, output_path)
+def flash_scratch_files(output_path, compression='gzip'):
+    '''
+    The files that run_flash leaves in output_path besides the merged reads:
+    the trimmed reads, the reads FLASH could not merge and its histograms.
+    '''
+    suffix = fastq_suffix(compression)
+    return [os.path.join(output_path, name) for name in ('trimmed_read1' + suffix,
+                                                         'trimmed_read2' + suffix,
+                                                         'trimmed_read1.notCombined_1' + suffix,
+                                                         'trimmed_read1.notCombined_2' + suffix,
+                                                         'trimmed_read1.hist',
+                                                         'trimmed_read1.histogram')]
+
+
+def run_flash(read1, read2, num_threads, output_path, log_path, streaming=False, compression='gzip'):
+    if streaming:
+        return run_flash_streaming(read1, read2, num_threads, output_path, log_path, compression)
+    read1,read2 = adapter_removal(read1, read2, num_threads, output_path, compression)
     read_filename = os.path.basename(read1)
     read_name = read_filename.split('.',1)[0]
 
@@ -62,12 +92,13 @@ def run_flash(read1, read2, num_threads, output_path, log_path):
         flash_run = subprocess.run(['flash',
                                     read1,
                                     read2,
-                                    '-t', num_threads,
+                                    '-t', str(num_threads),
                                     '-m', str(100),     # Minimum overlap length
                                     '-M', str(300),     # Maximum overlap to be considered in scoring
                                     '-d', output_path,
                                     '-o', read_name,
-                                    '-lz'],             # Lowercase overhang + compress output
+                                    '-l'] +             # Lowercase overhang
+                                    flash_options(compression, num_threads),
                                   stdout=f,
                                   stderr=subprocess.STDOUT
                                   )
@@ -77,15 +108,58 @@ def run_flash(read1, read2, num_threads, output_path, log_path):
     else:
         flash_run.check_returncode()
 
-    output_file = os.path.join(output_path, read_name) + '.extendedFrags.fastq.gz'
+    output_file = os.path.join(output_path, read_name) + '.extendedFrags' + fastq_suffix(compression)
     return output_file
 
+
+def run_flash_streaming(read1, read2, num_threads, output_path, log_path, compression='gzip'):
+    '''
+    Runs AdapterRemoval and FLASH at the same time. AdapterRemoval writes
+    the trimmed read pairs, interleaved, to a pipe that FLASH reads from, and
+    FLASH writes the merged reads uncompressed, unless fast or BGZF
+    compression is asked for. The reads that could not be merged and the
+    FLASH histograms are not kept.
+    '''
+    if compression not in ('fast', 'bgzf'):
+        compression = 'none'
+    read_name = 'trimmed_read1'
+    output_file = os.path.join(output_path, read_name) + '.extendedFrags' + fastq_suffix(compression)
+    stdout_file = os.path.join(log_path, 'flash_out.txt')
+    with open(output_file, 'w') as outfh, open(stdout_file, 'w') as f:
+        adapter_run = subprocess.Popen(adapter_removal_command(read1, read2, num_threads,
+                                                               '/dev/stdout', None),
+                                       stdout=subprocess.PIPE)
+        # Make sure to turn lowercase overhang option -l on!
+        flash_run = subprocess.Popen(['flash',
+                                      '--interleaved-input', '-',
+                                      '-t', str(num_threads),
+                                      '-m', str(100),     # Minimum overlap length
+                                      '-M', str(300),     # Maximum overlap to be considered in scoring
+                                      '-lc'] +            # Lowercase overhang + merged reads to stdout
+                                      flash_options(compression, num_threads),
+                                     stdin=adapter_run.stdout,
+                                     stdout=outfh,
+                                     stderr=f
+                                    )
+        # Let AdapterRemoval get SIGPIPE if FLASH stops early
+        adapter_run.stdout.close()
+        flash_run.wait()
+        adapter_run.wait()
+    # If FLASH failed, AdapterRemoval was stopped by SIGPIPE
+    for process in (flash_run, adapter_run):
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+    logging.info('Flash finished successfully')
+    return output_file
+
+
 def main(args):
     if args.log_path:
         log_path = args.log_path
     else:
         log_path = args.output_path
-    run_flash(args.read1, args.read2, args.num_threads, args.output_path, log_path)
+    run_flash(args.read1, args.read2, args.num_threads, args.output_path, log_path, args.streaming,
+              args.compression)
     return None
 
 if __name__ == '__main__':
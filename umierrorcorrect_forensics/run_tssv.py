@@ -4,9 +4,9 @@ import subprocess
 import sys
 import os
 import logging
-import tempfile
 import shutil
 from umierrorcorrect.version import __version__
+from umierrorcorrect_forensics.compression import decompress_command
 
 def parseArgs():
     parser = argparse.ArgumentParser(description="TSSV separation of Simsenseq sequencing of forensics markers ")
@@ -18,6 +18,8 @@ def parseArgs():
                         help='Path to the Library file for TSSV, Required', required=True)
     parser.add_argument('-t', '--num_threads', dest='num_threads',
                         help='Number of threads to run the program on. Default=%(default)s', default='1')
+    parser.add_argument('--in_process', dest='in_process', action='store_true',
+                        help='Run the TSSV engine in-process, with a flank seed prefilter, instead of the fdstools command.')
     args = parser.parse_args(sys.argv[1:])
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
     logging.info('Starting TSSV')
@@ -53,51 +55,73 @@ def qc_plot_alignment(tssv_folder, out_folder):
     stat_df.to_csv(out_folder + "/statistics_preumi.csv")
 
 
-def run_tssv(fastq_file, library_file, num_threads, output_path, plot_qc = False):
-    # If fastq file is compressed, unzip to temp file.
-    if os.path.splitext(fastq_file)[-1] == '.gz':
-        (_, unzipped_fastq) = tempfile.mkstemp()
-        with open(unzipped_fastq, 'w') as uf:
-            gzip_run = subprocess.run(['gunzip',
-                                       '--to-stdout',
-                                       fastq_file],
-                                      stdout = uf
-                                     )
+def in_process_tssv():
+    """
+    Returns the in-process TSSV engine (see tssv_engine), or None if it
+    cannot run. tssv_engine is imported here, as it needs FDStools internals
+    that older FDStools versions do not have; without them, the command is run.
+    """
+    try:
+        from umierrorcorrect_forensics.tssv_engine import run_tssv_inprocess
+    except ImportError as e:
+        logging.warning(f'TSSV cannot run in-process ({e}), running the fdstools tssv command')
+        return None
+    return run_tssv_inprocess
+
+def run_tssv(fastq_file, library_file, num_threads, output_path, plot_qc = False, in_process = False):
+    run_tssv_inprocess = in_process_tssv() if in_process else None
+    if run_tssv_inprocess is not None:
+        # Compressed files are read directly, no temp file is needed.
+        run_tssv_inprocess(fastq_file, library_file, num_threads, output_path)
+        logging.info('TSSV finished successfully assigning reads to loci')
+    else:
+        run_tssv_command(fastq_file, library_file, num_threads, output_path)
+
+    if plot_qc:
+        qc_folder = os.path.join(output_path, 'qc_stats')
+        if not os.path.isdir(qc_folder):
+            os.mkdir(qc_folder)
+        qc_plot_alignment(output_path, qc_folder)
+    return None
 
-        if gzip_run.returncode == 0:
-            logging.info('Unzipped preprocessed fastq.gz file to {}'.format(unzipped_fastq))
-        else:
-            gzip_run.check_returncode()
-        fastq_file = unzipped_fastq
-        fastq_istempfile = True
+def run_tssv_command(fastq_file, library_file, num_threads, output_path):
+    # If fastq file is compressed, it is decompressed by a separate process
+    # and piped to TSSV, so decompression runs in parallel with alignment and
+    # no uncompressed copy is written to disk.
+    if os.path.splitext(fastq_file)[-1] == '.gz':
+        gzip_run = subprocess.Popen(decompress_command(fastq_file, num_threads),
+                                    stdout = subprocess.PIPE
+                                   )
+        tssv_input = '-'
+        tssv_stdin = gzip_run.stdout
+        logging.info('Streaming preprocessed fastq.gz file to TSSV')
     else:
-        fastq_istempfile = False
+        gzip_run = None
+        tssv_input = fastq_file
+        tssv_stdin = None
 
     tssv_run = subprocess.run(['fdstools', 'tssv',
                                 '--dir', output_path, # Output dir for verbose output
                                 '--indel-score', str(2),
                                 '--mismatches', str(0.1),
-                                '--num-threads', num_threads,
+                                '--num-threads', str(num_threads),
                                 library_file,         # Marker definitions file
-                                fastq_file],           # Input file
+                                tssv_input],          # Input file, or - for stdin
+                                stdin=tssv_stdin,
                                 stdout=subprocess.DEVNULL
                               )
-    if tssv_run.returncode == 0:
-        logging.info('TSSV finished successfully assigning reads to loci')
-        if fastq_istempfile:
-            os.remove(fastq_file)
-    else:
-        tssv_run.check_returncode()
-
-    if plot_qc:
-        qc_folder = os.path.join(output_path, 'qc_stats')
-        if not os.path.isdir(qc_folder):
-            os.mkdir(qc_folder)
-        qc_plot_alignment(output_path, qc_folder)
+    if gzip_run is not None:
+        # Let gunzip get SIGPIPE if TSSV stopped early
+        gzip_run.stdout.close()
+        gzip_run.wait()
+    tssv_run.check_returncode()
+    if gzip_run is not None and gzip_run.returncode != 0:
+        raise subprocess.CalledProcessError(gzip_run.returncode, gzip_run.args)
+    logging.info('TSSV finished successfully assigning reads to loci')
     return None
 
 def main(args):
-    run_tssv(args.read1, args.library_file, args.num_threads, args.output_path)
+    run_tssv(args.read1, args.library_file, args.num_threads, args.output_path, in_process=args.in_process)
     return None
 
 if __name__ == '__main__':
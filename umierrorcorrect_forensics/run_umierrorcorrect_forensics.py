@@ -7,25 +7,47 @@ import os
 import tempfile
 import shutil
 import logging
-from run_flash import run_flash
+import copy
+import time
+import traceback
+import multiprocessing
+import importlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from run_flash import run_flash, flash_scratch_files
 from umierrorcorrect.preprocess import run_preprocessing
-from run_tssv import run_tssv
+from run_tssv import run_tssv, qc_plot_alignment
 from umierrorcorrect.umi_error_correct import run_umi_errorcorrect
-from umierrorcorrect.filter_bam import filter_bam
-from umierrorcorrect.get_consensus_statistics import run_get_consensus_statistics
-from run_fdstools import run_fdstools
+from run_fdstools import run_fdstools, in_process_fdstools, tssv_threads
 from convert_fastq2bam import fastq2bam
-from convert_bam2fastq import bam2fastq
-from run_umifilter import run_umifilter
-from umierrorcorrect_forensics.tools.uncollapse_reads import uncollapse_reads
+from run_umifilter import accepted_families, load_model
+from fastq2sam import get_flanks_lib
 from umierrorcorrect_forensics.tools.downsample import downsample_reads
+from umierrorcorrect_forensics.family_store import family_store_for
+from umierrorcorrect_forensics.postprocess import postprocess_consensus, statistics_files
+from umierrorcorrect_forensics.family_features import get_repeat_lengths_lib
+from umierrorcorrect_forensics.compression import COMPRESSION_MODES, check_compression, preprocessing_gziptool
+from umierrorcorrect_forensics.checkpoint import Checkpoints
+from umierrorcorrect_forensics.metrics import RunMetrics, rusage, write_run_metrics
+from umierrorcorrect_forensics.profiling import PROFILE_DIR
+from umierrorcorrect_forensics.scheduler import run_graph
+from umierrorcorrect_forensics.resources import ResourceGovernor, ScratchSpace, SORT_MEMORY_PER_THREAD
+from umierrorcorrect_forensics.intermediates import Intermediates, scratch_estimate
+
+# State shared by all samples of a batch, set before the worker processes are forked.
+shared_state = None
+
+# UMIerrorcorrect settings that affect its outputs, for the checkpoint of the stage.
+UMIERRORCORRECT_PARAMS = ['consensus_method', 'consensus_frequency_threshold', 'indel_frequency_threshold',
+                          'position_threshold', 'edit_distance_threshold', 'include_singletons',
+                          'output_json', 'regions_from_bed']
 
 def parseArgs():
     parser = argparse.ArgumentParser(description="TSSV seperation of Simsenseq sequencing of forensics markers ")
     parser.add_argument('-o', '--output_path', dest='output_path',
                         help='Path to the output directory, required', required=True)
     parser.add_argument('-r1', '--read1', dest='read1',
-                        help='Path to first FASTQ file, R1, required', required=True)
+                        help='Path to first FASTQ file, R1, required unless a sample sheet is given')
     parser.add_argument('-r2', '--read2', dest='read2',
                         help='Path to second FASTQ file, R2 if applicable')
     parser.add_argument('-l', '--library', dest='library_file',
@@ -36,6 +58,12 @@ def parseArgs():
                         help='Path to first FDStools ini file, required', required=True)
     parser.add_argument('-g', '--reference', dest='reference_file',
                         help='reference genome', required=True)
+    parser.add_argument('-s', '--sample_sheet', dest='sample_sheet',
+                        help='Tab-separated file with one sample per line: R1 file and, if paired, R2 file. \
+                            Runs all samples in one batch instead of -r1/-r2. Relative paths are relative to the sheet.')
+    parser.add_argument('--concurrent_samples', dest='concurrent_samples', type=int,
+                        help='Number of samples in a batch to run at the same time, each on up to -t threads. \
+                            0 runs as many as the threads of the node allow. [default = %(default)s]', default=1)
     parser.add_argument('-p', help='If fastq is paired', action='store_true')                    
     parser.add_argument('-c', '--consensus_method', dest='consensus_method',
                         help="Method for consensus generation. One of 'most_common', 'position' or 'MSA'. \
@@ -52,20 +80,58 @@ def parseArgs():
                         help='Probability threshold for the filtering model. [default=%(default)s].', default=0.95)
     parser.add_argument('-fthp', '--filter_threshold_path', dest='filter_threshold_path', 
                         help='Path to a tab-separated file with filter thresholds for each marker. Overrides -fth.')
+    parser.add_argument('--model_cache', dest='model_cache',
+                        help='Directory to cache compiled filtering models in. Default=~/.cache/umierrorcorrect_forensics/models')
     parser.add_argument('-t', '--num_threads', dest='num_threads',
-                        help='Number of threads to run the program on. Default=%(default)s', default='2')
+                        help='Most threads a stage of a sample runs on. Default=%(default)s', default='2')
+    parser.add_argument('--max_threads', dest='max_threads', type=int,
+                        help='Threads of all samples and stages of the run together. \
+                            Default is the CPUs of the node, under the cgroup (e.g. Slurm) CPU quota.')
+    parser.add_argument('--max_memory', dest='max_memory',
+                        help='Memory the stages of the run may reserve together, e.g. 16G. Default is 90%% \
+                            of the memory under the cgroup (e.g. Slurm) limit and the available memory of the node.')
+    parser.add_argument('--fused', dest='fused', action='store_true',
+                        help='Link the preprocessed reads to markers and write them to a BAM file in one pass, \
+                            without the intermediate TSSV fastq files.')
+    parser.add_argument('--stream_flash', dest='stream_flash', action='store_true',
+                        help='With paired ends, stream the reads from AdapterRemoval to FLASH through a pipe, \
+                            and keep the merged reads uncompressed.')
+    parser.add_argument('--compression', dest='compression', choices=COMPRESSION_MODES, default='gzip',
+                        help='Compression of intermediate files: gzip as the tools do by default, none, \
+                            fast (gzip level 1, pigz if installed) or bgzf (multi-threaded bgzip). Default=%(default)s')
+    parser.add_argument('--tssv_in_process', dest='tssv_in_process', action='store_true',
+                        help='Run the TSSV engine in-process, with a flank seed prefilter, instead of the fdstools command.')
+    parser.add_argument('--fdstools_in_process', dest='fdstools_in_process', action='store_true',
+                        help='Run the FDStools pipeline and stuttermark in-process, with the library and ini file read once, \
+                            instead of the fdstools commands.')
     parser.add_argument('-u', '--uncollapse', dest='uncollapse', 
-                        help='Provide uncollapsed FDStools output, useful for diversity evaluation', action='store_true')
+                        help='Provide uncollapsed FDStools output, useful for diversity evaluation. With --fdstools_in_process, \
+                            the consensus reads are counted by their family size instead of writing the uncollapsed reads.',
+                        action='store_true')
     parser.add_argument('--qcplots', dest='qcplots', 
                         help='Save qc plots and preumi.csv file. (requires Pandas, Matplotlib & Seaborn)', action='store_true')
     parser.add_argument('--downsample', dest='downsample', type=float,
                         help='Downsample the number of reads by this fraction. Useful for evaluation.')
     parser.add_argument('--sample_seed', dest='seed', type=int,
                         help='Seed for downsampling. For reproducability.')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Profile the stages, and write cProfile and collapsed stack files for flame graphs \
+                            to the profile directory in the output directory of each sample.')
+    parser.add_argument('--count_reads', dest='count_reads', action='store_true',
+                        help='Count the reads in the input and output files of each stage for run_metrics.json. \
+                            This reads each FASTQ and BAM file of the stages once more.')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Resume samples of an earlier run, skipping the stages whose outputs are still valid. \
+                            Checkpoints are saved in checkpoints.json in the output directory of each sample.')
     parser.add_argument('--keep', dest='keep_large_files', action='store_true', 
                         help="Keep large files. (circa 1.5 GB). Causes temp files to be written to output directory.")
+    parser.add_argument('--max_scratch', dest='max_scratch',
+                        help='Disk space for the temp files of the samples of a batch that run at the same time, \
+                            e.g. 100G. A sample waits to start until its estimated temp files fit. Default is no limit.')
     
     args = parser.parse_args(sys.argv[1:])
+    if not args.read1 and not args.sample_sheet:
+        parser.error('one of the arguments -r1/--read1 or -s/--sample_sheet is required')
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
     logging.info('Starting UMIerrorcorrect forensics')
     return(args)
@@ -117,7 +183,7 @@ def set_args_preprocessing(args, read_name, output_path, **kwargs):
     args.output_path = output_path
     args.sample_name = read_name
     args.mode = 'single'   # We do not use the double end read feature of umierrorcorrect
-    args.gziptool = 'gzip'
+    args.gziptool = preprocessing_gziptool(args.compression)
     args.umi_length = 12
     args.spacer_length = 16
     args.adapter_trimming = False
@@ -142,49 +208,215 @@ def set_args_umierrorcorrect(args, output_path, read_name, bam_file):
         args.include_singletons = False
     return args
 
-def main():
-    check_paths([args.read1, args.read2, args.bed_file, args.ini_file, args.bed_file, args.filter_model])
-    # Create output dir
+def read_sample_sheet(sample_sheet, paired):
+    """
+    Reads a sample sheet and returns a list of (read1, read2) tuples. Empty
+    lines and lines starting with # are skipped.
+    """
+    samples = []
+    sheet_dir = os.path.dirname(os.path.abspath(sample_sheet))
+    with open(sample_sheet) as fh:
+        for line in fh:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            fields = [os.path.join(sheet_dir, f) for f in line.split("\t")]
+            if paired and len(fields) < 2:
+                raise ValueError(f"Sample sheet line '{line}' has no R2 file, but -p is set.")
+            samples.append((fields[0], fields[1] if paired else None))
+    return samples
+
+def sample_name(args, read1, read2):
     if args.p:
-        read_name = common_read_name(os.path.basename(args.read1),
-                                     os.path.basename(args.read2))
-    else:
-        read_name = os.path.basename(args.read1).split('.',1)[0]
+        return common_read_name(os.path.basename(read1), os.path.basename(read2))
+    return os.path.basename(read1).split('.',1)[0]
+
+def load_shared_state(args, governor):
+    """
+    Reads the files that are the same for all samples: flanks and repeat
+    lengths from the library file, the filter model, and the library and ini
+    file for in-process FDStools. The resource governor of the run is shared
+    as well.
+    """
+    state = {"flanks": get_flanks_lib(args.library_file),
+             "repeat_lengths": get_repeat_lengths_lib(args.library_file),
+             "model": None,
+             "fdstools": None,
+             "governor": governor}
+    if args.filter_model:
+        state["model"] = load_model(args.filter_model, args.model_cache)
+    if args.fdstools_in_process:
+        state["fdstools"] = in_process_fdstools(args.ini_file, args.library_file)
+    return state
+
+def fused_available():
+    """
+    Returns True if the fused path can run. It uses the in-process TSSV
+    engine, which needs FDStools internals that older FDStools versions do
+    not have, so it is imported here rather than with the driver.
+    """
+    try:
+        importlib.import_module("umierrorcorrect_forensics.fused_fastq2bam")
+    except ImportError as e:
+        logging.warning(f'The fused path cannot run ({e}), running TSSV and fastq2bam instead')
+        return False
+    return True
+
+def link_reads_fused(args, fastq_file, bam_file, tssv_output_path, output_path, trim_flanks, flanks, num_threads):
+    """Links reads to markers and writes them to a BAM file in one pass, without TSSV's fastq files."""
+    from umierrorcorrect_forensics.fused_fastq2bam import fused_fastq2bam
+    bam_file = fused_fastq2bam(fastq_file, bam_file, args.bed_file,
+                               args.library_file, tssv_output_path, trim_flanks,
+                               num_threads, flanks=flanks)
+    shutil.copy(os.path.join(tssv_output_path, "statistics.csv"), os.path.join(output_path, "statistics_preumi.csv"))
+    return bam_file
+
+def link_reads_tssv(args, fastq_file, tssv_output_path, output_path, num_threads):
+    """Alignment of reads to markers by TSSV"""
+    run_tssv(fastq_file, args.library_file, num_threads, tssv_output_path,
+             in_process=args.tssv_in_process)
+    shutil.copy(os.path.join(tssv_output_path, "statistics.csv"), os.path.join(output_path, "statistics_preumi.csv"))
+    return tssv_output_path
+
+def run_postprocess(args, consensus_bam_file, json_file_path, mlfilter_bam_file, filtered_bam_file,
+                    consensus_fastq_file, stats_file, output_path, read_name, shared, num_threads):
+    """
+    Applies the ML filter, if a model is given, and the UMI member threshold
+    to the consensus reads, and counts them, in one pass over the consensus
+    BAM file (see postprocess).
+    """
+    accepted = None
+    if args.filter_model:
+        # The filter reads the UMI families from a compact binary copy of the JSON file, made once
+        # per JSON file, so that the filter does not parse it again when rerun (see family_store).
+        family_store = family_store_for(json_file_path)
+        accepted = accepted_families(family_store, args.filter_model,
+                                     threshold=None if args.filter_threshold_path else args.filter_threshold,
+                                     thresholds_path=args.filter_threshold_path,
+                                     library_file=args.library_file,
+                                     model_cache=args.model_cache,
+                                     model=shared["model"],
+                                     repeat_lengths=shared["repeat_lengths"])
+    return postprocess_consensus(consensus_bam_file, filtered_bam_file, consensus_fastq_file, stats_file,
+                                 output_path, read_name, args.umi_member_threshold, accepted,
+                                 mlfilter_bam_file if args.filter_model else None,
+                                 num_threads=num_threads)
+
+def run_umierrorcorrect_threads(args, num_threads):
+    """Runs UMIerrorcorrect with the number of threads given to the stage."""
+    args = copy.copy(args)
+    args.num_threads = str(num_threads)
+    return run_umi_errorcorrect(args)
+
+def run_qc_plots(tssv_output_path, qc_folder):
+    os.makedirs(qc_folder, exist_ok=True)
+    qc_plot_alignment(tssv_output_path, qc_folder)
+    return qc_folder
+
+def run_uncollapse(args, consensus_fastq_file, uncollapsed_path, output_path, fdstools, num_threads):
+    """
+    Runs FDStools on the uncollapsed consensus reads. In-process, they are
+    counted by their family size without writing uncollapsed_path. Returns
+    the uncollapsed FASTQ file if it was written.
+    """
+    return run_fdstools(consensus_fastq_file, args.library_file, args.ini_file, output_path, verbose=False,
+                        in_process=args.fdstools_in_process, fdstools=fdstools, uncollapsed_file=uncollapsed_path,
+                        num_threads=num_threads)
+
+def fdstools_outputs(fastq_file):
+    return [os.path.splitext(fastq_file)[0] + '.csv', os.path.splitext(fastq_file)[0] + '_stutter.csv']
+
+def run_sample(args, read1, read2, shared=None, tmp_root=None, release_scratch=None):
+    """
+    Runs the full pipeline on one sample. The args are copied, as the
+    UMIerrorcorrect steps take their settings from them. Files read once
+    for a batch, and the resource governor that hands out the threads and
+    memory of the stages, are given in shared (see load_shared_state). Temp files
+    are written in tmp_root, if given, and each is removed when the last
+    stage that reads it has finished (see intermediates). release_scratch
+    is called when the temp files are gone. With args.resume, each stage is
+    skipped if its checkpoint from an earlier run is valid (see checkpoint).
+    The performance of each stage is saved to run_metrics.json (see metrics),
+    and with args.profile the stages are profiled (see profiling).
+    """
+    args = copy.copy(args)
+    args.read1 = read1
+    args.read2 = read2
+    if shared is None:
+        shared = {"flanks": None, "repeat_lengths": None, "model": None, "fdstools": None,
+                  "governor": ResourceGovernor(args.max_threads, args.max_memory)}
+        shared["governor"].log_budget()
+    governor = shared["governor"]
+    num_threads = int(args.num_threads)
+    check_paths([args.read1, args.read2])
+    read_name = sample_name(args, args.read1, args.read2)
+    # Create output dir
     output_path = make_outputdir(args.output_path, read_name)
+    metrics = RunMetrics(output_path, args.count_reads)
+    profile_path = os.path.join(output_path, PROFILE_DIR) if args.profile else None
+    checkpoints = Checkpoints(output_path, args.resume, metrics, profile_path)
 
     # Create temp dir
-    if args.keep_large_files:
+    if args.keep_large_files or args.resume:
+        # Temp files must keep their paths between runs to be resumed
         tmp_dir = os.path.join(output_path, "tmp")
-        os.mkdir(tmp_dir)
+        os.makedirs(tmp_dir, exist_ok=True)
     else:
-        tmp_dir = tempfile.mkdtemp()
+        tmp_dir = tempfile.mkdtemp(dir=tmp_root)
+    intermediates = Intermediates(enabled=not args.keep_large_files)
 
     # If asked to downsample reads, do that and save into temp folder. 
+    # The stages up to the preprocessing run one after another, each on the threads it gets from the governor.
     if args.downsample: 
         logging.info('Downsampling input reads by factor ' + str(args.downsample))
-        if args.p: 
-            read1, read2 = downsample_reads(frac=args.downsample, 
-                                            read1=args.read1, 
-                                            read2=args.read2, 
-                                            output_path=tmp_dir, 
-                                            seed = args.seed)
-        else: 
-            read1 = downsample_reads(frac=args.downsample, 
-                                     read1=args.read1, 
-                                      output_path=tmp_dir,
-                                      seed = args.seed)
+        # Downsampled reads are written uncompressed by default
+        compression = 'none' if args.compression == 'gzip' else args.compression
+        downsample_params = {"fraction": args.downsample, "seed": args.seed, "compression": compression}
+        with governor.reserve(num_threads) as threads:
+            if args.p: 
+                read1, read2 = checkpoints.run("downsample",
+                                               partial(downsample_reads, frac=args.downsample, 
+                                                       read1=args.read1, 
+                                                       read2=args.read2, 
+                                                       output_path=tmp_dir, 
+                                                       seed = args.seed,
+                                                       compression = compression,
+                                                       num_threads = threads),
+                                               [args.read1, args.read2], downsample_params, list)
+            else: 
+                read1 = checkpoints.run("downsample",
+                                        partial(downsample_reads, frac=args.downsample, 
+                                                read1=args.read1, 
+                                                output_path=tmp_dir,
+                                                seed = args.seed,
+                                                compression = compression,
+                                                num_threads = threads),
+                                        [args.read1], downsample_params, lambda result: [result])
         logging.info('Selected reads saved in ' + read1 + ' etc.')
+        intermediates.add(read1, ["flash" if args.p else "preprocessing"])
+        intermediates.add(read2, ["flash"])
     else: 
         read1 = args.read1
         read2 = args.read2
 
     # If paired ends, combine reads into single reads using FLASH
     if args.p:
-        merged_reads_file = run_flash(read1,
-                                      read2,
-                                      args.num_threads,
-                                      tmp_dir,
-                                      output_path)
+        with governor.reserve(num_threads) as threads:
+            merged_reads_file = checkpoints.run("flash",
+                                                partial(run_flash, read1,
+                                                        read2,
+                                                        str(threads),
+                                                        tmp_dir,
+                                                        output_path,
+                                                        args.stream_flash,
+                                                        args.compression),
+                                                [read1, read2],
+                                                {"stream": args.stream_flash, "compression": args.compression},
+                                                lambda result: [result])
+        intermediates.add(merged_reads_file, ["preprocessing"])
+        for path in flash_scratch_files(tmp_dir, args.compression):
+            intermediates.add(path, ["flash"])
+        intermediates.finished("flash")
         args_preprocessing = set_args_preprocessing(args, read_name,
                                                     tmp_dir,
                                                     tmpdir=tmp_dir,
@@ -192,70 +424,263 @@ def main():
     else:
         args_preprocessing = set_args_preprocessing(args, read_name,
                                                     tmp_dir,
-                                                    tmpdir=tmp_dir)
+                                                    tmpdir=tmp_dir,
+                                                    reads_file=read1)
 
-    # Preprocessing using the UMIec preprocessor 
-    (fastq_file_umi_in_header, nseqs) = run_preprocessing(args_preprocessing)
+    # Preprocessing using the UMIec preprocessor. The args are copied, as
+    # they are changed for UMIerrorcorrect before the stage could be rerun.
+    args_preprocessing = copy.copy(args_preprocessing)
+    with governor.reserve(num_threads) as threads:
+        args_preprocessing.num_threads = str(threads)
+        (fastq_file_umi_in_header, nseqs) = checkpoints.run("preprocessing",
+                                                            partial(run_preprocessing, args_preprocessing),
+                                                            [args_preprocessing.read1],
+                                                            {"umi_length": args_preprocessing.umi_length,
+                                                             "spacer_length": args_preprocessing.spacer_length,
+                                                             "mode": args_preprocessing.mode},
+                                                            lambda result: result[0])
     fastq_file_umi_in_header = fastq_file_umi_in_header[0]
+    intermediates.finished("preprocessing")
 
-    # Alignment of reads to markers by TSSV
     tssv_output_path = os.path.join(tmp_dir, "tssv_output")
-    run_tssv(fastq_file_umi_in_header, args.library_file, args.num_threads, tssv_output_path, args.qcplots)
-    shutil.copy(os.path.join(tssv_output_path, "statistics.csv"), os.path.join(output_path, "statistics_preumi.csv"))
-
-    # Convert to fastq data to BAM file
-    # Paired end reads are already trimmed before FLASH, so skip trimming here in that case.
+    # Next to the TSSV output rather than in it, as it is written while the BAM file is made from that
+    qc_folder = os.path.join(tmp_dir, "qc_stats")
     bam_file = os.path.join(tmp_dir, read_name + '.bam')
+    preumi_stats_file = os.path.join(output_path, "statistics_preumi.csv")
+    json_file_path = os.path.join(output_path, read_name + '_umi_families.json')
+    consensus_bam_file = os.path.join(output_path, read_name + '_consensus_reads.bam')
+    mlfilter_bam_file = os.path.join(output_path, read_name + '_mlfiltered_consensus_reads.bam')
+    filtered_bam_file = os.path.join(output_path, read_name + '_filtered_consensus_reads.bam')
+    stats_file = os.path.join(output_path, read_name + '.hist')
+    consensus_fastq_file = os.path.join(output_path, read_name + '_filtered_consensus_reads.fq')
+    uncollapsed_path = os.path.join(output_path, read_name + '_uncollapsed_consensus_reads.fq')
+    # Paired end reads are already trimmed before FLASH, so skip trimming here in that case.
     trim_flanks = not args.p
-    bam_file = fastq2bam(tssv_output_path, bam_file, args.bed_file,
-                         args.library_file, trim_flanks,
-                         args.num_threads)
-    
+
+    # The remaining stages are run as a dependency graph, so that independent
+    # stages run at the same time, within the budget of the governor (see
+    # scheduler). Stages that use threads are given func(threads), with the
+    # number of threads the governor gives them, and their most threads.
+    # The intermediates a stage was the last to read are removed after it.
+    stages = []
+    def add_stage(name, func, inputs, params, outputs, after=(), threads=None, memory_per_thread=0):
+        def run_stage(granted):
+            result = checkpoints.run(name, func(granted) if threads else func, inputs, params, outputs)
+            intermediates.finished(name)
+            return result
+        stages.append({"name": name,
+                       "func": run_stage,
+                       "after": list(after),
+                       "threads": threads or 1,
+                       "memory_per_thread": memory_per_thread})
+
+    # The QC plots are listed right after the linking, so that they are started before the BAM file stage.
+    # They read statistics.csv in the TSSV output, but depend on the folder, as that is the output of the
+    # linking stage, so that the digest of a removed folder is known on resume.
+    def add_qc_plots(link_stage):
+        if args.qcplots:
+            add_stage("qc_plots", partial(run_qc_plots, tssv_output_path, qc_folder),
+                      [tssv_output_path], {},
+                      lambda result: [result],
+                      after=[link_stage])
+
+    if args.fused:
+        add_stage("fused_fastq2bam",
+                  lambda threads: partial(link_reads_fused, args, fastq_file_umi_in_header, bam_file,
+                                          tssv_output_path, output_path, trim_flanks, shared["flanks"],
+                                          threads),
+                  [fastq_file_umi_in_header, args.library_file, args.bed_file],
+                  {"trim_flanks": trim_flanks},
+                  lambda result: [result, result + '.bai', tssv_output_path, preumi_stats_file],
+                  threads=num_threads)
+        add_qc_plots("fused_fastq2bam")
+        bam_stage = "fused_fastq2bam"
+    else:
+        add_stage("tssv",
+                  lambda threads: partial(link_reads_tssv, args, fastq_file_umi_in_header,
+                                          tssv_output_path, output_path, threads),
+                  [fastq_file_umi_in_header, args.library_file], {},
+                  lambda result: [result, preumi_stats_file],
+                  threads=num_threads)
+        add_qc_plots("tssv")
+        # Convert to fastq data to BAM file
+        add_stage("fastq2bam",
+                  lambda threads: partial(fastq2bam, tssv_output_path, bam_file, args.bed_file,
+                                          args.library_file, trim_flanks,
+                                          threads, flanks=shared["flanks"]),
+                  [tssv_output_path, args.library_file, args.bed_file],
+                  {"trim_flanks": trim_flanks},
+                  lambda result: [result, result + '.bai'],
+                  after=["tssv"], threads=num_threads)
+        bam_stage = "fastq2bam"
+
     # Run UMIerrorcorrects
-    args_umierrrorcorrect = set_args_umierrorcorrect(args, output_path, read_name, bam_file)
-    run_umi_errorcorrect(args_umierrrorcorrect)
-    if not args.keep_large_files:
+    args_umierrrorcorrect = copy.copy(set_args_umierrorcorrect(args, output_path, read_name, bam_file))
+    umierrorcorrect_outputs = [consensus_bam_file, consensus_bam_file + '.bai',
+                               os.path.join(output_path, read_name + '_cons.tsv')]
+    if args_umierrrorcorrect.output_json:
+        umierrorcorrect_outputs.append(json_file_path)
+    add_stage("umierrorcorrect",
+              lambda threads: partial(run_umierrorcorrect_threads, args_umierrrorcorrect, threads),
+              [bam_file, args.reference_file, args.bed_file],
+              {name: getattr(args_umierrrorcorrect, name, None) for name in UMIERRORCORRECT_PARAMS},
+              lambda result: umierrorcorrect_outputs,
+              after=[bam_stage], threads=num_threads,
+              # It sorts the consensus reads with samtools on all its threads
+              memory_per_thread=SORT_MEMORY_PER_THREAD)
+    # The intermediates of the stages below, with the stages that read them
+    link_stage = "fused_fastq2bam" if args.fused else "tssv"
+    intermediates.add(fastq_file_umi_in_header, [link_stage])
+    tssv_consumers = ["qc_plots"] if args.qcplots else []
+    if not args.fused:
+        tssv_consumers.append("fastq2bam")
+    intermediates.add(tssv_output_path, tssv_consumers or [link_stage])
+    intermediates.add(bam_file, ["umierrorcorrect"])
+
+    def remove_temp_files(threads):
         shutil.rmtree(tmp_dir)
+        if release_scratch:
+            release_scratch()
+    if not args.keep_large_files:
+        stages.append({"name": "remove_temp_files",
+                       "func": remove_temp_files,
+                       "after": ["umierrorcorrect"] + (["qc_plots"] if args.qcplots else []),
+                       "threads": 1})
 
-    json_file_path = os.path.join(output_path, read_name + '_umi_families.json')
-    consensus_bam_file = os.path.join(output_path, read_name + '_consensus_reads.bam')
-    
+    # Filter and count the consensus reads, and write them to a fastq file, in one pass
+    postprocess_inputs = [consensus_bam_file, stats_file]
+    postprocess_outputs = [filtered_bam_file, consensus_fastq_file] + statistics_files(output_path, read_name)
     if args.filter_model:
-        mlfilter_bam_file = os.path.join(output_path, read_name + '_mlfiltered_consensus_reads.bam')
-        if args.filter_threshold_path: 
-            consensus_bam_file = run_umifilter(consensus_bam_file, json_file_path, 
-                                        args.filter_model, mlfilter_bam_file,
-                                        thresholds_path=args.filter_threshold_path)
-        else:
-            consensus_bam_file = run_umifilter(consensus_bam_file, json_file_path, 
-                                        args.filter_model, mlfilter_bam_file,
-                                        threshold=args.filter_threshold)
+        postprocess_inputs += [json_file_path, args.filter_model, args.filter_threshold_path, args.library_file]
+        postprocess_outputs += [mlfilter_bam_file, mlfilter_bam_file + '.bai']
+    add_stage("postprocess",
+              lambda threads: partial(run_postprocess, args, consensus_bam_file, json_file_path, mlfilter_bam_file,
+                                      filtered_bam_file, consensus_fastq_file, stats_file, output_path,
+                                      read_name, shared, threads),
+              postprocess_inputs,
+              {"umi_member_threshold": args.umi_member_threshold,
+               "filter_model": bool(args.filter_model),
+               "threshold": args.filter_threshold},
+              lambda result: postprocess_outputs,
+              after=["umierrorcorrect"], threads=num_threads)
 
-    filtered_bam_file = os.path.join(output_path, read_name + '_filtered_consensus_reads.bam')
-    filter_bam(consensus_bam_file, filtered_bam_file, args.umi_member_threshold)
-
-    # Calculate UMIerrorcorrect statistics
-    stats_file = os.path.join(output_path, read_name + '.hist')
-    run_get_consensus_statistics(output_path,
-                                 consensus_bam_file,
-                                 stats_file,
-                                 True,
-                                 read_name)
-
-    # Convert to Fastq file and then run FDStools to assign reads to alleles
-    consensus_fastq_file = os.path.join(output_path, read_name + '_filtered_consensus_reads.fq')
-    bam2fastq(filtered_bam_file, consensus_fastq_file, num_threads=args.num_threads)
-    run_fdstools(consensus_fastq_file, args.library_file, args.ini_file, output_path, verbose=False)
-    logging.info('Finished generating consensus sequences!')
+    # Run FDStools to assign reads to alleles. TSSV runs on the threads the governor gives the stage,
+    # at most those of the ini file.
+    fdstools_threads = min(tssv_threads(args.ini_file), num_threads)
+    add_stage("fdstools",
+              lambda threads: partial(run_fdstools, consensus_fastq_file, args.library_file, args.ini_file,
+                                      output_path, verbose=False, in_process=args.fdstools_in_process,
+                                      fdstools=shared["fdstools"], num_threads=threads),
+              [consensus_fastq_file, args.library_file, args.ini_file], {},
+              lambda result: fdstools_outputs(consensus_fastq_file),
+              after=["postprocess"], threads=fdstools_threads)
 
     # If desired, the pipeline can output uncollapsed reads files that can be used for diagnosis. 
     if args.uncollapse: 
-        logging.info("Generating uncollapsed read files (-u option activated)...")
-        uncollapsed_path = os.path.join(output_path, read_name + '_uncollapsed_consensus_reads.fq')
-        uncollapse_reads(consensus_fastq_file, uncollapsed_path)
-        run_fdstools(uncollapsed_path, args.library_file, args.ini_file, output_path, verbose=False)
+        add_stage("uncollapse",
+                  lambda threads: partial(run_uncollapse, args, consensus_fastq_file, uncollapsed_path,
+                                          output_path, shared["fdstools"], threads),
+                  [consensus_fastq_file, args.library_file, args.ini_file], {},
+                  lambda result: ([result] if result else []) + fdstools_outputs(uncollapsed_path),
+                  after=["postprocess"], threads=fdstools_threads)
+
+    # Profiles of stages are only sampled in the main thread, so profiled stages are run one at a time
+    run_graph(stages, governor, parallel=not args.profile)
+    logging.info('Finished generating consensus sequences!')
+    if args.uncollapse:
         logging.info("Finished generating uncollapsed read files! ")
+    return read_name
+
+def run_batch_sample(args, sample):
+    """
+    Runs one sample of a batch and returns (sample name, error message),
+    with None as the message if it succeeded. Errors are logged and
+    returned, so that a failing sample does not stop the other samples.
+    Temp files of failed samples are removed as well.
+    """
+    (read1, read2) = sample
+    name = sample_name(args, read1, read2)
+    tmp_root = tempfile.mkdtemp()
+    try:
+        # Waits until the temp files of the sample fit in the scratch space
+        with shared_state["scratch"].reserve(scratch_estimate([read1, read2], args.downsample)) as release_scratch:
+            run_sample(args, read1, read2, shared_state, tmp_root, release_scratch)
+        return (name, None)
+    except (Exception, SystemExit) as e:
+        logging.error(f'Sample {name} failed:\n' + traceback.format_exc())
+        return (name, f'{type(e).__name__}: {e}')
+    finally:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+
+def run_batch(args):
+    """
+    Runs all samples of the sample sheet, concurrent_samples at a time.
+    The library, flanks and filter model are read once, before the worker
+    processes are forked, so that the workers share them, and the resource
+    governor, so that the samples share one budget. Writes a summary
+    of the batch to batch_summary.tsv in the output directory and returns
+    the number of failed samples.
+    """
+    global shared_state
+    samples = read_sample_sheet(args.sample_sheet, args.p)
+    names = [sample_name(args, read1, read2) for (read1, read2) in samples]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError(f"Sample names must be unique in a batch, found duplicates: {', '.join(duplicates)}")
+    governor = ResourceGovernor(args.max_threads, args.max_memory)
+    governor.log_budget()
+    concurrent_samples = args.concurrent_samples
+    if concurrent_samples <= 0:
+        # As many samples as can run their stages on -t threads each
+        concurrent_samples = max(governor.threads // int(args.num_threads), 1)
+    concurrent_samples = min(concurrent_samples, len(samples))
+    logging.info(f'Running {len(samples)} samples, {concurrent_samples} at a time')
+    shared_state = load_shared_state(args, governor)
+    shared_state["scratch"] = ScratchSpace(args.max_scratch)
+
+    if concurrent_samples <= 1:
+        results = [run_batch_sample(args, sample) for sample in samples]
+    else:
+        # Fork, so that the workers inherit the shared state without pickling it.
+        with ProcessPoolExecutor(max_workers=concurrent_samples,
+                                 mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = [executor.submit(run_batch_sample, args, sample) for sample in samples]
+            results = []
+            for name, future in zip(names, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # The worker process died, e.g. killed when out of memory
+                    logging.error(f'Sample {name} failed: {e}')
+                    results.append((name, f'{type(e).__name__}: {e}'))
+
+    os.makedirs(args.output_path, exist_ok=True)
+    with open(os.path.join(args.output_path, "batch_summary.tsv"), "w") as fh:
+        fh.write("sample\tstatus\terror\n")
+        for name, error in results:
+            fh.write(f"{name}\t{'failed' if error else 'ok'}\t{error or ''}\n")
+    n_failed = sum(1 for _, error in results if error)
+    logging.info(f'Finished batch: {len(samples) - n_failed} samples succeeded, {n_failed} failed')
+    return n_failed
+
+def main(args):
+    check_paths([args.bed_file, args.ini_file, args.library_file, args.filter_model, args.sample_sheet])
+    check_compression(args.compression)
+    if args.fused and not fused_available():
+        args.fused = False
+    start = time.perf_counter()
+    if args.sample_sheet:
+        names = [sample_name(args, read1, read2) for (read1, read2) in read_sample_sheet(args.sample_sheet, args.p)]
+        n_failed = run_batch(args)
+    else:
+        names = [run_sample(args, args.read1, args.read2)]
+        n_failed = 0
+    # The stage metrics of all samples, in one file for the run
+    write_run_metrics(args.output_path, {name: os.path.join(args.output_path, name) for name in names},
+                      time.perf_counter() - start, rusage()[0])
+    if n_failed > 0:
+        sys.exit(1)
 
 if __name__ == '__main__':
     args = parseArgs()
-    main()
+    main(args)
@@ -1,28 +1,43 @@
 import argparse
 import sys
-import os
 import logging
 import numpy as np
 import pandas as pd
-import pickle
 import pysam
-import lzma
+import umierrorcorrect_forensics.family_features as ff
+import umierrorcorrect_forensics.family_store as fs
+import umierrorcorrect_forensics.model_cache as mc
+from umierrorcorrect_forensics.family_store import iter_json
+from umierrorcorrect_forensics.metrics import ReadProgress
+from umierrorcorrect_forensics.profiling import profile_main
+
+DEFAULT_CHUNKSIZE = 100000
 
 def parseArgs():
     parser = argparse.ArgumentParser(description="Applies an model to filter UMI families.")
     parser.add_argument('-i', '--input_path', dest='input_path',
                         help='Path to the input BAM file with consensus reads.', required=True)
     parser.add_argument('-j', '--json_path', dest='json_path',
-                        help='Path to the input json file with UMI family metadata.', required=True)
+                        help='Path to the input json file, or family store directory, with UMI family metadata.', required=True)
     parser.add_argument('-o', '--output_path', dest='output_path',
                         help='Path to the output file.', required=True)
     parser.add_argument('-m', '--model_path', dest='model_path',
-                        help='Path to a pickle (or .xz) file with a Scikit-learn model to apply.', required=True)
+                        help='Path to a pickle (or .xz) file with a Scikit-learn model to apply, or a compiled .joblib model.', required=True)
     th_group = parser.add_mutually_exclusive_group(required=True)
     th_group.add_argument('-th', '--threshold', dest='threshold', type=float,
                         help='Classification threshold.')
     th_group.add_argument('-thp', '--thresholds_path', dest='thresholds_path',
                         help='Path to file with classification threshold per marker. Either -th or -thp are required.')
+    parser.add_argument('-l', '--library', dest='library_file',
+                        help='FDStools library file to get the repeat length of each marker from. 4 is used if unset.')
+    parser.add_argument('-t', '--num_threads', dest='num_threads', type=int,
+                        help='Number of threads for BAM compression and decompression. Default=%(default)s', default=1)
+    parser.add_argument('-c', '--chunksize', dest='chunksize', type=int,
+                        help='Number of UMI families to score at a time. Default=%(default)s', default=DEFAULT_CHUNKSIZE)
+    parser.add_argument('--model_cache', dest='model_cache',
+                        help='Directory to cache compiled models in. Default=$' + mc.CACHE_ENV_VARIABLE + ' or ~/.cache/umierrorcorrect_forensics/models')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Profile the filter, and write the profile files to a profile directory next to the output file.')
     args = parser.parse_args(sys.argv[1:])
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
     return(args)
@@ -47,6 +62,86 @@ def read_json(json_path):
     df_json["marker"] = df_json["Annotation"].apply(lambda x: x[2])
     return df_json
 
+def read_json_chunks(json_path, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Reads a JSON file with UMI families in DataFrames of at most chunksize
+    families each, with the same columns as read_json.
+    """
+    chunk = []
+    for family in iter_json(json_path):
+        chunk.append(family)
+        if len(chunk) == chunksize:
+            yield json_records_to_df(chunk)
+            chunk = []
+    if chunk:
+        yield json_records_to_df(chunk)
+
+def json_records_to_df(records):
+    df_json = pd.DataFrame.from_records(records)
+    df_json["UMI"] = df_json["Name"].str.split("_", expand=True)[3]
+    df_json["marker"] = df_json["Annotation"].apply(lambda x: x[2])
+    return df_json
+
+def read_json_feature_chunks(json_path, chunksize=DEFAULT_CHUNKSIZE, repeat_lengths=None):
+    """
+    Reads the UMI families in a JSON file in one pass, and returns a list of
+    DataFrames of at most chunksize families with their features calculated.
+    Only the features are kept of each chunk, not the sequences, and the
+    family sizes are summed on the way, as normalized_count needs the
+    average family size of all families.
+    """
+    chunks = []
+    n_families = 0
+    total_count = 0
+    for df_json in read_json_chunks(json_path, chunksize):
+        df_features = calc_features(df_json, repeat_lengths, mean_count=1).drop(columns=["Members", "Consensus"])
+        n_families += len(df_features)
+        total_count += int(df_features["total_count"].sum())
+        chunks.append(df_features)
+    if n_families:
+        mean_count = total_count / n_families
+        for df_features in chunks:
+            df_features["normalized_count"] = df_features["total_count"] / mean_count
+    return chunks
+
+def read_store_chunks(store_path, chunksize=DEFAULT_CHUNKSIZE, repeat_lengths=None):
+    """
+    Reads the UMI families in a family store (see family_store) and yields
+    DataFrames of at most chunksize families with their features calculated.
+    Only the columns needed for the features are read from the store.
+    """
+    meta = fs.read_meta(store_path)
+    markers = np.array(meta["markers"], dtype=object)
+    contigs = np.array(meta["contigs"], dtype=object)
+    marker_repeat = ff.marker_repeat_lengths(meta["markers"], repeat_lengths)
+    total_count = fs.open_column(store_path, "total_count")
+    mean_count = total_count.mean()
+    marker = fs.open_column(store_path, "marker")
+    contig = fs.open_column(store_path, "contig")
+    cons_len = fs.open_column(store_path, "cons_len")
+    member_offsets = fs.open_column(store_path, "member_offsets")
+    member_len = fs.open_column(store_path, "member_len")
+    member_count = fs.open_column(store_path, "member_count")
+
+    for start in range(0, meta["n_families"], chunksize):
+        stop = min(start + chunksize, meta["n_families"])
+        first, last = member_offsets[start], member_offsets[stop]
+        family_idx = np.repeat(np.arange(stop - start), np.diff(member_offsets[start:stop + 1]))
+        features = ff.member_features(family_idx,
+                                      np.asarray(member_len[first:last], dtype=np.int64),
+                                      np.asarray(member_count[first:last], dtype=np.int64),
+                                      cons_len[start:stop],
+                                      marker_repeat[marker[start:stop]])
+        df_features = pd.DataFrame({"Name": fs.read_names(store_path, start, stop),
+                                    "Contig": contigs[contig[start:stop]].tolist()})
+        df_features["UMI"] = df_features["Name"].str.split("_", expand=True)[3]
+        df_features["marker"] = markers[marker[start:stop]].tolist()
+        df_features["total_count"] = np.asarray(total_count[start:stop], dtype=np.int64)
+        df_features["normalized_count"] = df_features["total_count"] / mean_count
+        for name in ff.MEMBER_FEATURES:
+            df_features[name] = features[name]
+        yield df_features
+
 def get_shorter_longer(umi_fam, get_proportions=True): 
     '''Returns number of shorter, same length and longer than consensus members in each UMI family.'''
     n_reads_per_seq = sorted(list(umi_fam["Members"].values()))
@@ -96,49 +191,69 @@ def get_stutterprops(umi_fam, repeat_length, get_proportions=True):
         output = [val/total_reads for val in output]
     return output
 
-def calc_features(df_json):
-    """Adds features to the DataFrame with UMI families."""
+def calc_features(df_json, repeat_lengths=None, mean_count=None):
+    """
+    Adds features to the DataFrame with UMI families. The members of all
+    families are flattened once and the features calculated with vectorized
+    reductions, see family_features. repeat_lengths is a dict with the repeat
+    unit length of each marker, 4 is used for markers not in it. mean_count
+    is the average family size used for normalized_count, by default the
+    average in df_json.
+    """
     df_features = df_json
 
     # Number of members per UMI group, and number of members compared to average group size
     df_features["total_count"] = df_features["Name"].str.split("=", expand=True)[1].astype(int)
-    df_features["normalized_count"] = df_features["total_count"] / df_features["total_count"].mean()
+    if mean_count is None:
+        mean_count = df_features["total_count"].mean()
+    df_features["normalized_count"] = df_features["total_count"] / mean_count
 
-    # Purity, propotion longer, shorter etc
-    df_features[["purity", "unpurity", "prop_shorter", "prop_samelength", "prop_longer",\
-        "prop_n_variants", "cons_len"]] = df_features.apply(get_shorter_longer, axis=1, result_type="expand")
-    df_features["diff_longer_shorter"] = (df_features["prop_longer"]-df_features["prop_shorter"])
-
-    # Stutter proportion. TODO: Currently only supports markers with repeat length of 4! Fix please. 
-    df_features[["prop_minus1", "prop_minus2", "prop_plus1"]] = df_features.apply(get_stutterprops, axis=1, result_type="expand", repeat_length=4)
+    # Purity, propotion longer, shorter, stutter proportions etc
+    family_idx, lengths, counts = ff.flatten_members(df_features["Members"].tolist())
+    cons_len = df_features["Consensus"].str.len().to_numpy()
+    repeat_length = ff.marker_repeat_lengths(df_features["marker"], repeat_lengths)
+    features = ff.member_features(family_idx, lengths, counts, cons_len, repeat_length)
+    for name in ff.MEMBER_FEATURES:
+        df_features[name] = features[name]
     return df_features
 
 def adjust_mlscores(cons_len, k, m):
     '''Adjusts the scores returned by the ML model counter length bias.'''
     return k*cons_len + m
 
-def apply_filter(df_json, model_path, threshold=None, threshold_path=None):
-    """Applies model to UMI families and returns those who passed."""
-    df_json = calc_features(df_json)
+def load_model(model_path, cache_dir=None):
+    """Reads an ML model, through the compiled model cache (see model_cache)."""
+    return mc.load_model(model_path, cache_dir)
 
-    # Read ML model. TODO: Change from pickle format to ONNX or PMML. 
-    if os.path.splitext(model_path)[1] == ".xz":
-        with lzma.open(model_path, "rb") as f: 
-            model = pickle.load(f)
+def apply_filter(df_json, model_path, threshold=None, threshold_path=None, repeat_lengths=None):
+    """Applies model to UMI families and returns those who passed."""
+    model = load_model(model_path)
+    if threshold_path:
+        threshold_dict = read_thresholds(threshold_path)
     else:
-        with open(model_path, "rb") as f: 
-            model = pickle.load(f)
+        threshold_dict = None
+    return filter_families(df_json, model, threshold, threshold_dict, repeat_lengths)
 
+def filter_families(df_json, model, threshold=None, threshold_dict=None, repeat_lengths=None, mean_count=None):
+    """
+    Calculates features, applies a loaded model to UMI families and returns
+    those who passed. mean_count is the average family size of the sample,
+    which must be given when df_json holds only part of the families.
+    """
+    df_json = calc_features(df_json, repeat_lengths, mean_count)
+    return score_families(df_json, model, threshold, threshold_dict)
+
+def score_families(df_features, model, threshold=None, threshold_dict=None):
+    """Applies a loaded model to UMI families with features and returns those who passed."""
     if isinstance(model, dict):
-        probabilities = predict_proba_model_dict(model, df_json)
+        probabilities = predict_proba_model_dict(model, df_features)
     else:
-        probabilities = model.predict_proba(df_json)
+        probabilities = model.predict_proba(df_features)
 
-    if threshold_path:
-        threshold_dict = read_thresholds(threshold_path)
-        df_out = filter_thresholds_dict(df_json, probabilities[:,0], threshold_dict)
+    if threshold_dict is not None:
+        df_out = filter_thresholds_dict(df_features, probabilities[:,0], threshold_dict)
     else:
-        df_out = df_json.loc[probabilities[:,0] >= threshold, :]
+        df_out = df_features.loc[probabilities[:,0] >= threshold, :]
     return df_out
 
 def predict_proba_model_dict(model_dict, df):
@@ -172,15 +287,24 @@ def filter_thresholds_dict(df, probabilites, threshold_dict):
     return df.loc[df.keep].drop(columns=["p", "keep"])
 
 
-def filter_bamfile(infilename, outfilename, acceptedfams):
-    """Reads/writes BAM-file while removing those UMI families that are not in list."""
+def filter_bamfile(infilename, outfilename, acceptedfams, num_threads=1):
+    """
+    Reads/writes BAM-file while removing those UMI families that are not in list.
+    Membership is looked up in a set built once from the accepted families, and
+    BGZF decompression and compression are spread over num_threads threads.
+    """
     n_accepted = 0
     n_dismissed = 0
-    with pysam.AlignmentFile(infilename,'rb') as f, pysam.AlignmentFile(outfilename,'wb',template=f) as g:
+    acceptedfams = set(acceptedfams)
+    num_threads = int(num_threads)
+    with pysam.AlignmentFile(infilename,'rb', threads=num_threads) as f, \
+         pysam.AlignmentFile(outfilename,'wb',template=f, threads=num_threads) as g:
         reads=f.fetch()
+        progress = ReadProgress("ML filter")
         for read in reads:
+            progress.update()
             name_contig=read.query_name + "_" + read.reference_name
-            if acceptedfams.eq(name_contig).any():
+            if name_contig in acceptedfams:
                 g.write(read)
                 n_accepted += 1
             else:
@@ -190,22 +314,60 @@ def filter_bamfile(infilename, outfilename, acceptedfams):
     pysam.index(outfilename)
     logging.info(f"Wrote ML filtered BAM file: {outfilename}. Included {n_accepted}, dismissed {n_dismissed} consensus sequences out of {n_accepted+n_dismissed} in total.")
 
-def run_umifilter(input_path, json_path, model_path, output_path, threshold=None, thresholds_path=None):
-    """Apply ML model to UMI families and write a new model BAM file with passing consensus sequences only."""
+def accepted_families(json_path, model_path, threshold=None, thresholds_path=None, library_file=None,
+                      chunksize=DEFAULT_CHUNKSIZE, model_cache=None, model=None, repeat_lengths=None):
+    """
+    Applies the ML model to the UMI families and returns the accepted families,
+    as a set of "<consensus read name>_<contig>". A model already read with
+    load_model and repeat lengths already read from the library file can be
+    given, so that several samples can share them.
+    """
     if thresholds_path:
         logging.info(f'Applying ML model to filter UMI families. Using model from {model_path} with thresholds from {thresholds_path}.')
     else:
         logging.info(f'Applying ML model to filter UMI families. Using model from {model_path} with threshold >= {threshold}.')
-    df_json = read_json(json_path)
-    df_filtered = apply_filter(df_json, model_path, threshold, thresholds_path)
-    accepted_UMIfams = df_filtered["Name"].str.cat(df_filtered["Contig"], sep="_")
-    filter_bamfile(input_path, output_path, accepted_UMIfams)
+    if repeat_lengths is None and library_file:
+        repeat_lengths = ff.get_repeat_lengths_lib(library_file)
+    if model is None:
+        model = load_model(model_path, model_cache)
+    if thresholds_path:
+        threshold_dict = read_thresholds(thresholds_path)
+    else:
+        threshold_dict = None
+
+    # Families are scored one chunk at a time, only the accepted names are kept.
+    accepted_UMIfams = set()
+    if fs.is_family_store(json_path):
+        if fs.read_meta(json_path)["n_families"] == 0:
+            logging.warning(f"No UMI families in {json_path}, the ML filter accepts none.")
+            return accepted_UMIfams
+        feature_chunks = read_store_chunks(json_path, chunksize, repeat_lengths)
+    else:
+        feature_chunks = read_json_feature_chunks(json_path, chunksize, repeat_lengths)
+        if not feature_chunks:
+            logging.warning(f"No UMI families in {json_path}, the ML filter accepts none.")
+    for df_features in feature_chunks:
+        df_filtered = score_families(df_features, model, threshold, threshold_dict)
+        accepted_UMIfams.update(df_filtered["Name"].str.cat(df_filtered["Contig"], sep="_"))
+    return accepted_UMIfams
+
+def run_umifilter(input_path, json_path, model_path, output_path, threshold=None, thresholds_path=None, num_threads=1,
+                  library_file=None, chunksize=DEFAULT_CHUNKSIZE, model_cache=None, model=None, repeat_lengths=None):
+    """
+    Apply ML model to UMI families and write a new model BAM file with passing consensus sequences only.
+    A model already read with load_model and repeat lengths already read from the library file can be
+    given, so that several samples can share them.
+    """
+    accepted_UMIfams = accepted_families(json_path, model_path, threshold, thresholds_path, library_file,
+                                         chunksize, model_cache, model, repeat_lengths)
+    filter_bamfile(input_path, output_path, accepted_UMIfams, num_threads)
     return output_path
 
 def main(args):
-    run_umifilter(args.input_path, args.json_path, args.model_path, args.output_path, args.threshold, args.thresholds_path)
+    run_umifilter(args.input_path, args.json_path, args.model_path, args.output_path, args.threshold, args.thresholds_path,
+                  args.num_threads, args.library_file, args.chunksize, args.model_cache)
     return None
 
 if __name__ == '__main__':
     args = parseArgs()
-    main(args)
+    profile_main(main, args, args.output_path, "umifilter")
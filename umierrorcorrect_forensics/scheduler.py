@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Runs the stages of a sample as a dependency graph.
+
+Each stage is a dict with:
+name    - unique name of the stage
+func    - function that runs the stage, given the number of threads it gets
+after   - names of the stages that must finish before it starts
+threads - the most threads the stage can use
+memory_per_thread - optional, bytes of memory the stage needs per thread
+
+The stages are run in threads, as soon as the stages they come after have
+finished and the resource governor (see resources) has threads, and memory,
+for them, so that independent stages overlap within the budget of the run.
+Ready stages are started in the order they are listed, and each gets as
+many of the free threads as it can use. List light stages before heavy
+stages that become ready at the same time, so that the heavy stage gets the
+threads left over rather than holding up the light one. Threads released by
+other samples are noticed within POLL_INTERVAL seconds.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+POLL_INTERVAL = 1
+
+def check_graph(stages):
+    """Checks that the stages only come after earlier stages, so the graph has no cycles."""
+    names = set()
+    for stage in stages:
+        unknown = [name for name in stage["after"] if name not in names]
+        if unknown:
+            raise ValueError(f"Stage {stage['name']} comes after unknown or later stages: {', '.join(unknown)}")
+        names.add(stage["name"])
+
+def run_reserved(func, governor, threads, memory):
+    try:
+        return func(threads)
+    finally:
+        governor.release(threads, memory)
+
+def run_graph(stages, governor, parallel=True):
+    """
+    Runs the stages with the threads and memory of the governor and returns
+    the results of the stages by name. If not parallel, the stages are run
+    one at a time, in the order they are listed, in the calling thread. If
+    a stage fails, no more stages are started, and its error is raised when
+    the running stages have finished.
+    """
+    check_graph(stages)
+    if not parallel:
+        results = {}
+        for stage in stages:
+            threads, memory = governor.acquire(stage["threads"], stage.get("memory_per_thread", 0))
+            results[stage["name"]] = run_reserved(stage["func"], governor, threads, memory)
+        return results
+
+    pending = list(stages)
+    running = {}
+    results = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+        while pending or running:
+            waiting = False
+            if error is None:
+                for stage in list(pending):
+                    if not all(name in results for name in stage["after"]):
+                        continue
+                    granted = governor.try_acquire(stage["threads"], stage.get("memory_per_thread", 0))
+                    if granted is None:
+                        waiting = True
+                        continue
+                    pending.remove(stage)
+                    running[executor.submit(run_reserved, stage["func"], governor, *granted)] = stage
+            if not running:
+                if waiting:
+                    # All threads are used by other samples
+                    governor.wait(POLL_INTERVAL)
+                    continue
+                break
+            done, _ = wait(running, timeout=POLL_INTERVAL if waiting else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage["name"]] = future.result()
+                except Exception as e:
+                    logging.error(f"Stage {stage['name']} failed: {type(e).__name__}: {e}")
+                    if error is None:
+                        error = e
+    if error is not None:
+        raise error
+    return results
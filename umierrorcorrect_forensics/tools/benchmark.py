@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Scaling benchmark of the pipeline stages on simulated data.
+
+For each number of reads, the input of each stage is simulated (see
+simulate_reads) and the stage is timed: fastq2sam on TSSV marker fastq
+files, the ML filter features and inference on a family store, downsampling
+of paired FASTQ files, and uncollapse and barcode diversity on consensus
+reads. The metrics of each stage (see metrics) are written to
+run_metrics.json, and a summary to benchmark.tsv, in the output directory.
+"""
+import argparse
+import sys
+import os
+import json
+import random
+import shutil
+import logging
+from collections import Counter
+from functools import partial
+import numpy as np
+import pysam
+from umierrorcorrect_forensics import fastq2sam as f2s
+from umierrorcorrect_forensics import run_umifilter as ru
+from umierrorcorrect_forensics.family_features import get_repeat_lengths_lib
+from umierrorcorrect_forensics.family_store import json_to_family_store
+from umierrorcorrect_forensics.metrics import RunMetrics
+from umierrorcorrect_forensics.tools import simulate_reads as sim
+from umierrorcorrect_forensics.tools.downsample import downsample_reads
+from umierrorcorrect_forensics.tools.uncollapse_reads import uncollapse_reads
+
+BENCHMARK_STAGES = ['fastq2sam', 'umifilter_features', 'umifilter_inference', 'downsample',
+                    'uncollapse', 'barcode_diversity']
+DEFAULT_SIZES = '10000,100000,1000000,10000000'
+SUMMARY_COLUMNS = ['stage', 'reads', 'wall_time', 'cpu_time', 'peak_rss', 'reads_per_sec']
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Times the pipeline stages on simulated data of increasing size.")
+    parser.add_argument('-l', '--library', dest='library_file',
+                        help='FDStools library file with marker definitions, required', required=True)
+    parser.add_argument('-b', '--bed', dest='bed_file',
+                        help='Path to BED file with genomic positions of markers, required', required=True)
+    parser.add_argument('-o', '--output_path', dest='output_path',
+                        help='Path to the output directory, required', required=True)
+    parser.add_argument('--sizes', dest='sizes', default=DEFAULT_SIZES,
+                        help='Comma separated numbers of reads to benchmark. Default=%(default)s')
+    parser.add_argument('--stages', dest='stages', default=','.join(BENCHMARK_STAGES),
+                        help='Comma separated stages to benchmark. Default=%(default)s')
+    parser.add_argument('-fm', '--filter_model', dest='filter_model',
+                        help='Path to model for the ML filter inference. The inference is skipped if unset.')
+    parser.add_argument('-fth', '--filter_threshold', dest='filter_threshold', type=float, default=0.5,
+                        help='Probability threshold for the filtering model. Default=%(default)s')
+    parser.add_argument('--model_cache', dest='model_cache',
+                        help='Directory to cache compiled filtering models in.')
+    parser.add_argument('-m', '--mean_family_size', dest='mean_family_size', type=float, default=10,
+                        help='Mean UMI family size. Default=%(default)s')
+    parser.add_argument('-t', '--num_threads', dest='num_threads',
+                        help='Number of threads for the stages that use them. Default=%(default)s', default='1')
+    parser.add_argument('-s', '--seed', dest='seed', type=int, default=1,
+                        help='Seed, for reproducability. Default=%(default)s')
+    parser.add_argument('--keep', dest='keep', action='store_true',
+                        help='Keep the simulated data of each size.')
+    args = parser.parse_args(sys.argv[1:])
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
+    return(args)
+
+def simulate_families(library_file, reads, mean_family_size, seed):
+    """Returns the markers of the library and a generator of simulated UMI families, with reads members in total."""
+    rng = random.Random(seed)
+    markers = sim.read_library(library_file)
+    alleles = sim.make_alleles(markers, rng)
+    sizes = sim.draw_family_sizes(reads, None, 'geometric', mean_family_size, np.random.default_rng(seed))
+    return markers, sim.simulate_families(markers, alleles, sizes, 0.05, 0.002, rng)
+
+def write_tssv_output(output_path, library_file, reads, mean_family_size, seed):
+    """Writes the reads as TSSV does, to a paired.fq file in one directory per marker."""
+    markers, families = simulate_families(library_file, reads, mean_family_size, seed)
+    outfiles = {}
+    for marker in markers:
+        os.makedirs(os.path.join(output_path, marker), exist_ok=True)
+        outfiles[marker] = open(os.path.join(output_path, marker, "paired.fq"), "w")
+    rng = random.Random(seed)
+    n = 0
+    for umi, marker, _, _, members in families:
+        for member in members:
+            outfiles[marker].write(f"@SIM:1:FC:1:1:{n}:{umi} 1:N:0:1\n{member}\n+\n{sim.quality(len(member), rng)}\n")
+            n += 1
+    for outfh in outfiles.values():
+        outfh.close()
+    return output_path
+
+def write_consensus_data(output_path, library_file, bed_file, reads, mean_family_size, seed):
+    """
+    Writes the simulated UMI families as UMIerrorcorrect does: a families
+    JSON file and a sorted, indexed BAM file of consensus reads. The
+    consensus reads are also written as from bam2fastq, to a FASTQ file and
+    a paired.fq file per marker, with the family sizes in the read names.
+    Returns the paths of the JSON, BAM and FASTQ files and the marker directory.
+    """
+    chromosomes, pos, fq_dirs = f2s.get_chr_str(bed_file)
+    bed_markers = {marker: (chromosome, int(p)) for marker, chromosome, p in zip(fq_dirs, chromosomes, pos)}
+    markers, families = simulate_families(library_file, reads, mean_family_size, seed)
+    json_path = os.path.join(output_path, "sim_umi_families.json")
+    fastq_path = os.path.join(output_path, "sim_filtered_consensus_reads.fq")
+    marker_path = os.path.join(output_path, "markers")
+    consensus = {marker: [] for marker in markers if marker in bed_markers}
+    with open(json_path, "w") as jsonfh, open(fastq_path, "w") as fqfh:
+        jsonfh.write("[")
+        separator = ""
+        for i, (umi, marker, _, _, members) in enumerate(families):
+            if marker not in consensus:
+                continue
+            contig = bed_markers[marker][0]
+            counts = Counter(members)
+            seq = counts.most_common(1)[0][0]
+            name = f"Consensus_read_{i}_{umi}_Count={len(members)}"
+            family = {"Name": name, "Contig": contig, "Annotation": [contig, str(bed_markers[marker][1]), marker],
+                      "Consensus": seq, "Members": counts}
+            jsonfh.write(separator + json.dumps(family))
+            separator = ","
+            fqfh.write(f"@{name}\n{seq}\n+\n{'F' * len(seq)}\n")
+            consensus[marker].append((name, seq))
+        jsonfh.write("]")
+
+    bam_path = os.path.join(output_path, "sim_consensus_reads.bam")
+    header = f2s.make_bam_header(chromosomes)
+    with pysam.AlignmentFile(bam_path, "wb", header=header) as outfh:
+        for marker, contig, start in f2s.sorted_markers(chromosomes, fq_dirs, pos):
+            for name, seq in consensus.get(marker, []):
+                outfh.write(f2s.make_bam_record(outfh.header, outfh.get_tid(contig), int(start) - 1,
+                                                name, seq, 'F' * len(seq), marker))
+    pysam.index(bam_path)
+
+    for marker, records in consensus.items():
+        os.makedirs(os.path.join(marker_path, marker), exist_ok=True)
+        with open(os.path.join(marker_path, marker, "paired.fq"), "w") as fh:
+            for name, seq in records:
+                fh.write(f"@{name}\n{seq}\n+\n{'F' * len(seq)}\n")
+    return json_path, bam_path, fastq_path, marker_path
+
+def umifilter_features(store_path, repeat_lengths):
+    return list(ru.read_store_chunks(store_path, repeat_lengths=repeat_lengths))
+
+def umifilter_inference(features, model, threshold):
+    return [ru.score_families(df_features, model, threshold) for df_features in features]
+
+def barcode_diversity(marker_path):
+    # Imported here, as it needs seaborn and matplotlib for its plots
+    from umierrorcorrect_forensics.tools.barcode_diversity import create_histo_loop
+    return create_histo_loop(marker_path)
+
+def write_summary(output_path, stages):
+    with open(os.path.join(output_path, "benchmark.tsv"), "w") as fh:
+        fh.write("\t".join(SUMMARY_COLUMNS) + "\n")
+        for stage in stages:
+            fh.write("\t".join(str(stage.get(column)) for column in SUMMARY_COLUMNS) + "\n")
+
+def benchmark_size(args, metrics, reads, stages, model):
+    """Simulates the inputs of the stages for a number of reads, and times the stages."""
+    data_path = os.path.join(args.output_path, str(reads))
+    os.makedirs(data_path, exist_ok=True)
+    no_outputs = lambda result: []
+
+    def measure(stage, func, inputs, outputs=no_outputs):
+        result = metrics.measure(stage, func, inputs, outputs)
+        metrics.stages[-1]["reads"] = reads
+        metrics.save()
+        write_summary(args.output_path, metrics.stages)
+        return result
+
+    if 'fastq2sam' in stages:
+        logging.info(f'Simulating TSSV output with {reads} reads')
+        tssv_path = write_tssv_output(os.path.join(data_path, "tssv_output"), args.library_file,
+                                      reads, args.mean_family_size, args.seed)
+        chromosomes, pos, fq_dirs = f2s.get_chr_str(args.bed_file)
+        bam_path = os.path.join(data_path, "sim.bam")
+        measure('fastq2sam', partial(f2s.loop_fds_result_bam, tssv_path, bam_path, chromosomes, fq_dirs, pos,
+                                     args.library_file, True, args.num_threads),
+                [], lambda result: [bam_path])
+
+    if stages & {'umifilter_features', 'umifilter_inference', 'uncollapse', 'barcode_diversity'}:
+        logging.info(f'Simulating UMI families with {reads} reads')
+        json_path, bam_path, fastq_path, marker_path = write_consensus_data(data_path, args.library_file, args.bed_file,
+                                                                            reads, args.mean_family_size, args.seed)
+        store_path = json_to_family_store(json_path)
+        repeat_lengths = get_repeat_lengths_lib(args.library_file)
+        if stages & {'umifilter_features', 'umifilter_inference'}:
+            features = measure('umifilter_features', partial(umifilter_features, store_path, repeat_lengths), [bam_path])
+            if 'umifilter_inference' in stages and model is not None:
+                measure('umifilter_inference', partial(umifilter_inference, features, model, args.filter_threshold),
+                        [bam_path])
+        if 'uncollapse' in stages:
+            uncollapsed_path = os.path.join(data_path, "sim_uncollapsed_consensus_reads.fq")
+            measure('uncollapse', partial(uncollapse_reads, fastq_path, uncollapsed_path),
+                    [fastq_path], lambda result: [uncollapsed_path])
+        if 'barcode_diversity' in stages:
+            try:
+                measure('barcode_diversity', partial(barcode_diversity, marker_path), [])
+            except ImportError as e:
+                logging.warning(f'Skipping barcode_diversity: {e}')
+
+    if 'downsample' in stages:
+        logging.info(f'Simulating {reads} read pairs')
+        read1, read2 = sim.simulate_reads(args.library_file, data_path, reads,
+                                          mean_family_size=args.mean_family_size, paired=True,
+                                          seed=args.seed, num_threads=args.num_threads)
+        downsample_path = os.path.join(data_path, "downsampled")
+        os.makedirs(downsample_path, exist_ok=True)
+        measure('downsample', partial(downsample_reads, 0.5, read1, read2, downsample_path, args.seed),
+                [read1, read2], list)
+
+    if not args.keep:
+        shutil.rmtree(data_path)
+
+def run_benchmark(args):
+    stages = set(args.stages.split(','))
+    unknown = stages - set(BENCHMARK_STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+    model = None
+    if 'umifilter_inference' in stages:
+        if args.filter_model:
+            model = ru.load_model(args.filter_model, args.model_cache)
+        else:
+            logging.warning('Skipping umifilter_inference, as no filter model was given')
+    os.makedirs(args.output_path, exist_ok=True)
+    # The benchmark reports reads per second, so reads are counted, outside the timing of the stages
+    metrics = RunMetrics(args.output_path, count_reads=True)
+    for reads in (int(size) for size in args.sizes.split(',')):
+        benchmark_size(args, metrics, reads, stages, model)
+    return metrics.stages
+
+def main(args):
+    run_benchmark(args)
+
+if __name__ == '__main__':
+    args = parseArgs()
+    main(args)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Checks that the flank search of fastq2sam (flank_search.py) gives the same
+trim positions as the reference implementation,
+fastq2sam.search_for_flank_trim.
+
+The reads are the paired.fq files of a TSSV output folder, if given, and
+reads simulated from the markers of a library file (such as
+data/ultra_library.txt). The simulated reads are alleles between the
+marker flanks, as in simulate_reads.py, with substitutions, insertions and
+deletions in the flanks, lowercase overhang bases as from FLASH, random
+read ends and truncated reads, so that the approximate search is used, also
+for windows running past the start of the read. Prints the number of reads
+checked and each read whose trim positions differ, and exits with status 1
+if any do.
+"""
+import argparse
+import sys
+import os
+import random
+from umierrorcorrect_forensics.fastq2sam import get_flanks_lib, rev_comp, search_for_flank_trim
+from umierrorcorrect_forensics.flank_search import compile_flank, search_compiled_flank_trim
+from umierrorcorrect_forensics.tools.simulate_reads import (read_library, make_allele, allele_sequence, add_errors,
+                                                            revcomp)
+
+BASES = "ACGT"
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Checks the flank search of fastq2sam against the reference implementation.")
+    parser.add_argument('-l', '--library', dest='library_file',
+                        help='FDStools library file with the marker flanks, required', required=True)
+    parser.add_argument('-i', '--infile', dest='infolder',
+                        help='Folder created by FDStools tssv, whose paired.fq files are checked as well')
+    parser.add_argument('-n', '--reads', dest='reads', type=int, default=2000,
+                        help='Number of simulated reads per marker. Default=%(default)s')
+    parser.add_argument('-s', '--seed', dest='seed', type=int, default=1,
+                        help='Seed of the simulated reads. Default=%(default)s')
+    args = parser.parse_args(sys.argv[1:])
+    return args
+
+def edit_flank(flank, edits, rng):
+    """Returns the flank with the given number of random substitutions, insertions and deletions."""
+    flank = list(flank)
+    for _ in range(edits):
+        pos = rng.randrange(len(flank))
+        kind = rng.randrange(3)
+        if kind == 0:
+            flank[pos] = rng.choice(BASES)
+        elif kind == 1:
+            flank.insert(pos, rng.choice(BASES))
+        elif len(flank) > 1:
+            del flank[pos]
+    return "".join(flank)
+
+def simulate_read(marker, rng):
+    """Returns a read of a random allele of a marker, with edits in its flanks."""
+    left, right = marker["flanks"]
+    seq = allele_sequence(marker, make_allele(marker, rng))
+    core = seq[len(left):len(seq) - len(right)]
+    # Up to 4 edits, so that flanks within and beyond the distance of the search are both checked
+    seq = edit_flank(left, rng.randrange(5), rng) + core + edit_flank(right, rng.randrange(5), rng)
+    seq = add_errors(seq, 0.01, rng)
+    seq += "".join(rng.choice(BASES) for _ in range(rng.randrange(20)))
+    if rng.random() < 0.1:
+        seq = revcomp(seq)
+    if rng.random() < 0.2:
+        # Overhang bases are lowercase in reads merged by FLASH
+        start = rng.randrange(len(seq))
+        seq = seq[:start] + seq[start:].lower()
+    if rng.random() < 0.2:
+        seq = seq[:rng.randrange(1, len(seq) + 1)]
+    return seq
+
+def simulated_reads(library_file, reads, seed):
+    """Yields (marker, read) for the simulated reads of each marker with flanks in the library."""
+    rng = random.Random(seed)
+    for name, marker in read_library(library_file).items():
+        for _ in range(reads):
+            yield name, simulate_read(marker, rng)
+
+def tssv_reads(infolder, markers):
+    """Yields (marker, read) for the reads in the paired.fq file of each marker in a TSSV output folder."""
+    for name in markers:
+        path = os.path.join(infolder, name, "paired.fq")
+        if not os.path.isfile(path):
+            continue
+        with open(path) as fh:
+            for i, line in enumerate(fh):
+                if i % 4 == 1:
+                    yield name, line.rstrip()
+
+def check_reads(reads, flanks):
+    """
+    Compares the trim positions of both implementations on (marker, read),
+    with the flanks fastq2sam uses. Returns the number of reads checked and
+    the reads whose trim positions differ, as (marker, read, reference, fast).
+    """
+    compiled = {}
+    checked = 0
+    differing = []
+    for name, seq in reads:
+        if name not in compiled:
+            flank, flank_rev = flanks[name][1], rev_comp(flanks[name][0])
+            compiled[name] = (flank, flank_rev, compile_flank(flank), compile_flank(flank_rev))
+        flank, flank_rev, compiled_flank, compiled_flank_rev = compiled[name]
+        expected = search_for_flank_trim(seq, flank, flank_rev, len(flank), len(flank_rev))
+        found = search_compiled_flank_trim(seq, compiled_flank, compiled_flank_rev)
+        checked += 1
+        if found != expected:
+            differing.append((name, seq, expected, found))
+    return checked, differing
+
+def main(args):
+    flanks = get_flanks_lib(args.library_file)
+    checked, differing = check_reads(simulated_reads(args.library_file, args.reads, args.seed), flanks)
+    print(f"{checked} simulated reads checked, {len(differing)} differ")
+    if args.infolder:
+        tssv_checked, tssv_differing = check_reads(tssv_reads(args.infolder, flanks), flanks)
+        print(f"{tssv_checked} TSSV reads checked, {len(tssv_differing)} differ")
+        differing += tssv_differing
+    for name, seq, expected, found in differing:
+        print(f"{name}\t{seq}\treference: {expected}\tflank_search: {found}")
+    return 1 if differing else 0
+
+if __name__ == '__main__':
+    args = parseArgs()
+    sys.exit(main(args))
@@ -3,7 +3,8 @@ import argparse
 import random
 import sys
 import os
-import gzip as gz
+from umierrorcorrect_forensics.compression import COMPRESSION_MODES, fastq_suffix, open_fastq
+from umierrorcorrect_forensics.metrics import ReadProgress
 def parseArgs():
     parser = argparse.ArgumentParser(description="To downsample the number of reads from a SimSenSeq experiment. Useful for evaluation.")
     parser.add_argument('-o', '--output_path', dest='output_path',
@@ -16,60 +17,63 @@ def parseArgs():
                         help='fraction of reads to keep', required=True)
     parser.add_argument('-s', '--seed', dest='seed',
                         help='for reproducability')
+    parser.add_argument('-c', '--compression', dest='compression', choices=COMPRESSION_MODES, default='none',
+                        help='Compression of the output files. Default=%(default)s')
+    parser.add_argument('-t', '--num_threads', dest='num_threads',
+                        help='Number of threads for compression. Default=%(default)s', default='1')
     args = parser.parse_args(sys.argv[1:])
     return(args)
 
-def read_fastq(fn):
+def read_fastq(fn, num_threads=1):
     """
-    A generator that reads gzip compressed FASTA format files and yields each
-    block of 4 lines
+    A generator that reads FASTQ format files, optionally gzip compressed,
+    and yields each block of 4 lines. Compressed files are decompressed by
+    a separate process.
     
     :param fn: Name of the file with path
     :return: Yields list containing 4 lines, each as str element
     """
     
     block = []
-    if fn.endswith(".gz"):
-        for line in gz.open(fn):
-            block.append(line.decode("utf-8").strip())
-            if len(block) == 4:
-                yield block
-                block = []
-    else:
-        for line in open(fn):
+    with open_fastq(fn, num_threads=num_threads) as f:
+        for line in f:
             block.append(line.strip())
             if len(block) == 4:
                 yield block
                 block = []
 
-def downsample_reads(frac, read1, read2, output_path, seed):
+def downsample_reads(frac, read1, read2=None, output_path=None, seed=None, compression='none', num_threads=1):
     frac = float(frac)
     if seed:
         random.seed(int(seed))
     if not(output_path): 
         output_path = os.path.dirname(read1)
+    suffix = "_downsampled" + fastq_suffix(compression)
+    progress = ReadProgress("Downsampling")
     
     if read2:
         file1_name = str.split(os.path.basename(read1),".")[0]
         file2_name = str.split(os.path.basename(read2),".")[0]
-        out1_path = os.path.join(output_path,file1_name+"_downsampled.fastq")
-        out2_path = os.path.join(output_path,file2_name+"_downsampled.fastq")
-        out1 = open( out1_path ,"w")
-        out2 = open( out2_path ,"w")
-        for r1,r2 in zip(read_fastq(read1),read_fastq(read2)):
-            if random.random() < frac:
-                for l1,l2 in zip(r1,r2):
-                    out1.write(l1 + "\n")
-                    out2.write(l2 + "\n")
+        out1_path = os.path.join(output_path,file1_name+suffix)
+        out2_path = os.path.join(output_path,file2_name+suffix)
+        with open_fastq(out1_path, "w", compression, num_threads) as out1, \
+             open_fastq(out2_path, "w", compression, num_threads) as out2:
+            for r1,r2 in zip(read_fastq(read1, num_threads),read_fastq(read2, num_threads)):
+                progress.update()
+                if random.random() < frac:
+                    for l1,l2 in zip(r1,r2):
+                        out1.write(l1 + "\n")
+                        out2.write(l2 + "\n")
         return out1_path, out2_path
     else:
         file1_name = str.split(os.path.basename(read1),".")[0]
-        out1_path = os.path.join(output_path,file1_name+"_downsampled.fastq")
-        out1 = open(out1_path,"w")
-        for r1 in read_fastq(read1):
-            if random.random() < frac:
-                for l1 in r1:
-                    out1.write(l1 + "\n")
+        out1_path = os.path.join(output_path,file1_name+suffix)
+        with open_fastq(out1_path, "w", compression, num_threads) as out1:
+            for r1 in read_fastq(read1, num_threads):
+                progress.update()
+                if random.random() < frac:
+                    for l1 in r1:
+                        out1.write(l1 + "\n")
         return out1_path
 
 def main(): 
@@ -77,7 +81,9 @@ def main():
                       frac = args.frac, 
                       read1 = args.read1, 
                       read2 = args.read2, 
-                      seed = args.seed)
+                      seed = args.seed,
+                      compression = args.compression,
+                      num_threads = args.num_threads)
 
 if __name__ == '__main__':
     args = parseArgs()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Simulates UMI tagged sequencing reads of the markers in an FDStools library
+file, for testing and benchmarking the pipeline.
+
+Two alleles of each marker are built from the prefix, repeat structure and
+suffix in the library, and each UMI family is a molecule of one of them,
+between the marker flanks. The family members get stutters (one repeat
+unit less, or more at a tenth of the rate) and substitution errors. Each
+read starts with the 12 nt UMI and the 16 nt spacer that the
+UMIerrorcorrect preprocessing removes, on a random strand. Paired reads
+are read from both ends of the molecule, with adapter read-through for
+molecules shorter than the reads.
+"""
+import argparse
+import sys
+import os
+import math
+import random
+import configparser
+import numpy as np
+from umierrorcorrect_forensics.compression import COMPRESSION_MODES, fastq_suffix, open_fastq
+
+UMI_LENGTH = 12
+SPACER = "ACGTCAGTCATCGCAT"
+ADAPTER_R1 = "AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC"
+ADAPTER_R2 = "AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT"
+FAMILY_SIZE_DISTRIBUTIONS = ('geometric', 'poisson', 'lognormal', 'fixed')
+# Reads are shuffled in blocks of this many reads, so that families are spread out
+SHUFFLE_BUFFER = 100000
+QUALITIES = "FFFFFFFFF:FFFF,FFFFF:FFFFFFF:FFFFFFF,FFF"
+SUBSTITUTIONS = {"A": "CGT", "C": "AGT", "G": "ACT", "T": "ACG"}
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Simulates UMI tagged reads of the markers in an FDStools library file.")
+    parser.add_argument('-l', '--library', dest='library_file',
+                        help='FDStools library file with marker definitions, required', required=True)
+    parser.add_argument('-o', '--output_path', dest='output_path',
+                        help='Path to the output directory, required', required=True)
+    parser.add_argument('--name', dest='name', default='simulated',
+                        help='Sample name, used in the file names. Default=%(default)s')
+    parser.add_argument('-n', '--reads', dest='reads', type=int,
+                        help='Number of reads (or read pairs) to simulate.')
+    parser.add_argument('-u', '--umis', dest='umis', type=int,
+                        help='Number of UMI families. Default is the number of reads divided by the mean family size.')
+    parser.add_argument('-d', '--family_size_distribution', dest='distribution', choices=FAMILY_SIZE_DISTRIBUTIONS,
+                        default='geometric', help='Distribution of the UMI family sizes. Default=%(default)s')
+    parser.add_argument('-m', '--mean_family_size', dest='mean_family_size', type=float, default=10,
+                        help='Mean UMI family size. Default=%(default)s')
+    parser.add_argument('--stutter_rate', dest='stutter_rate', type=float, default=0.05,
+                        help='Proportion of reads with a stutter. Default=%(default)s')
+    parser.add_argument('--error_rate', dest='error_rate', type=float, default=0.002,
+                        help='Substitution error rate per base. Default=%(default)s')
+    parser.add_argument('--read_length', dest='read_length', type=int, default=150,
+                        help='Read length. Default=%(default)s')
+    parser.add_argument('-p', help='Simulate paired reads', action='store_true')
+    parser.add_argument('-s', '--seed', dest='seed', type=int,
+                        help='Seed, for reproducability.')
+    parser.add_argument('-c', '--compression', dest='compression', choices=COMPRESSION_MODES, default='gzip',
+                        help='Compression of the output files. Default=%(default)s')
+    parser.add_argument('-t', '--num_threads', dest='num_threads',
+                        help='Number of threads for compression. Default=%(default)s', default='1')
+    args = parser.parse_args(sys.argv[1:])
+    if not args.reads and not args.umis:
+        parser.error('Give the number of reads, the number of UMIs, or both')
+    return(args)
+
+def revcomp(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+def read_library(library_file):
+    """
+    Reads the flanks, first prefix and suffix, and repeat structure of each
+    marker with flanks from an FDStools library file.
+    """
+    config = configparser.ConfigParser(interpolation=None, comment_prefixes=(';',), strict=False)
+    config.optionxform = str
+    config.read(library_file)
+    markers = {}
+    for marker, flanks in config["flanks"].items():
+        left, right = (flank.strip() for flank in flanks.split(","))
+        repeat = config["repeat"].get(marker, "").split()
+        markers[marker] = {"flanks": (left, right),
+                           "prefix": config["prefix"].get(marker, "").split(",")[0].strip(),
+                           "suffix": config["suffix"].get(marker, "").split(",")[0].strip(),
+                           "repeat": [(repeat[i], int(repeat[i+1]), int(repeat[i+2]))
+                                      for i in range(0, len(repeat), 3)]}
+    return markers
+
+def make_allele(marker, rng):
+    """
+    Returns an allele as the repeat counts of each block of the repeat
+    structure. Optional blocks are left out at random, and long blocks are
+    kept at realistic lengths.
+    """
+    counts = []
+    for unit, minimum, maximum in marker["repeat"]:
+        if minimum == 0 and rng.random() < 0.5:
+            counts.append(0)
+        else:
+            counts.append(rng.randint(max(minimum, 1), max(minimum, min(maximum, 12))))
+    return counts
+
+def allele_sequence(marker, counts):
+    """Returns the sequence of an allele, with the marker flanks."""
+    repeat = "".join(unit * count for (unit, _, _), count in zip(marker["repeat"], counts))
+    return marker["flanks"][0] + marker["prefix"] + repeat + marker["suffix"] + marker["flanks"][1]
+
+def stutter(marker, counts, kind):
+    """Returns the counts of an allele with one repeat unit less (kind=-1) or more in its longest block."""
+    block = max(range(len(counts)), key=lambda i: counts[i] * len(marker["repeat"][i][0]))
+    counts = list(counts)
+    counts[block] = max(counts[block] + kind, 0)
+    return counts
+
+def add_errors(seq, error_rate, rng):
+    """Substitutes bases at error_rate, drawing the distance to the next error."""
+    if error_rate <= 0:
+        return seq
+    log_rate = math.log1p(-error_rate)
+    pos = int(math.log(1.0 - rng.random()) / log_rate)
+    if pos >= len(seq):
+        return seq
+    seq = list(seq)
+    while pos < len(seq):
+        seq[pos] = rng.choice(SUBSTITUTIONS.get(seq[pos], "ACGT"))
+        pos += 1 + int(math.log(1.0 - rng.random()) / log_rate)
+    return "".join(seq)
+
+def family_sizes(n_umis, distribution, mean, np_rng):
+    """Draws UMI family sizes of at least one read, with the given mean."""
+    if distribution == 'fixed':
+        return np.full(n_umis, max(int(round(mean)), 1))
+    if distribution == 'poisson':
+        return 1 + np_rng.poisson(max(mean - 1, 0), n_umis)
+    if distribution == 'lognormal':
+        sigma = 1.0
+        return np.maximum(np.rint(np_rng.lognormal(math.log(mean) - sigma**2 / 2, sigma, n_umis)), 1).astype(np.int64)
+    return np_rng.geometric(1 / max(mean, 1), n_umis)
+
+def draw_family_sizes(reads, umis, distribution, mean, np_rng):
+    """
+    Returns the family sizes. Without a UMI count, families are drawn until
+    the number of reads is reached. With both, the sizes are scaled to the
+    number of reads.
+    """
+    if umis is None:
+        sizes = []
+        total = 0
+        while total < reads:
+            block = family_sizes(max(int((reads - total) / mean), 1000), distribution, mean, np_rng)
+            block = block[:np.searchsorted(np.cumsum(block), reads - total) + 1]
+            sizes.append(block)
+            total += block.sum()
+        sizes = np.concatenate(sizes)
+        sizes[-1] -= total - reads
+        return sizes
+    sizes = family_sizes(umis, distribution, mean, np_rng)
+    if reads:
+        sizes = np.maximum(np.rint(sizes * reads / sizes.sum()), 1).astype(np.int64)
+    return sizes
+
+def make_alleles(markers, rng):
+    """Two alleles of each marker, as repeat counts."""
+    return {name: [make_allele(marker, rng) for _ in range(2)] for name, marker in markers.items()}
+
+def simulate_families(markers, alleles, sizes, stutter_rate, error_rate, rng):
+    """
+    Yields the UMI families as (UMI, marker, allele sequence, strand, members),
+    where members are the sequences of the molecules of the family, in the
+    marker orientation, with stutters and errors.
+    """
+    names = list(markers)
+    for size in sizes:
+        name = rng.choice(names)
+        marker = markers[name]
+        counts = rng.choice(alleles[name])
+        sequences = {}
+        members = []
+        for _ in range(int(size)):
+            x = rng.random()
+            kind = -1 if x < stutter_rate else 1 if x < stutter_rate * 1.1 else 0
+            if kind not in sequences:
+                sequences[kind] = allele_sequence(marker, stutter(marker, counts, kind) if kind else counts)
+            members.append(add_errors(sequences[kind], error_rate, rng))
+        umi = "".join(rng.choices("ACGT", k=UMI_LENGTH))
+        yield umi, name, sequences.get(0) or allele_sequence(marker, counts), rng.random() < 0.5, members
+
+def quality(length, rng):
+    start = rng.randrange(len(QUALITIES))
+    qual = QUALITIES[start:] + QUALITIES * (length // len(QUALITIES) + 1)
+    return qual[:length]
+
+def make_reads(umi, member, reverse, read_length, paired, error_rate, rng):
+    """Returns the read, or read pair, of a molecule, starting with the UMI and spacer."""
+    molecule = revcomp(member) if reverse else member
+    insert = add_errors(umi + SPACER, error_rate, rng) + molecule
+    read1 = (insert + ADAPTER_R1)[:read_length]
+    if not paired:
+        return (read1,)
+    read2 = (revcomp(insert) + ADAPTER_R2)[:read_length]
+    return read1, read2
+
+def write_reads(outfiles, buffer, first_read, rng):
+    rng.shuffle(buffer)
+    for i, reads in enumerate(buffer, first_read):
+        for mate, (outfh, read) in enumerate(zip(outfiles, reads), 1):
+            outfh.write(f"@SIM:1:FC:1:1:{i}:1 {mate}:N:0:1\n{read}\n+\n{quality(len(read), rng)}\n")
+
+def simulate_reads(library_file, output_path, reads=None, umis=None, distribution='geometric', mean_family_size=10,
+                   stutter_rate=0.05, error_rate=0.002, read_length=150, paired=False, seed=None,
+                   compression='gzip', num_threads=1, name='simulated'):
+    """
+    Writes simulated reads of the markers in the library to FASTQ files,
+    and the simulated alleles to <name>_alleles.tsv. Returns the paths of
+    the FASTQ files.
+    """
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    markers = read_library(library_file)
+    alleles = make_alleles(markers, rng)
+    sizes = draw_family_sizes(reads, umis, distribution, mean_family_size, np_rng)
+    os.makedirs(output_path, exist_ok=True)
+    with open(os.path.join(output_path, name + "_alleles.tsv"), "w") as fh:
+        fh.write("marker\tallele\n")
+        for marker, marker_alleles in alleles.items():
+            for counts in marker_alleles:
+                fh.write(f"{marker}\t{allele_sequence(markers[marker], counts)}\n")
+
+    paths = [os.path.join(output_path, f"{name}_R{mate}" + fastq_suffix(compression)) for mate in range(1, paired + 2)]
+    with open_fastq(paths[0], "w", compression, num_threads) as out1, \
+         (open_fastq(paths[1], "w", compression, num_threads) if paired else open(os.devnull, "w")) as out2:
+        outfiles = [out1, out2]
+        buffer = []
+        n_reads = 0
+        for umi, _, _, reverse, members in simulate_families(markers, alleles, sizes, stutter_rate, error_rate, rng):
+            for member in members:
+                buffer.append(make_reads(umi, member, reverse, read_length, paired, error_rate, rng))
+            if len(buffer) >= SHUFFLE_BUFFER:
+                write_reads(outfiles, buffer, n_reads, rng)
+                n_reads += len(buffer)
+                buffer = []
+        write_reads(outfiles, buffer, n_reads, rng)
+    return paths
+
+def main(args):
+    simulate_reads(args.library_file, args.output_path, args.reads, args.umis, args.distribution,
+                   args.mean_family_size, args.stutter_rate, args.error_rate, args.read_length, args.p,
+                   args.seed, args.compression, args.num_threads, args.name)
+
+if __name__ == '__main__':
+    args = parseArgs()
+    main(args)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+In-process, multi-core TSSV marker assignment with a flank seed prefilter.
+
+FDStools TSSV aligns both flanks of every marker to each read and to its
+reverse complement. Here, the TSSV engine of FDStools is run in-process, and
+before the alignments a read is checked for exact seeds of each flank: a
+flank that aligns with at most t mismatches/indels, where t is its
+threshold, contains at least one of t+1 disjoint segments of the flank
+without errors. The seeds of all flanks are looked up for a whole batch of
+reads at once with NumPy, and only the markers with a seed in the read (or
+its reverse complement) are aligned. Markers without seeds give the same
+result as an alignment that found nothing, so the output is the same as
+from fdstools tssv.
+
+The batches are spread over a process pool and the reads are handled in
+input order, so the output files are the same as from fdstools tssv with
+one thread, for any number of threads.
+"""
+import argparse
+import sys
+import os
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+import numpy as np
+from fdstools.lib.io import parse_reads
+from fdstools.lib.library import parse_library
+from fdstools.lib.seq import reverse_complement
+from fdstools.tools.tssv import TSSV, process_sequence, open_outdir, flatten_qualities
+from umierrorcorrect_forensics.compression import decompressed_path
+from umierrorcorrect_forensics.metrics import ReadProgress
+
+# Same settings as run_tssv, the others are the FDStools tssv defaults.
+INDEL_SCORE = 2
+MISMATCHES = 0.1
+FLANK_LENGTH = 16
+MINIMUM = 2
+
+# Longer seeds are cut to this length, so the seed tables stay small.
+MAX_SEED_LENGTH = 8
+# Same batches as FDStools, of about 1 million alignments each.
+ALIGNMENTS_PER_BATCH = 1000000
+
+FLANK_BASES = str.maketrans("1248", "ACGT")
+BASE_CODES = np.full(256, 4, dtype=np.int64)
+for code, bases in enumerate(["Aa", "Cc", "Gg", "TtUu"]):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+
+# Set in each worker process by init_worker.
+worker_state = {}
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Links reads to markers with the FDStools TSSV engine, in-process.")
+    parser.add_argument('-r1', '--read1', dest='read1',
+                        help='Path to the FASTQ file, optionally gzipped, required', required=True)
+    parser.add_argument('-l', '--library', dest='library_file',
+                        help='FDStools library file with marker definitions, required', required=True)
+    parser.add_argument('-o', '--output_path', dest='output_path',
+                        help='TSSV output directory, required', required=True)
+    parser.add_argument('-t', '--num_threads', dest='num_threads',
+                        help='Number of processes to align reads in. Default=%(default)s', default='1')
+    args = parser.parse_args(sys.argv[1:])
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
+    return(args)
+
+def flank_seeds(flank, threshold):
+    """
+    Returns t+1 disjoint exact seeds of a flank (as in the TSSV library, with
+    IUPAC bit codes) for threshold t, or None if the flank has no usable seeds.
+    """
+    flank = flank.translate(FLANK_BASES)
+    seed_length = len(flank) // (threshold + 1)
+    if seed_length == 0:
+        return None
+    seeds = [flank[i*seed_length:(i+1)*seed_length][:MAX_SEED_LENGTH] for i in range(threshold + 1)]
+    if any(seed.strip("ACGT") for seed in seeds):
+        # An ambiguous base in a seed could match several bases
+        return None
+    return seeds
+
+def seed_code(seed):
+    code = 0
+    for base in seed:
+        code = code*4 + int(BASE_CODES[ord(base)])
+    return code
+
+def build_seed_index(tssv_library):
+    """
+    Builds one table per seed length, with a bit mask of the markers that
+    have the seed, or its reverse complement, in a flank. Markers with a
+    flank without usable seeds are always aligned.
+    """
+    markers = list(tssv_library)
+    n_words = (len(markers) + 63) // 64
+    tables = {}
+    always = np.zeros(n_words, dtype=np.uint64)
+    for i, marker in enumerate(markers):
+        word, bit = divmod(i, 64)
+        flanks, thresholds, _ = tssv_library[marker]
+        for flank, threshold in zip(flanks, thresholds):
+            seeds = flank_seeds(flank, threshold)
+            if seeds is None:
+                always[word] |= np.uint64(1 << bit)
+                continue
+            for seed in seeds:
+                # Last row is for positions without a valid seed
+                table = tables.setdefault(len(seed), np.zeros((4**len(seed) + 1, n_words), dtype=np.uint64))
+                table[seed_code(seed), word] |= np.uint64(1 << bit)
+                table[seed_code(reverse_complement(seed)), word] |= np.uint64(1 << bit)
+    return {"markers": markers, "tables": tables, "always": always}
+
+def candidate_masks(seqs, seed_index):
+    """
+    Returns the bit masks of the candidate markers of each sequence. All
+    sequences are joined, separated by an invalid base, and the seeds at all
+    positions are looked up at once. Ambiguous bases in a read can match any
+    flank base, so all markers are candidates for such reads.
+    """
+    lengths = np.fromiter((len(seq) + 1 for seq in seqs), dtype=np.int64, count=len(seqs))
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    max_seed = max(seed_index["tables"], default=0)
+    joined = "\n".join(seqs) + "\n" * (max_seed + 1)
+    bases = BASE_CODES[np.frombuffer(joined.encode(), dtype=np.uint8)]
+    n_positions = int(lengths.sum())
+    masks = np.tile(seed_index["always"], (len(seqs), 1))
+    # Each sequence ends with one separator
+    ambiguous = np.add.reduceat(bases[:n_positions] == 4, starts) > 1
+    masks[ambiguous] = np.uint64(0xFFFFFFFFFFFFFFFF)
+    for seed_length, table in seed_index["tables"].items():
+        codes = np.zeros(n_positions, dtype=np.int64)
+        invalid = np.zeros(n_positions, dtype=bool)
+        for i in range(seed_length):
+            window = bases[i:i + n_positions]
+            codes = codes*4 + window
+            invalid |= window == 4
+        codes[invalid] = len(table) - 1
+        masks |= np.bitwise_or.reduceat(table[codes], starts, axis=0)
+    return masks
+
+def process_sequence_prefiltered(tssv_library, indel_score, markers, mask, seq):
+    """
+    Same results as fdstools.tools.tssv.process_sequence, but aligning only
+    the markers in mask. The other markers are given the result of an
+    alignment where neither flank was found.
+    """
+    candidates = {marker: tssv_library[marker] for i, marker in enumerate(markers)
+                  if int(mask[i // 64]) >> (i % 64) & 1}
+    if not candidates:
+        return [(marker, 0, None, None, False) for marker in markers]
+    results = {result[0]: result for result in process_sequence(candidates, indel_score, seq)}
+    return [results.get(marker, (marker, 0, None, None, False)) for marker in markers]
+
+def process_batch(tssv_library, indel_score, seed_index, batch):
+    if not batch:
+        return ()
+    masks = candidate_masks(batch, seed_index)
+    return tuple((seq, process_sequence_prefiltered(tssv_library, indel_score, seed_index["markers"], mask, seq))
+                 for seq, mask in zip(batch, masks))
+
+def init_worker(tssv_library, indel_score, seed_index):
+    worker_state["args"] = (tssv_library, indel_score, seed_index)
+
+def process_batch_worker(batch):
+    return process_batch(*worker_state["args"], batch)
+
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while batch := tuple(islice(iterator, n)):
+        yield batch
+
+class InProcessTSSV(TSSV):
+    """
+    FDStools TSSV with the flank seed prefilter. The reads are read in
+    batches, the new sequences of a batch are aligned, and the reads are
+    then handled in input order, as by FDStools TSSV with one thread.
+    Reads are always deduplicated.
+    """
+    def process_file(self, resolve_ambiguous):
+        self.progress = ReadProgress("TSSV")
+        seed_index = build_seed_index(self.tssv_library)
+        batch_size = ALIGNMENTS_PER_BATCH // (4 * len(self.tssv_library)) or 1
+        if self.workers == 1:
+            for records in batched(self.input, batch_size):
+                seqs = self.new_sequences(records)
+                self.process_records(records, process_batch(self.tssv_library, self.indel_score, seed_index, seqs))
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                     initargs=(self.tssv_library, self.indel_score, seed_index)) as executor:
+                # At most two batches per worker are kept in memory.
+                pending = deque()
+                for records in batched(self.input, batch_size):
+                    pending.append((records, executor.submit(process_batch_worker, self.new_sequences(records))))
+                    if len(pending) >= 2 * self.workers:
+                        records, future = pending.popleft()
+                        self.process_records(records, future.result())
+                while pending:
+                    records, future = pending.popleft()
+                    self.process_records(records, future.result())
+
+        # Same as in TSSV.process_file
+        if resolve_ambiguous:
+            self.process_ambiguous_sequences()
+        if self.distrust_base_quality:
+            self.flatten_low_quality_bases()
+        if self.output_qualities:
+            for marker_seqs in self.sequences.values():
+                for seq_values in marker_seqs.values():
+                    seq_values[2] = flatten_qualities(seq_values[2], seq_values[0] + seq_values[1])
+        for marker in self.tssv_library:
+            self.counters[marker]["unique_seqs"] = len(self.sequences[marker])
+
+    def new_sequences(self, records):
+        """Returns the sequences not seen in earlier reads, in input order."""
+        seqs = []
+        for record in records:
+            if record[1] not in self.cache:
+                self.cache[record[1]] = None
+                seqs.append(record[1])
+        return seqs
+
+    def process_records(self, records, batch_results):
+        for seq, results in batch_results:
+            self.cache[seq] = results
+        for record in records:
+            self.process_results(record, self.cache[record[1]])
+        self.progress.update(len(records))
+
+def make_tssv(tssv_class, reads, library, num_threads, outdir=None, **kwargs):
+    """Creates a TSSV object with the same settings as run_tssv."""
+    return tssv_class(reads, library, FLANK_LENGTH, MISMATCHES, True, False, 0,
+                      INDEL_SCORE, outdir, int(num_threads), True, **kwargs)
+
+def read_library(library_file):
+    with open(library_file) as fh:
+        return parse_library(fh)
+
+def write_tssv_tables(tssv, output_path=None):
+    """
+    Writes the sequence and statistics tables, filtered as by fdstools tssv.
+    If the TSSV object has no output directory, they are written to output_path.
+    """
+    tssv.filter_sequences(True, MINIMUM, "include")
+    if tssv.outfiles:
+        with open(os.devnull, "w") as devnull:
+            tssv.write_sequence_tables(devnull)
+        tssv.write_statistics_table(None)
+    else:
+        with open(os.path.join(output_path, "sequences.csv"), "w") as seqfh:
+            tssv.write_sequence_tables(seqfh)
+        with open(os.path.join(output_path, "statistics.csv"), "w") as statfh:
+            tssv.write_statistics_table(statfh)
+
+def run_tssv_inprocess(fastq_file, library_file, num_threads, output_path):
+    """
+    Links the reads of a FASTQ file, optionally gzipped, to markers and
+    writes the same output directory as fdstools tssv --dir. Compressed files
+    are decompressed by a separate process.
+    """
+    library = read_library(library_file)
+    with decompressed_path(fastq_file, num_threads) as reads_path, \
+         parse_reads(reads_path) as (file_format, reads), \
+         open_outdir(Path(output_path), library.get_ranges(), file_format, 0) as outdir:
+        tssv = make_tssv(InProcessTSSV, reads, library, num_threads, outdir)
+        tssv.process_file(True)
+        write_tssv_tables(tssv)
+    logging.info(f'Linked {tssv.total_reads - tssv.unrecognised} of {tssv.total_reads} reads to markers')
+    return output_path
+
+def main(args):
+    run_tssv_inprocess(args.read1, args.library_file, args.num_threads, args.output_path)
+
+if __name__ == '__main__':
+    args = parseArgs()
+    main(args)